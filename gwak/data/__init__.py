@@ -1 +1,2 @@
-from .prior import BasePrior
\ No newline at end of file
+from .prior import BasePrior
+from .glitch_catalog import GlitchCatalog
\ No newline at end of file
@@ -1,37 +1,185 @@
 import h5py
-import subprocess
+import logging
 from typing import Optional
 
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from background_utils import (
     get_conincident_segs,
+    plan_shards,
     get_background,
     create_lcs,
     omicron_bashes,
-    glitch_merger
+    glitch_merger,
+    owned_spans,
+    combine_catalogs,
+    discover_frames,
+    write_background_streamed,
+    write_decimated,
+    load_manifest,
+    update_manifest
 )
+from omicron_scheduler import OmicronScheduler
+from excess_power import excess_power
 
 
-def run_bash(bash_file):
+def omicron_dir(omi_paras: dict, seg_num: int):
 
-    subprocess.run(
-        ["bash", f"{bash_file}"], 
+    return Path(omi_paras["out_dir"]) / f"Segs_{seg_num:05d}"
+
+
+def prepare_omicron(
+    seg_num: int,
+    seg_start: int,
+    seg_end: int,
+    ifos: list[str],
+    channels: list[str],
+    frame_type: list[str],
+    sample_rate: int,
+    omi_paras: dict,
+    frame_cache: Optional[dict] = None,
+):
+    """
+    Write the frame caches and omicron scripts of a single segment.
+    Returns the segment's project directory and its bash scripts.
+    """
+
+    project_dir = omicron_dir(omi_paras, seg_num)
+
+    for ifo, frametype in zip(ifos, frame_type):
+
+        create_lcs(
+            ifo=ifo,
+            frametype=f"{ifo}_{frametype}",
+            start_time=seg_start,
+            end_time=seg_end,
+            output_dir= project_dir,
+            urltype="file",
+            frame_cache=frame_cache,
+        )
+
+    bash_files = omicron_bashes(
+        ifos= ifos,
+        start_time=seg_start,
+        end_time=seg_end,
+        project_dir= project_dir,
+        # INI
+        q_range= omi_paras["q_range"],
+        frequency_range= omi_paras["frequency_range"],
+        frame_type= frame_type,
+        channels= channels,
+        cluster_dt= omi_paras["cluster_dt"],
+        sample_rate= sample_rate,
+        chunk_duration= omi_paras["chunk_duration"],
+        segment_duration= omi_paras["segment_duration"],
+        overlap_duration= omi_paras["overlap_duration"],
+        mismatch_max= omi_paras["mismatch_max"],
+        snr_threshold= omi_paras["snr_threshold"],
+        omicron_command= omi_paras.get("omicron_command", "omicron-process"),
     )
 
+    return project_dir, bash_files
+
+
+def process_segment(
+    seg_num: int,
+    seg_start: int,
+    seg_end: int,
+    ifos: list[str],
+    channels: list[str],
+    frame_type: list[str],
+    sample_rate: int,
+    save_dir: Path,
+    stream_paras: Optional[dict] = None,
+    frame_cache: Optional[dict] = None,
+    decimate_rates: Optional[list] = None,
+):
+    """
+    Fetch and write the background of a single segment, with its
+    decimated copies at decimate_rates. Returns the name of the
+    written file.
+    """
+
+    seg_dur = seg_end-seg_start
+    file_name = f"background-{int(seg_start)}-{int(seg_dur)}.h5"
+
+    # Write to a temporary file first so an interrupted job
+    # never leaves a truncated background file behind.
+    tmp_file = save_dir / f"{file_name}.tmp"
+
+    if stream_paras is not None:
+
+        write_background_streamed(
+            output_file=tmp_file,
+            seg_start=seg_start,
+            seg_end=seg_end,
+            ifos=ifos,
+            channels=channels,
+            frame_type=frame_type,
+            sample_rate=sample_rate,
+            frame_cache=frame_cache,
+            **stream_paras
+        )
+
+    else:
+
+        strains = get_background(
+            seg_start=seg_start,
+            seg_end=seg_end,
+            ifos=ifos,
+            channels=channels,
+            frame_type=frame_type,
+            sample_rate=sample_rate,
+            frame_cache=frame_cache,
+        )
+
+        with h5py.File(tmp_file, "w") as g:
+
+            for ifo in ifos:
+                g.create_dataset(ifo, data=strains[ifo])
+
+    if decimate_rates:
+
+        write_decimated(
+            tmp_file,
+            ifos=ifos,
+            sample_rate=sample_rate,
+            rates=decimate_rates,
+            **(stream_paras or {})
+        )
+
+    tmp_file.replace(save_dir / file_name)
+
+    return file_name
+
 
 def gwak_background(
-    ifos: list[str], 
-    state_flag: list[str], 
-    channels: list[str], 
-    frame_type: list[str], 
+    ifos: list[str],
+    state_flag: list[str],
+    channels: list[str],
+    frame_type: list[str],
     ana_start: int,
-    ana_end: int, 
-    sample_rate: int, 
-    save_dir: Path, 
+    ana_end: int,
+    sample_rate: int,
+    save_dir: Path,
+    # Local DQSegDB cache, see segment_cache.SegmentCache
+    segment_cache: Optional[dict] = None,
+    # Split segments into overlapping shards of equal size
+    shard_paras: Optional[dict] = None,
+    # Process pool
+    max_workers: int = 1,
+    # Streaming writer, block-wise read for long segments
+    stream_paras: Optional[dict] = None,
+    # Local frame discovery index, see frame_cache.FrameCache
+    frame_cache: Optional[dict] = None,
     # Omicron process
     omi_paras: Optional[dict] = None,
+    # Built-in excess power search, an omicron alternative
+    ep_paras: Optional[dict] = None,
+    # Anti-aliased copies at lower rates, read by the training dataloaders
+    decimate_rates: Optional[list] = None,
     **kwargs
 ):
 
@@ -40,75 +188,187 @@ def gwak_background(
         ifos=ifos,
         start=ana_start,
         stop=ana_end,
-        state_flag=state_flag, 
+        state_flag=state_flag,
+        segment_cache=segment_cache,
     )
 
+    if shard_paras is not None:
+
+        n_segs = len(segs)
+        segs = plan_shards(segs, **shard_paras)
+        logging.info(f"Split {n_segs} segments into {len(segs)} shards")
+
+    # Discover the frames of the whole analysis range once per IFO,
+    # the workers then answer their segment queries from the cache.
+    if frame_cache is not None:
+
+        for ifo, frametype in zip(ifos, frame_type):
+
+            discover_frames(
+                site=ifo[0],
+                frametype=f"{ifo}_{frametype}",
+                gpsstart=ana_start,
+                gpsend=ana_end,
+                urltype="file",
+                frame_cache=frame_cache,
+            )
+
+    # Segments whose background file is listed in the manifest
+    # were completed by a previous run and are skipped.
+    manifest_file = save_dir / "manifest.json"
+    done = load_manifest(manifest_file)
 
+    todo, finished = [], []
     for seg_num, (seg_start, seg_end) in enumerate(segs):
 
-        strains = get_background(
-            seg_start=seg_start, 
-            seg_end=seg_end,
-            ifos=ifos, 
-            channels=channels, 
-            frame_type=frame_type, 
-            sample_rate=sample_rate,
+        file_name = f"background-{int(seg_start)}-{int(seg_end-seg_start)}.h5"
+        if file_name in done and (save_dir / file_name).exists():
+            finished.append(save_dir / file_name)
+            continue
+
+        todo.append((seg_num, seg_start, seg_end))
+
+    logging.info(
+        f"{len(segs) - len(todo)} of {len(segs)} segments already done, "
+        f"fetching {len(todo)} with {max_workers} worker(s)"
+    )
+
+    segment_kwargs = dict(
+        ifos=ifos,
+        channels=channels,
+        frame_type=frame_type,
+        sample_rate=sample_rate,
+        save_dir=save_dir,
+        stream_paras=stream_paras,
+        frame_cache=frame_cache,
+        decimate_rates=decimate_rates,
+    )
+
+    # Omicron jobs of a segment start as soon as its background is
+    # written, and its triggers are merged once all its jobs are done.
+    scheduler = None
+    if omi_paras is not None:
+
+        scheduler = OmicronScheduler(
+            max_jobs=omi_paras.get("max_jobs", 8),
+            timeout=omi_paras.get("timeout", None),
+            retries=omi_paras.get("retries", 2),
         )
 
-        seg_dur = seg_end-seg_start
-        file_name = f"background-{int(seg_start)}-{int(seg_dur)}.h5" 
+    def schedule_omicron(seg_num, seg_start, seg_end):
 
-        with h5py.File(save_dir / file_name, "w") as g:
+        if scheduler is None:
+            return
 
-            for ifo in ifos:
-                g.create_dataset(ifo, data=strains[ifo])
+        project_dir, bash_files = prepare_omicron(
+            seg_num,
+            seg_start,
+            seg_end,
+            ifos=ifos,
+            channels=channels,
+            frame_type=frame_type,
+            sample_rate=sample_rate,
+            omi_paras=omi_paras,
+            frame_cache=frame_cache,
+        )
 
+        if (project_dir / "glitch_info.h5").exists():
+            return
 
-        bash_files = [] # List of omicron commands to excute in background.  
-        if omi_paras is not None:
-            
-            for ifo, frametype in zip(ifos, frame_type):
-
-                create_lcs(
-                    ifo=ifo,
-                    frametype=f"{ifo}_{frametype}",
-                    start_time=seg_start,
-                    end_time=seg_end,
-                    output_dir= Path(omi_paras["out_dir"]) / f"Segs_{seg_num:05d}", 
-                    urltype="file"
-                )
-
-            bash_scripts = omicron_bashes(
-                ifos= ifos,
-                start_time=seg_start,
-                end_time=seg_end,
-                project_dir= Path(omi_paras["out_dir"]) / f"Segs_{seg_num:05d}",
-                # INI
-                q_range= omi_paras["q_range"],
-                frequency_range= omi_paras["frequency_range"],
-                frame_type= frame_type,
-                channels= channels,
-                cluster_dt= omi_paras["cluster_dt"],
-                sample_rate= sample_rate,
-                chunk_duration= omi_paras["chunk_duration"],
-                segment_duration= omi_paras["segment_duration"],
-                overlap_duration= omi_paras["overlap_duration"],
-                mismatch_max= omi_paras["mismatch_max"],
-                snr_threshold= omi_paras["snr_threshold"],
+        scheduler.submit(
+            project_dir.name,
+            bash_files,
+            merge=partial(
+                glitch_merger,
+                ifos=ifos,
+                omicron_path=project_dir,
+                channels=channels
             )
+        )
 
-            for bash_script in bash_scripts:
-                bash_files.append(bash_script)
+    # Files of a previous run only get their missing copies
+    decimate = []
+    if decimate_rates:
 
+        decimate = [
+            partial(
+                write_decimated,
+                file_name,
+                ifos=ifos,
+                sample_rate=sample_rate,
+                rates=decimate_rates,
+                **(stream_paras or {})
+            )
+            for file_name in finished
+        ]
 
-            # with ThreadPoolExecutor(max_workers=8) as e: # 8 workers
-            
-            #     for bash_file in bash_files:
-            #         e.submit(run_bash, bash_file)
+    # Segments finished by a previous run may still miss their triggers
+    todo_nums = {seg_num for seg_num, _, _ in todo}
+    for seg_num, (seg_start, seg_end) in enumerate(segs):
 
-            #     # Generate a glitch_info.h5 file that stores omicron informations 
-            #     glitch_merger = glitch_merger(
-            #         ifos=ifos,
-            #         omicron_path=omi_paras["out_dir"],
-            #         channels=channels
-            #     )
\ No newline at end of file
+        if seg_num not in todo_nums:
+            schedule_omicron(seg_num, seg_start, seg_end)
+
+    if max_workers <= 1:
+
+        for job in decimate:
+            job()
+
+        for seg_num, seg_start, seg_end in todo:
+
+            done.add(process_segment(seg_num, seg_start, seg_end, **segment_kwargs))
+            update_manifest(manifest_file, done)
+            schedule_omicron(seg_num, seg_start, seg_end)
+
+    else:
+
+        with ProcessPoolExecutor(max_workers=max_workers) as e:
+
+            copies = {e.submit(job): job.args[0] for job in decimate}
+            futures = {
+                e.submit(process_segment, seg_num, seg_start, seg_end, **segment_kwargs): 
+                (seg_num, seg_start, seg_end)
+                for seg_num, seg_start, seg_end in todo
+            }
+
+            for future in as_completed(copies):
+
+                if future.exception() is not None:
+                    logging.error(f"Decimating {copies[future]} failed: {future.exception()}")
+
+            # The manifest is only written from the parent process.
+            for future in as_completed(futures):
+
+                try:
+                    done.add(future.result())
+                except Exception:
+                    logging.exception(f"Segment {futures[future][0]} failed")
+                    continue
+
+                update_manifest(manifest_file, done)
+                schedule_omicron(*futures[future])
+
+    if scheduler is not None:
+
+        failed = scheduler.wait()
+        if failed:
+            logging.error(f"Omicron failed for {len(failed)} segment(s): {sorted(failed)}")
+
+        # One catalog of all segments for the glitch dataloader
+        catalogs = {
+            omicron_dir(omi_paras, seg_num) / "glitch_info.h5": span
+            for seg_num, span in enumerate(owned_spans(segs))
+            if (omicron_dir(omi_paras, seg_num) / "glitch_info.h5").exists()
+        }
+        output_file = Path(omi_paras["out_dir"]) / "glitch_info.h5"
+        combine_catalogs(catalogs, output_file, ifos)
+        logging.info(f"Combined the triggers of {len(catalogs)} segment(s) into {output_file}")
+
+    if ep_paras is not None:
+
+        excess_power(
+            save_dir=save_dir,
+            ifos=ifos,
+            sample_rate=sample_rate,
+            **ep_paras
+        )
@@ -1,45 +1,81 @@
 import h5py
+import json
+import math
+import shutil
 import logging
 import configparser
 
 import numpy as np
 
+from typing import Optional
 from pathlib import Path
+from contextlib import contextmanager
+from multiprocessing import get_context
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from gwdatafind import find_urls
 from gwpy.timeseries import TimeSeries
 from gwpy.segments import DataQualityDict
 
-
-
-glitch_keys = [
-    'time', 
-    'frequency', 
-    'tstart', 
-    'tend', 
-    'fstart', 
-    'fend', 
-    'snr', 
-    'q', 
-    'amplitude', 
-    'phase'
-]
+from frame_cache import open_frame_cache, frame_span
+from segment_cache import SegmentCache
+from glitch_catalog import glitch_keys
 
 
 ########################
 ### File level utils ###
 ########################
 
+def discover_frames(
+    site: str,
+    frametype: str,
+    gpsstart: int,
+    gpsend: int,
+    urltype: str="file",
+    frame_cache: Optional[dict]=None
+):
+    """
+    Query datafind, or the local FrameCache described by the 
+    frame_cache parameters if it is given. 
+    """
+
+    if frame_cache is not None:
+        return open_frame_cache(**frame_cache).find_urls(
+            site=site,
+            frametype=frametype,
+            gpsstart=gpsstart,
+            gpsend=gpsend,
+            urltype=urltype,
+        )
+
+    return find_urls(
+        site=site,
+        frametype=frametype,
+        gpsstart=gpsstart,
+        gpsend=gpsend,
+        urltype=urltype,
+    )
+
+
 def get_conincident_segs(
     ifos:list,
     start:int,
     stop:int,
     state_flag:list,
+    segment_cache:Optional[dict]=None
 ):
 
     query_flag = []
     for i, ifo in enumerate(ifos):
         query_flag.append(f"{ifo}:{state_flag[i]}")
 
+    # Only the GPS spans missing from the cache are queried, 
+    # see segment_cache.SegmentCache
+    if segment_cache is not None:
+
+        segs = SegmentCache(**segment_cache).coincident(query_flag, start, stop)
+
+        return [(seg_start, seg_end) for seg_start, seg_end in segs.tolist()]
+
     flags = DataQualityDict.query_dqsegdb(
         query_flag,
         start,
@@ -55,6 +91,87 @@ def get_conincident_segs(
     return segs
 
 
+def plan_shards(
+    segs: list,
+    shard_duration: int,
+    psd_length: float,
+    fduration: float,
+    kernel_length: float,
+):
+    """
+    Split coincident segments into shards of at most shard_duration 
+    seconds within the segment. Consecutive shards of a segment overlap
+    by at least psd_length + fduration + kernel_length, so every training
+    window of the segment is fully contained in one shard. Segments shorter 
+    than a single window are dropped. The shards are returned longest 
+    first, so a process pool fed in that order stays balanced. 
+    """
+
+    overlap = psd_length + fduration + kernel_length
+    if shard_duration < overlap + 1:
+        raise ValueError(
+            f"shard_duration {shard_duration} must exceed the "
+            f"overlap of {overlap} seconds by at least one second"
+        )
+
+    shards = []
+    for seg_start, seg_end in segs:
+
+        seg_dur = seg_end - seg_start
+        if seg_dur < overlap:
+            continue
+
+        if seg_dur <= shard_duration:
+            shards.append((seg_start, seg_end))
+            continue
+
+        # Equal length shards of whole seconds. The starts are rounded
+        # down to integer GPS times, so consecutive starts are at most
+        # step apart and the overlap holds.
+        n_shards = math.ceil((seg_dur - overlap) / (shard_duration - overlap))
+        length = max(math.ceil((seg_dur - overlap) / n_shards + overlap), math.ceil(overlap + 1))
+        step = math.floor(length - overlap)
+        n_shards = math.ceil((seg_dur - length) / step) + 1
+        stride = (seg_dur - length) / (n_shards - 1)
+
+        for k in range(n_shards):
+
+            start = seg_start + math.floor(k * stride)
+            shards.append((start, min(start + length, seg_end)))
+
+    return sorted(shards, key=lambda shard: shard[1] - shard[0], reverse=True)
+
+
+def read_ifo_strain(
+    ifo: str,
+    seg_start: int,
+    seg_end: int,
+    frame_type: str,
+    channel: str,
+    sample_rate: int,
+    verbose: bool=True,
+    frame_cache: Optional[dict]=None
+):
+
+    files = discover_frames(
+        site=f"{ifo[0]}",
+        frametype=f"{ifo}_{frame_type}",
+        gpsstart=seg_start,
+        gpsend=seg_end,
+        urltype="file",
+        frame_cache=frame_cache,
+    )
+
+    return TimeSeries.read(
+        files, 
+        f"{ifo}:{channel}", 
+        start=seg_start, 
+        end=seg_end, 
+        nproc=8, 
+        verbose=verbose
+    ).resample(sample_rate).value
+
+
 def get_background(
     seg_start: int,
     seg_end: int, 
@@ -62,41 +179,69 @@ def get_background(
     frame_type:list,
     channels:list,
     sample_rate:int,
-    verbose:bool=True
+    verbose:bool=True,
+    frame_cache:Optional[dict]=None
 ): 
+    """
+    Read the strain of every IFO for one segment. The IFOs are
+    read concurrently, one thread each. 
+    """
     
-    strains = {}
     logging.info(f"Collecting strain data from {seg_start} to {seg_end} at {channels}")
-    for num, ifo in enumerate(ifos):
-    
-        files = find_urls(
-            site=f"{ifo[0]}",
-            frametype=f"{ifo}_{frame_type[num]}",
-            gpsstart=seg_start,
-            gpsend=seg_end,
-            urltype="file",
-        )
-        
-        strains[ifo] = TimeSeries.read(
-            files, 
-            f"{ifo}:{channels[num]}", 
-            start=seg_start, 
-            end=seg_end, 
-            nproc=8, 
-            verbose=verbose
-        ).resample(sample_rate).value
-    
+    with ThreadPoolExecutor(max_workers=len(ifos)) as e:
+
+        futures = {
+            ifo: e.submit(
+                read_ifo_strain,
+                ifo=ifo,
+                seg_start=seg_start,
+                seg_end=seg_end,
+                frame_type=frame_type[num],
+                channel=channels[num],
+                sample_rate=sample_rate,
+                verbose=verbose,
+                frame_cache=frame_cache
+            ) for num, ifo in enumerate(ifos)
+        }
+
+        strains = {ifo: future.result() for ifo, future in futures.items()}
 
     return strains
 
 
+def load_manifest(manifest_file: Path):
+    """
+    Return the set of background file names that were already 
+    written by a previous run. 
+    """
+
+    if not manifest_file.exists():
+        return set()
+
+    with open(manifest_file, "r") as f:
+        return set(json.load(f))
+
+
+def update_manifest(manifest_file: Path, done: set):
+    """
+    Atomically rewrite the manifest of completed background files. 
+    """
+
+    tmp_file = manifest_file.with_suffix(".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(sorted(done), f, indent=1)
+
+    tmp_file.replace(manifest_file)
+
+
 def create_lcs(
     ifo: str,
     frametype: str,
     start_time,
     end_time,
     output_dir,
-    urltype="file"
+    urltype="file",
+    frame_cache: Optional[dict]=None
 ):
     """
     Create lcs file for omicron to fetch strain data (*.gwf file) 
@@ -106,68 +251,253 @@ def create_lcs(
     empty = ""
 
 
-    files = find_urls(
+    files = discover_frames(
         site=ifo[0],
         frametype=f"{frametype}",
         gpsstart=start_time,
         gpsend=end_time,
         urltype=urltype,
+        frame_cache=frame_cache,
     )
     # breakpoint()
     
     output_dir = output_dir / ifo
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    f = open(output_dir / "data_file.lcf", "a")
+    f = open(output_dir / "data_file.lcf", "w")
     for file in files:
         f.write(f"{file.replace(head, empty)}\n")
     f.close()
 
 
 
+@contextmanager
+def atomic_update(output_file: Path):
+    """
+    Yield a copy of output_file that replaces it once the block
+    finished, so an interrupted update leaves output_file untouched.
+    """
+
+    output_file = Path(output_file)
+    tmp_file = output_file.with_name(f"{output_file.name}.tmp")
+    if output_file.exists():
+        shutil.copyfile(output_file, tmp_file)
+    else:
+        tmp_file.unlink(missing_ok=True)
+
+    yield tmp_file
+
+    tmp_file.replace(output_file)
+
+
+def read_triggers(file: Path, glitch_keys=glitch_keys):
+
+    with h5py.File(file, "r") as h:
+
+        triggers = h["triggers"][:]
+
+    return {key: triggers[key] for key in glitch_keys}
+
+
+def append_sorted(group: h5py.Group, triggers: dict, glitch_keys=glitch_keys):
+    """
+    Append a batch of triggers to the resizable datasets of group, 
+    keeping them sorted by time. Triggers later than everything 
+    stored are simply appended, otherwise only the stored tail from 
+    the earliest new trigger onwards is read back and merged. 
+    """
+
+    order = np.argsort(triggers["time"], kind="stable")
+    triggers = {key: triggers[key][order] for key in glitch_keys}
+
+    n_stored = group["time"].shape[0]
+    idx = n_stored
+    if n_stored and group["time"][-1] > triggers["time"][0]:
+        idx = int(np.searchsorted(group["time"][:], triggers["time"][0], side="right"))
+
+    if idx < n_stored:
+
+        tail = {key: group[key][idx:] for key in glitch_keys}
+        order = np.argsort(
+            np.concatenate([tail["time"], triggers["time"]]), 
+            kind="stable"
+        )
+        triggers = {
+            key: np.concatenate([tail[key], triggers[key]])[order] 
+            for key in glitch_keys
+        }
+
+    for key in glitch_keys:
+
+        group[key].resize((idx + len(triggers[key]),))
+        group[key][idx:] = triggers[key]
+
+
+def trigger_group(
+    g: h5py.File, 
+    ifo: str, 
+    glitch_keys=glitch_keys, 
+    chunk_size: int = 2**16
+):
+    """
+    Get, or create, the group of resizable trigger datasets of ifo.
+    """
+
+    if ifo in g:
+        return g[ifo]
+
+    g1 = g.create_group(ifo)
+    for key in glitch_keys:
+        g1.create_dataset(
+            key, 
+            shape=(0,), 
+            maxshape=(None,), 
+            chunks=(chunk_size,), 
+            dtype=np.float64
+        )
+
+    # the index into sources of the file every trigger came from
+    g1.create_dataset(
+        "source", 
+        shape=(0,), 
+        maxshape=(None,), 
+        chunks=(chunk_size,), 
+        dtype=np.int64
+    )
+    g1.create_dataset(
+        "sources", 
+        shape=(0,), 
+        maxshape=(None,), 
+        dtype=h5py.string_dtype()
+    )
+
+    return g1
+
+
+def add_source(group: h5py.Group, source: str, triggers: dict, glitch_keys=glitch_keys):
+    """
+    Merge the triggers of one source file into group, every row
+    tagged with the index of source in the sources dataset.
+    """
+
+    n_sources = group["sources"].shape[0]
+    n_triggers = len(triggers["time"])
+    if n_triggers:
+        triggers = dict(triggers, source=np.full(n_triggers, n_sources))
+        append_sorted(group, triggers, glitch_keys=list(glitch_keys) + ["source"])
+
+    group["sources"].resize((n_sources + 1,))
+    group["sources"][n_sources] = source
+
+
+def merged_sources(group: h5py.Group):
+
+    return set(group["sources"].asstr()[:])
+
+
 def glitch_merger(
     ifos,
     omicron_path: Path,
     channels,
     output_file=None,
-    glitch_keys=glitch_keys
+    glitch_keys=glitch_keys,
+    max_workers: int = 4,
+    chunk_size: int = 2**16,
 ):
+    """
+    Stream the omicron trigger files of every IFO into chunked, 
+    time-sorted datasets. The trigger files are read in parallel, 
+    batch by batch, so memory is bounded by max_workers files. 
+    Every merged file is recorded and its triggers tagged with it, 
+    so rerunning on a directory with new omicron output only merges 
+    the new files. The reading processes are spawned, not forked, 
+    as this runs next to other threads using h5py.
+    """
 
-    
-    for i, ifo in enumerate(ifos):
+    if output_file is None:
+        output_file = omicron_path / "glitch_info.h5"
 
-        glitch_dir = \
-            omicron_path / f"{ifo}/trigger_output/merge/{ifo}:{channels[i]}"
+    with atomic_update(output_file) as tmp_file, \
+        h5py.File(tmp_file, "a") as g, \
+        ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("spawn")) as e:
 
-        h5_name = {}
-        for key in glitch_keys:
+        for i, ifo in enumerate(ifos):
 
-            h5_name[key] = []   
+            glitch_dir = \
+                omicron_path / f"{ifo}/trigger_output/merge/{ifo}:{channels[i]}"
 
-        for file in sorted(glitch_dir.glob("*.h5")):
+            g1 = trigger_group(g, ifo, glitch_keys=glitch_keys, chunk_size=chunk_size)
+            merged = merged_sources(g1)
+            files = [
+                file for file in sorted(glitch_dir.glob("*.h5"))
+                if file.name not in merged
+            ]
+            logging.info(f"{ifo}: merging {len(files)} new trigger file(s)")
 
-            with h5py.File(file, "r") as h:
-                
-                for key in glitch_keys:
-                    
-                    h5_name[key].append(h["triggers"][key])
-                    
-        for key in glitch_keys:
-            h5_name[key] = np.concatenate(h5_name[key])
-            
-        if output_file is None:
-            output_file = omicron_path / "glitch_info.h5"
+            for b in range(0, len(files), max_workers):
 
-        with h5py.File(output_file, "a") as g:
-            
-            g1 = g.create_group(ifo)
-            
-            for key in glitch_keys:
-                g1.create_dataset(key, data=h5_name[key])
+                batch = files[b:b+max_workers]
+                for file, triggers in zip(batch, e.map(read_triggers, batch)):
+
+                    add_source(g1, file.name, triggers, glitch_keys=glitch_keys)
 
     return output_file
 
 
+def owned_spans(segs: list):
+    """
+    The part of every segment whose triggers it keeps. Overlapping
+    segments split their overlap at its midpoint, so no trigger is
+    kept twice.
+    """
+
+    spans = [list(seg) for seg in segs]
+    order = sorted(range(len(segs)), key=lambda i: segs[i][0])
+    for i, j in zip(order[:-1], order[1:]):
+
+        if segs[j][0] < segs[i][1]:
+            middle = (segs[j][0] + segs[i][1]) / 2
+            spans[i][1] = min(spans[i][1], middle)
+            spans[j][0] = max(spans[j][0], middle)
+
+    return [tuple(span) for span in spans]
+
+
+def combine_catalogs(
+    catalogs: dict,
+    output_file: Path,
+    ifos: list,
+    glitch_keys=glitch_keys,
+):
+    """
+    Combine the glitch_info.h5 files of single segments, given as
+    {file: (start, end)}, into one catalog keeping the triggers of
+    every file inside its span. Files combined by a previous run,
+    recorded under the name of their directory, are skipped.
+    """
+
+    with atomic_update(output_file) as tmp_file, h5py.File(tmp_file, "a") as g:
+
+        for ifo in ifos:
+
+            group = trigger_group(g, ifo, glitch_keys=glitch_keys)
+            merged = merged_sources(group)
+
+            for catalog_file, (start, end) in catalogs.items():
+
+                source = Path(catalog_file).parent.name
+                if source in merged:
+                    continue
+
+                with h5py.File(catalog_file, "r") as h:
+                    time = h[ifo]["time"][:]
+                    keep = (time >= start) & (time < end)
+                    triggers = {key: h[ifo][key][:][keep] for key in glitch_keys}
+
+                add_source(group, source, triggers, glitch_keys=glitch_keys)
+
+    return output_file
+
 
 def omicron_bashes(
     ifos,
@@ -189,7 +519,8 @@ def omicron_bashes(
     # log_file: Path,
     verbose: bool = False,
     state_flag=None,
-    mode="GW"
+    mode="GW",
+    omicron_command="omicron-process"
 ):
     # Modified from BBHNet and CCSNet. 
 
@@ -236,7 +567,7 @@ def omicron_bashes(
             config.write(config_file)
             
         omicron_args = [
-            f"omicron-process {section}",
+            f"{omicron_command} {section}",
             f"--gps {start_time} {end_time}",
             f"--ifo {ifo}",
             f"--config-file {str(config_file_path)}",
@@ -292,3 +623,196 @@ class Pathfinder:
 #########################
 ### Strain data utils ###
 #########################
+
+def stream_ifo(
+    dataset: h5py.Dataset,
+    ifo: str,
+    seg_start: int,
+    seg_end: int,
+    frame_type: str,
+    channel: str,
+    sample_rate: int,
+    block_duration: int,
+    pad_duration: int,
+    dtype: str,
+    verbose: bool = False,
+    frame_cache: Optional[dict] = None
+):
+    """
+    Read, resample and append the strain of one IFO block by block
+    to dataset, see write_background_streamed.
+    """
+
+    files = discover_frames(
+        site=f"{ifo[0]}",
+        frametype=f"{ifo}_{frame_type}",
+        gpsstart=seg_start,
+        gpsend=seg_end,
+        urltype="file",
+        frame_cache=frame_cache,
+    )
+    spans = [frame_span(file) for file in files]
+
+    for block_start in range(int(seg_start), int(seg_end), block_duration):
+
+        block_end = min(block_start + block_duration, seg_end)
+        read_start = max(block_start - pad_duration, seg_start)
+        read_end = min(block_end + pad_duration, seg_end)
+
+        block_files = [
+            file for file, (t0, t1) in zip(files, spans)
+            if t0 < read_end and t1 > read_start
+        ]
+
+        block = TimeSeries.read(
+            block_files, 
+            f"{ifo}:{channel}", 
+            start=read_start, 
+            end=read_end, 
+            verbose=verbose
+        ).resample(sample_rate)
+        block = block.crop(block_start, block_end).value
+
+        idx = dataset.shape[0]
+        dataset.resize((idx + len(block),))
+        dataset[idx:] = block.astype(dtype)
+
+        logging.info(f"{ifo}: wrote {block_start} to {block_end}")
+
+
+def write_background_streamed(
+    output_file: Path,
+    seg_start: int,
+    seg_end: int, 
+    ifos: list,
+    frame_type: list,
+    channels: list,
+    sample_rate: int,
+    block_duration: int = 512,
+    pad_duration: int = 8,
+    dtype: str = "float64",
+    compression: Optional[str] = None,
+    verbose: bool = False,
+    frame_cache: Optional[dict] = None
+):
+    """
+    Read, resample and append the strain of a segment block by block 
+    into chunked HDF5 datasets. Each block is read with pad_duration
+    seconds of extra data on both sides that is cropped after 
+    resampling, so the block edges are free of filter transients. 
+    Peak memory scales with block_duration, not the segment length.
+    The IFOs are streamed concurrently, one thread each, like
+    get_background. 
+    """
+
+    block_size = int(block_duration * sample_rate)
+    with h5py.File(output_file, "w") as g:
+
+        datasets = {
+            ifo: g.create_dataset(
+                ifo,
+                shape=(0,),
+                maxshape=(None,),
+                chunks=(min(block_size, 2**18),),
+                dtype=dtype,
+                compression=compression,
+            ) for ifo in ifos
+        }
+
+        with ThreadPoolExecutor(max_workers=len(ifos)) as e:
+
+            futures = [
+                e.submit(
+                    stream_ifo,
+                    datasets[ifo],
+                    ifo=ifo,
+                    seg_start=seg_start,
+                    seg_end=seg_end,
+                    frame_type=frame_type[num],
+                    channel=channels[num],
+                    sample_rate=sample_rate,
+                    block_duration=block_duration,
+                    pad_duration=pad_duration,
+                    dtype=dtype,
+                    verbose=verbose,
+                    frame_cache=frame_cache
+                ) for num, ifo in enumerate(ifos)
+            ]
+
+            for future in futures:
+                future.result()
+
+    return output_file
+
+
+def write_decimated(
+    file_name: Path,
+    ifos: list,
+    sample_rate: int,
+    rates: list,
+    block_duration: int = 512,
+    pad_duration: int = 8,
+    dtype: str = "float64",
+    compression: Optional[str] = None,
+    **kwargs
+):
+    """
+    Add anti-aliased copies of the strain in file_name at every rate
+    in rates as decimated/<rate>/<ifo>. The strain is resampled block
+    by block with pad_duration seconds of extra data on both sides
+    that is cropped after resampling. Copies already in the file are
+    kept, so this also completes files of a previous run in place.
+    """
+
+    with h5py.File(file_name, "a") as g:
+
+        g.attrs["sample_rate"] = sample_rate
+        for rate in rates:
+
+            if rate >= sample_rate or sample_rate % rate:
+                raise ValueError(f"Cannot decimate {sample_rate} Hz to {rate} Hz")
+
+            factor = sample_rate // rate
+            block_size = int(block_duration * sample_rate)
+            pad_size = int(pad_duration * rate) * factor
+            group = g.require_group(f"decimated/{rate}")
+
+            for ifo in ifos:
+
+                if ifo in group:
+                    continue
+
+                # written under a temporary name, complete copies are moved in place
+                tmp = f"{ifo}.tmp"
+                if tmp in group:
+                    del group[tmp]
+
+                strain = g[ifo]
+                size = len(strain)
+                dataset = group.create_dataset(
+                    tmp,
+                    shape=(size // factor,),
+                    chunks=(min(block_size // factor, 2**18),),
+                    dtype=dtype,
+                    compression=compression,
+                )
+
+                for block_start in range(0, size, block_size):
+
+                    block_end = min(block_start + block_size, size)
+                    read_start = max(block_start - pad_size, 0)
+                    read_end = min(block_end + pad_size, size)
+
+                    block = TimeSeries(
+                        strain[read_start:read_end],
+                        sample_rate=sample_rate
+                    ).resample(rate).value
+
+                    start, stop = block_start // factor, block_end // factor
+                    offset = (block_start - read_start) // factor
+                    dataset[start:stop] = block[offset:offset + stop - start].astype(dtype)
+
+                group.move(tmp, ifo)
+                logging.info(f"{ifo}: wrote the {rate} Hz copy of {file_name}")
+
+    return file_name
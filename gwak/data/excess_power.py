@@ -0,0 +1,313 @@
+import h5py
+import math
+import logging
+
+import numpy as np
+
+from typing import Optional
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from background_utils import trigger_group, add_source, merged_sources, owned_spans
+from glitch_catalog import glitch_keys
+
+
+def q_planes(q_range: list, mismatch_max: float):
+    """
+    Q values tiling q_range with at most mismatch_max energy loss,
+    following the omicron/gwpy tiling.
+    """
+
+    deltam = 2 * math.sqrt(mismatch_max / 3)
+    qcum = math.sqrt(2) * math.log(q_range[1] / q_range[0])
+    n_planes = max(math.ceil(qcum / deltam), 1)
+
+    return q_range[0] * (q_range[1] / q_range[0]) ** ((0.5 + np.arange(n_planes)) / n_planes)
+
+
+def q_frequencies(
+    q: float,
+    frequency_range: list,
+    mismatch_max: float,
+    sample_rate: int,
+    duration: float
+):
+
+    deltam = 2 * math.sqrt(mismatch_max / 3)
+    fmin = max(frequency_range[0], 50 * q / (2 * math.pi * duration))
+    fmax = min(frequency_range[1], sample_rate / 2 / (1 + math.sqrt(11) / q))
+    if fmax <= fmin:
+        return np.empty(0)
+
+    fcum = math.sqrt(2 + q**2) / 2 * math.log(fmax / fmin)
+    n_rows = max(math.ceil(fcum / deltam), 1)
+
+    return fmin * (fmax / fmin) ** ((0.5 + np.arange(n_rows)) / n_rows)
+
+
+def whiten(block: np.ndarray, sample_rate: int, fftlength: float):
+    """
+    Whitened rfft of block and its one-sided PSD. The PSD is a median
+    average over half-overlapping Hann windowed fftlength segments.
+    """
+
+    nperseg = int(fftlength * sample_rate)
+    window = np.hanning(nperseg)
+    segs = np.lib.stride_tricks.sliding_window_view(block, nperseg)[::nperseg // 2]
+
+    psd = np.median(np.abs(np.fft.rfft(segs * window, axis=-1))**2, axis=0)
+    psd *= 2 / (sample_rate * (window**2).sum()) / np.log(2)
+
+    # tukey taper to suppress the circular wrap of the block edges
+    n = len(block)
+    taper = np.ones(n)
+    n_edge = min(nperseg // 2, n // 2)
+    taper[:n_edge] = 0.5 * (1 - np.cos(np.pi * np.arange(n_edge) / n_edge))
+    taper[n - n_edge:] = taper[:n_edge][::-1]
+
+    freqs = np.fft.rfftfreq(n, 1 / sample_rate)
+    psd = np.interp(freqs, np.fft.rfftfreq(nperseg, 1 / sample_rate), psd)
+
+    spectrum = np.fft.rfft(block * taper)
+    white = np.zeros_like(spectrum)
+    white[1:] = spectrum[1:] / np.sqrt(psd[1:])
+
+    return white, psd
+
+
+def block_pixels(
+    white: np.ndarray,
+    psd: np.ndarray,
+    t0: float,
+    duration: float,
+    q_range: list,
+    frequency_range: list,
+    mismatch_max: float,
+    sample_rate: int,
+    snr_threshold: float,
+):
+    """
+    Q-transform a whitened block tile row by tile row and return the
+    pixels above snr_threshold as columns of a dict.
+    """
+
+    pixels = {key: [] for key in ("time", "frequency", "q", "snr", "phase", "dt", "df", "amplitude")}
+    energy_threshold = 1 + snr_threshold**2 / 2
+
+    for q in q_planes(q_range, mismatch_max):
+
+        qprime = q / math.sqrt(11)
+        for f in q_frequencies(q, frequency_range, mismatch_max, sample_rate, duration):
+
+            # bisquare window around f, shifted to baseband
+            half = int(f / qprime * duration)
+            k = np.arange(-half, half + 1)
+            window = (1 - (k / duration * qprime / f)**2)**2
+            window *= math.sqrt(315 * qprime / (128 * f))
+
+            m = 2 ** math.ceil(math.log2(len(k)))
+            padded = np.zeros(m, dtype=complex)
+            padded[k % m] = white[int(round(f * duration)) + k] * window
+            tile = np.fft.ifft(padded) * m
+
+            energy = np.abs(tile)**2
+            energy /= np.median(energy) / np.log(2)
+
+            hot = np.flatnonzero(energy >= energy_threshold)
+            if len(hot) == 0:
+                continue
+
+            snr = np.sqrt(2 * (energy[hot] - 1))
+            pixels["time"].append(t0 + hot * duration / m)
+            pixels["frequency"].append(np.full(len(hot), f))
+            pixels["q"].append(np.full(len(hot), q))
+            pixels["snr"].append(snr)
+            pixels["phase"].append(np.angle(tile[hot]))
+            pixels["dt"].append(np.full(len(hot), duration / m))
+            pixels["df"].append(np.full(len(hot), 2 * f / qprime))
+            pixels["amplitude"].append(snr * np.sqrt(psd[int(round(f * duration))]))
+
+    return {
+        key: np.concatenate(value) if value else np.empty(0)
+        for key, value in pixels.items()
+    }
+
+
+def cluster_pixels(pixels: dict, cluster_dt: float):
+    """
+    Cluster time sorted pixels separated by less than cluster_dt and
+    keep the loudest pixel of each cluster with the cluster extent.
+    """
+
+    if len(pixels["time"]) == 0:
+        return {key: np.empty(0) for key in glitch_keys}
+
+    order = np.argsort(pixels["time"], kind="stable")
+    pixels = {key: value[order] for key, value in pixels.items()}
+
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = np.diff(pixels["time"]) > cluster_dt
+    cluster = np.cumsum(new) - 1
+    idx = np.flatnonzero(new)
+
+    # loudest pixel per cluster: last entry of each cluster after
+    # sorting by (cluster, snr)
+    by_snr = np.lexsort((pixels["snr"], cluster))
+    last = np.concatenate([idx[1:], [len(order)]]) - 1
+    peak = by_snr[last]
+
+    return dict(
+        time=pixels["time"][peak],
+        frequency=pixels["frequency"][peak],
+        tstart=np.minimum.reduceat(pixels["time"] - pixels["dt"] / 2, idx),
+        tend=np.maximum.reduceat(pixels["time"] + pixels["dt"] / 2, idx),
+        fstart=np.minimum.reduceat(pixels["frequency"] - pixels["df"] / 2, idx),
+        fend=np.maximum.reduceat(pixels["frequency"] + pixels["df"] / 2, idx),
+        snr=pixels["snr"][peak],
+        q=pixels["q"][peak],
+        amplitude=pixels["amplitude"][peak],
+        phase=pixels["phase"][peak],
+    )
+
+
+def find_file_triggers(
+    fname: Path,
+    ifos: list,
+    sample_rate: int,
+    q_range: list,
+    frequency_range: list,
+    cluster_dt: float,
+    segment_duration: float,
+    overlap_duration: float,
+    mismatch_max: float,
+    snr_threshold: float,
+    fftlength: float = 2,
+):
+    """
+    Excess power triggers of every IFO of one background file. The
+    file is processed in overlapping blocks of segment_duration, the
+    last one aligned to the end of the file, and only pixels outside
+    the overlap/2 edges of a block and past the previous block are kept.
+    """
+
+    # background-<gps start>-<duration>.h5
+    t_file = float(Path(fname).stem.split("-")[-2])
+    block_size = int(segment_duration * sample_rate)
+    edge = overlap_duration / 2
+
+    triggers = {}
+    with h5py.File(fname, "r") as h:
+
+        for ifo in ifos:
+
+            n = h[ifo].shape[0]
+            stride = block_size - int(overlap_duration * sample_rate)
+
+            starts = list(range(0, max(n - block_size, 0) + 1, stride))
+            if n > block_size and starts[-1] + block_size < n:
+                starts.append(n - block_size)
+
+            pixels = []
+            kept_until = -np.inf
+            for start in starts:
+
+                block = h[ifo][start:start + block_size].astype(np.float64)
+                if len(block) < block_size:
+                    break
+
+                t0 = t_file + start / sample_rate
+                white, psd = whiten(block, sample_rate, fftlength)
+                block_pix = block_pixels(
+                    white,
+                    psd,
+                    t0=t0,
+                    duration=segment_duration,
+                    q_range=q_range,
+                    frequency_range=frequency_range,
+                    mismatch_max=mismatch_max,
+                    sample_rate=sample_rate,
+                    snr_threshold=snr_threshold,
+                )
+
+                keep = (block_pix["time"] >= max(t0 + edge, kept_until)) \
+                    & (block_pix["time"] < t0 + segment_duration - edge)
+                kept_until = t0 + segment_duration - edge
+                pixels.append({key: value[keep] for key, value in block_pix.items()})
+
+            if pixels:
+                pixels = {key: np.concatenate([p[key] for p in pixels]) for key in pixels[0]}
+                triggers[ifo] = cluster_pixels(pixels, cluster_dt)
+            else:
+                triggers[ifo] = {key: np.empty(0) for key in glitch_keys}
+
+    return triggers
+
+
+def excess_power(
+    save_dir: Path,
+    ifos: list,
+    sample_rate: int,
+    output_file: Optional[Path] = None,
+    max_workers: int = 4,
+    **ep_paras
+):
+    """
+    Run find_file_triggers over the background files of save_dir in a
+    process pool and merge the triggers into the glitch_info.h5
+    schema of glitch_merger. Files already merged are skipped.
+    Overlapping files, e.g. shards, only keep the triggers of their
+    owned_spans, like combine_catalogs on the omicron path.
+
+    The catalog goes to save_dir/glitch_info.h5 by default, while
+    GlitchDataloader reads the omicron catalog by default, point its
+    glitch_file at output_file to train on these triggers.
+    """
+
+    save_dir = Path(save_dir)
+    if output_file is None:
+        output_file = save_dir / "glitch_info.h5"
+
+    with h5py.File(output_file, "a") as g:
+
+        groups = {ifo: trigger_group(g, ifo) for ifo in ifos}
+        merged = set.intersection(*[merged_sources(group) for group in groups.values()])
+
+        # background-<gps start>-<duration>.h5
+        fnames = sorted(save_dir.glob("background-*.h5"))
+        segs = []
+        for fname in fnames:
+            start, duration = map(int, fname.stem.split("-")[-2:])
+            segs.append((start, start + duration))
+        spans = dict(zip(fnames, owned_spans(segs)))
+
+        fnames = [fname for fname in fnames if fname.name not in merged]
+        logging.info(f"Searching {len(fnames)} background file(s) for excess power")
+
+        with ProcessPoolExecutor(max_workers=max_workers) as e:
+
+            futures = {
+                e.submit(find_file_triggers, fname, ifos, sample_rate, **ep_paras): fname
+                for fname in fnames
+            }
+
+            # Only the parent process writes to the output file
+            for future in as_completed(futures):
+
+                fname = futures[future]
+                try:
+                    triggers = future.result()
+                except Exception:
+                    logging.exception(f"Excess power search of {fname} failed")
+                    continue
+
+                start, end = spans[fname]
+                for ifo in ifos:
+
+                    keep = (triggers[ifo]["time"] >= start) & (triggers[ifo]["time"] < end)
+                    triggers[ifo] = {key: value[keep] for key, value in triggers[ifo].items()}
+                    if fname.name not in merged_sources(groups[ifo]):
+                        add_source(groups[ifo], fname.name, triggers[ifo])
+
+                logging.info(f"{fname.name}: {[len(triggers[ifo]['time']) for ifo in ifos]} triggers")
+
+    return output_file
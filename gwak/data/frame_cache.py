@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import logging
+import tempfile
+
+from typing import Optional
+from pathlib import Path
+from functools import lru_cache
+
+
+def frame_span(url: str):
+    """
+    Parse the GPS span of a frame file following the
+    LIGO naming convention <obs>-<type>-<gps>-<dur>.gwf
+    """
+
+    gps, dur = Path(url).stem.split("-")[-2:]
+
+    return int(gps), int(gps) + int(dur)
+
+
+def overlapping(urls: list, start: float, end: float):
+
+    keep = []
+    for url in urls:
+
+        t0, t1 = frame_span(url)
+        if t0 < end and t1 > start:
+            keep.append(url)
+
+    return keep
+
+
+class FrameCache:
+    """
+    Local frame discovery index with the same call signature as
+    gwdatafind.find_urls. Every query is stored per site/frametype
+    with the GPS span it covers, so any later query inside a known
+    span is answered by interval lookup without contacting datafind.
+
+    If frame_dir is given, frames are discovered by globbing that
+    directory instead of querying datafind, so the data stage can
+    run fully offline.
+
+    The cache file is read once, other processes sharing it are only
+    looked up again on a miss, when the file changed on disk.
+    """
+
+    def __init__(
+        self,
+        cache_file: Path,
+        frame_dir: Optional[Path] = None,
+        max_entries: int = 256,
+    ):
+
+        self.cache_file = Path(cache_file)
+        self.frame_dir = Path(frame_dir) if frame_dir is not None else None
+        self.max_entries = max_entries
+
+        self.mtime = None
+        self.entries = self.load()
+
+    def load(self):
+
+        if not self.cache_file.exists():
+            return {}
+
+        self.mtime = self.cache_file.stat().st_mtime_ns
+        with open(self.cache_file, "r") as f:
+            return json.load(f)
+
+    def refresh(self):
+        """
+        Reload the cache file if another process wrote it since.
+        """
+
+        if not self.cache_file.exists():
+            return False
+
+        if self.cache_file.stat().st_mtime_ns == self.mtime:
+            return False
+
+        self.entries = self.load()
+
+        return True
+
+    def save(self):
+
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+        # every worker may save, each one to a file of its own
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.cache_file.parent, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(self.entries, f)
+
+        os.replace(f.name, self.cache_file)
+        self.mtime = self.cache_file.stat().st_mtime_ns
+
+    def lookup(self, key: str, start: float, end: float):
+
+        for entry in self.entries.get(key, []):
+
+            if entry["start"] <= start and entry["end"] >= end:
+
+                entry["last_used"] = time.time()
+                return overlapping(entry["urls"], start, end)
+
+        return None
+
+    def insert(self, key: str, start: float, end: float, urls: list):
+
+        # keep the entries other processes saved meanwhile
+        self.refresh()
+
+        # Merge every entry that overlaps or touches the new span,
+        # so neighbouring queries collapse into one interval.
+        keep = []
+        for entry in self.entries.get(key, []):
+
+            if entry["start"] <= end and entry["end"] >= start:
+                start = min(start, entry["start"])
+                end = max(end, entry["end"])
+                urls = urls + entry["urls"]
+            else:
+                keep.append(entry)
+
+        keep.append(
+            dict(
+                start=start,
+                end=end,
+                urls=sorted(set(urls), key=frame_span),
+                last_used=time.time()
+            )
+        )
+        self.entries[key] = keep
+
+        self.evict()
+        self.save()
+
+    def evict(self):
+
+        entries = [
+            (entry["last_used"], key, i)
+            for key, values in self.entries.items()
+            for i, entry in enumerate(values)
+        ]
+        n_drop = len(entries) - self.max_entries
+        if n_drop <= 0:
+            return
+
+        drop = {(key, i) for _, key, i in sorted(entries)[:n_drop]}
+        for key in list(self.entries.keys()):
+
+            self.entries[key] = [
+                entry for i, entry in enumerate(self.entries[key])
+                if (key, i) not in drop
+            ]
+            if not self.entries[key]:
+                del self.entries[key]
+
+    def discover(self, site: str, frametype: str, gpsstart: float, gpsend: float, urltype: str):
+
+        if self.frame_dir is None:
+
+            from gwdatafind import find_urls
+
+            return find_urls(
+                site=site,
+                frametype=frametype,
+                gpsstart=gpsstart,
+                gpsend=gpsend,
+                urltype=urltype,
+            )
+
+        files = self.frame_dir.rglob(f"{site}-{frametype}-*.gwf")
+        urls = [f"file://localhost{file.resolve()}" for file in files]
+
+        return sorted(overlapping(urls, gpsstart, gpsend), key=frame_span)
+
+    def find_urls(
+        self,
+        site: str,
+        frametype: str,
+        gpsstart: float,
+        gpsend: float,
+        urltype: str = "file"
+    ):
+
+        key = f"{site}/{frametype}/{urltype}"
+
+        urls = self.lookup(key, gpsstart, gpsend)
+        if urls is None and self.refresh():
+            urls = self.lookup(key, gpsstart, gpsend)
+
+        if urls is not None:
+            return urls
+
+        logging.info(f"Discovering {frametype} frames from {gpsstart} to {gpsend}")
+        urls = self.discover(site, frametype, gpsstart, gpsend, urltype)
+        self.insert(key, gpsstart, gpsend, urls)
+
+        return urls
+
+
+@lru_cache(maxsize=None)
+def open_frame_cache(
+    cache_file: Path,
+    frame_dir: Optional[Path] = None,
+    max_entries: int = 256,
+):
+    """
+    The FrameCache of these parameters, opened once per process.
+    """
+
+    return FrameCache(cache_file, frame_dir=frame_dir, max_entries=max_entries)
@@ -0,0 +1,198 @@
+import os
+import h5py
+import logging
+import tempfile
+
+import numpy as np
+
+from typing import Optional
+from pathlib import Path
+
+
+glitch_keys = [
+    'time',
+    'frequency',
+    'tstart',
+    'tend',
+    'fstart',
+    'fend',
+    'snr',
+    'q',
+    'amplitude',
+    'phase'
+]
+
+
+class GlitchCatalog:
+    """
+    Read only view of one IFO of the glitch_info.h5 file written by
+    glitch_merger, indexed by trigger time.
+
+    The columns are exported once to one .npy file per key in an
+    index directory next to the h5 file and memory-mapped from there,
+    so opening the catalog costs nothing and every worker shares the
+    page cache. The index is rebuilt when the h5 file is newer.
+    """
+
+    def __init__(
+        self,
+        glitch_file: Path,
+        ifo: str,
+        index_dir: Optional[Path] = None,
+        glitch_keys: list = glitch_keys,
+    ):
+
+        self.glitch_file = Path(glitch_file)
+        self.ifo = ifo
+        self.glitch_keys = glitch_keys
+
+        if index_dir is None:
+            index_dir = self.glitch_file.with_name(f"{self.glitch_file.stem}_index")
+        self.index_dir = Path(index_dir) / ifo
+
+        if self.stale():
+            self.build()
+
+        self.columns = {
+            key: np.load(self.index_dir / f"{key}.npy", mmap_mode="r")
+            for key in glitch_keys
+        }
+        # passing triggers and their times per set of cuts
+        self.selections = {}
+
+    def stale(self):
+
+        stamp = self.index_dir / "time.npy"
+        if not stamp.exists():
+            return True
+
+        return stamp.stat().st_mtime < self.glitch_file.stat().st_mtime
+
+    def build(self):
+
+        logging.info(f"Building the time index of {self.ifo} in {self.glitch_file}")
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+
+        with h5py.File(self.glitch_file, "r") as h:
+
+            time = h[self.ifo]["time"][:]
+            order = None
+            if np.any(np.diff(time) < 0):
+                order = np.argsort(time, kind="stable")
+
+            for key in self.glitch_keys:
+
+                column = h[self.ifo][key][:]
+                if order is not None:
+                    column = column[order]
+
+                # Write the time column last, it marks the index as complete
+                if key != "time":
+                    self.save(key, column)
+
+            self.save("time", time if order is None else time[order])
+
+    def save(self, key: str, column: np.ndarray):
+
+        # every worker may build the index, each column is written
+        # to a file of its own and renamed in place
+        with tempfile.NamedTemporaryFile(dir=self.index_dir, suffix=".npy", delete=False) as f:
+            np.save(f, column)
+        os.replace(f.name, self.index_dir / f"{key}.npy")
+
+    def __len__(self):
+        return len(self.columns["time"])
+
+    def __getitem__(self, key: str):
+        return self.columns[key]
+
+    def mask(
+        self,
+        snr_min: Optional[float] = None,
+        snr_max: Optional[float] = None,
+        fmin: Optional[float] = None,
+        fmax: Optional[float] = None,
+    ):
+        """
+        Boolean mask of the triggers passing the SNR and peak
+        frequency cuts, None if there are no cuts.
+        """
+
+        cuts = [
+            ("snr", snr_min, np.greater_equal),
+            ("snr", snr_max, np.less_equal),
+            ("frequency", fmin, np.greater_equal),
+            ("frequency", fmax, np.less_equal),
+        ]
+
+        mask = None
+        for key, value, op in cuts:
+
+            if value is None:
+                continue
+
+            cut = op(self.columns[key], value)
+            mask = cut if mask is None else mask & cut
+
+        return mask
+
+    def selection(self, **cuts):
+        """
+        Indices and times of the triggers passing the cuts, computed
+        once per set of cuts. None without cuts.
+        """
+
+        key = tuple(sorted(cuts.items()))
+        if key not in self.selections:
+
+            mask = self.mask(**cuts)
+            if mask is None:
+                self.selections[key] = None
+            else:
+                passing = np.flatnonzero(mask)
+                self.selections[key] = passing, np.asarray(self.columns["time"][passing])
+
+        return self.selections[key]
+
+    def query(self, t0: float, t1: float, **cuts):
+        """
+        Indices of the triggers with t0 <= time <= t1 passing the cuts.
+        """
+
+        idx, _ = self.batch_query(np.array([t0]), np.array([t1]), **cuts)
+
+        return idx
+
+    def batch_query(self, t0: np.ndarray, t1: np.ndarray, **cuts):
+        """
+        Vectorized range query for many windows [t0[i], t1[i]].
+
+        Returns the concatenated trigger indices of all windows and
+        the offsets into them, so the triggers of window i are
+        idx[offsets[i]:offsets[i+1]].
+        """
+
+        # the passing triggers are searched directly, still sorted
+        passing, time = None, self.columns["time"]
+        selection = self.selection(**cuts)
+        if selection is not None:
+            passing, time = selection
+
+        lo = np.searchsorted(time, t0, side="left")
+        hi = np.searchsorted(time, t1, side="right")
+        counts = np.maximum(hi - lo, 0)
+
+        starts = np.cumsum(counts) - counts
+        idx = np.arange(counts.sum()) - np.repeat(starts, counts) + np.repeat(lo, counts)
+        if passing is not None:
+            idx = passing[idx]
+
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        return idx, offsets
+
+    def count(self, t0: np.ndarray, t1: np.ndarray, **cuts):
+
+        _, offsets = self.batch_query(t0, t1, **cuts)
+
+        return np.diff(offsets)
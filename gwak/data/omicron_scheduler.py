@@ -0,0 +1,173 @@
+import os
+import time
+import signal
+import logging
+import threading
+import subprocess
+
+from typing import Callable, Optional
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_job(
+    bash_file: Path,
+    timeout: Optional[float] = None,
+    retries: int = 0,
+):
+    """
+    Run one omicron bash script, retrying it up to retries times
+    on a non zero exit code or a timeout. The script runs in its own
+    process group, which is killed as a whole on a timeout so no
+    omicron process outlives its attempt. The output of every
+    attempt goes to a log file next to the script. Returns the
+    wall time of the successful attempt.
+    """
+
+    bash_file = Path(bash_file)
+    log_file = bash_file.with_suffix(".log")
+
+    for attempt in range(retries + 1):
+
+        t0 = time.time()
+        with open(log_file, "a") as log:
+
+            process = subprocess.Popen(
+                ["bash", f"{bash_file}"],
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+
+            try:
+                returncode = process.wait(timeout=timeout)
+
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                returncode = None
+
+        if returncode == 0:
+            return time.time() - t0
+
+        if returncode is not None:
+            logging.warning(
+                f"{bash_file} exited with {returncode} "
+                f"(attempt {attempt + 1}/{retries + 1})"
+            )
+
+        else:
+            logging.warning(
+                f"{bash_file} timed out after {timeout}s "
+                f"(attempt {attempt + 1}/{retries + 1})"
+            )
+
+    raise RuntimeError(f"{bash_file} failed after {retries + 1} attempt(s), see {log_file}")
+
+
+class OmicronScheduler:
+    """
+    Run omicron bash scripts with bounded concurrency. Jobs are
+    grouped per segment and the merge callback of a segment is
+    called as soon as all of its jobs succeeded.
+    """
+
+    def __init__(
+        self,
+        max_jobs: int = 8,
+        timeout: Optional[float] = None,
+        retries: int = 2,
+    ):
+
+        self.timeout = timeout
+        self.retries = retries
+
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self.lock = threading.Lock()
+        self.futures = []
+
+        self.pending = {}
+        self.failed = set()
+        self.merges = {}
+        self.n_done = 0
+        self.n_total = 0
+        self.t_start = time.time()
+
+    def submit(
+        self,
+        segment: str,
+        bash_files: list,
+        merge: Optional[Callable] = None,
+    ):
+
+        with self.lock:
+            self.pending[segment] = len(bash_files)
+            self.merges[segment] = merge
+            self.n_total += len(bash_files)
+
+        for bash_file in bash_files:
+
+            future = self.executor.submit(
+                run_job,
+                bash_file,
+                timeout=self.timeout,
+                retries=self.retries
+            )
+            future.add_done_callback(
+                lambda f, segment=segment, bash_file=bash_file: self.job_done(segment, bash_file, f)
+            )
+            self.futures.append(future)
+
+    def job_done(self, segment: str, bash_file: Path, future):
+
+        with self.lock:
+
+            self.n_done += 1
+            self.pending[segment] -= 1
+            last_job = self.pending[segment] == 0
+
+            if future.exception() is not None:
+                self.failed.add(segment)
+                logging.error(future.exception())
+            else:
+                logging.info(f"{bash_file} finished in {future.result():.1f}s")
+
+            elapsed = time.time() - self.t_start
+            logging.info(f"Omicron jobs {self.n_done}/{self.n_total} done, {elapsed:.0f}s elapsed")
+
+            merge = self.merges.pop(segment) if last_job else None
+            failed = segment in self.failed
+
+        if not last_job:
+            return
+
+        if failed:
+            logging.error(f"Skipping merge of {segment}, some of its omicron jobs failed")
+            return
+
+        if merge is not None:
+
+            t0 = time.time()
+            try:
+                merge()
+            except Exception:
+                logging.exception(f"Merging the triggers of {segment} failed")
+                with self.lock:
+                    self.failed.add(segment)
+                return
+
+            logging.info(f"Merged triggers of {segment} in {time.time() - t0:.1f}s")
+
+    def wait(self):
+        """
+        Block until every submitted job and merge is done, no job
+        can be submitted afterwards. Returns the segments with at
+        least one failed job or merge.
+        """
+
+        for future in list(self.futures):
+            future.exception()
+
+        self.executor.shutdown(wait=True)
+
+        return self.failed
@@ -1,3 +1,4 @@
+import math
 import logging
 from collections import OrderedDict
 
@@ -9,7 +10,6 @@ import torch.nn.functional as F
 from torch.distributions.uniform import Uniform
 from tqdm import tqdm
 import lal
-from astropy import units as u
 from ml4gw.distributions import Cosine, Sine
 from ml4gw.waveforms.conversion import (
     bilby_spins_to_lalsim, 
@@ -23,8 +23,8 @@ class Constant:
         self.val = val
         self.tensor = tensor
 
-    def __repr__(self, cls):
-        return self.__name__
+    def __repr__(self):
+        return f"Constant({self.val})"
 
     def sample(self, batch_size):
 
@@ -34,22 +34,110 @@ class Constant:
         return self.val
 
 
+class CompiledPrior:
+    """
+    Sample a dict of distributions as one struct of tensors on one
+    device. Distributions of the same family are stacked and drawn
+    with a single random call from a seeded generator. Without a seed
+    the global torch generator is used, so seed_everything applies.
+    """
+
+    def __init__(self, distributions: dict, device=None, seed=None):
+
+        self.device = torch.device('cpu' if device is None else device)
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator(self.device)
+            self.generator.manual_seed(seed)
+
+        self.keys = list(distributions)
+        self.fixed = {}
+        self.other = {}
+
+        # Uniform: low + u * (high - low)
+        # Cosine and Sine: shift + asin(sin(low) + u * (sin(high) - sin(low)))
+        uniform, arcsin = [], []
+        for key, dist in distributions.items():
+
+            if isinstance(dist, Uniform):
+                uniform.append((key, dist.low, dist.high))
+            elif isinstance(dist, Cosine):
+                arcsin.append((key, dist.low, dist.high, 0))
+            elif isinstance(dist, Sine):
+                base = dist.base_dist
+                arcsin.append((key, base.low, base.high, torch.pi / 2))
+            elif isinstance(dist, Constant):
+                self.fixed[key] = dist
+            elif hasattr(dist, 'sample'):
+                self.other[key] = dist
+            else:
+                self.fixed[key] = Constant(dist, tensor=False)
+
+        as_tensor = lambda x: torch.as_tensor(x, dtype=torch.float32, device=self.device)
+
+        self.uniform_keys = [u[0] for u in uniform]
+        self.low = as_tensor([float(u[1]) for u in uniform])[:, None]
+        self.width = as_tensor([float(u[2] - u[1]) for u in uniform])[:, None]
+
+        self.arcsin_keys = [a[0] for a in arcsin]
+        self.sin_low = as_tensor([math.sin(a[1]) for a in arcsin])[:, None]
+        self.sin_width = as_tensor([math.sin(a[2]) - math.sin(a[1]) for a in arcsin])[:, None]
+        self.shift = as_tensor([a[3] for a in arcsin])[:, None]
+
+    def rand(self, n, batch_size):
+
+        return torch.rand((n, batch_size), generator=self.generator, device=self.device)
+
+    def sample(self, batch_size):
+
+        sampled = {}
+
+        if self.uniform_keys:
+            values = self.low + self.width * self.rand(len(self.uniform_keys), batch_size)
+            sampled.update(zip(self.uniform_keys, values))
+
+        if self.arcsin_keys:
+            u = self.rand(len(self.arcsin_keys), batch_size)
+            values = self.shift + torch.arcsin(self.sin_low + self.sin_width * u)
+            sampled.update(zip(self.arcsin_keys, values))
+
+        for key, constant in self.fixed.items():
+            if constant.tensor:
+                sampled[key] = torch.full((batch_size,), constant.val, device=self.device)
+            else:
+                sampled[key] = constant.val
+
+        for key, dist in self.other.items():
+            sampled[key] = dist.sample((batch_size,)).to(self.device)
+
+        return {key: sampled[key] for key in self.keys}
+
+
 class BasePrior:
 
     def __init__(self):
         self.params = OrderedDict()
         self.sampled_params = OrderedDict()
 
+    def distributions(self):
+        return self.params
+
+    def compile(self, device=None, seed=None):
+        """
+        Sample on device from a generator seeded with seed, see
+        CompiledPrior.
+        """
+
+        self.compiled = CompiledPrior(self.distributions(), device, seed)
+
+        return self
+
     def sample(self, batch_size):
 
-        self.sampled_params = OrderedDict()
-        
-        for k in self.params.keys():
+        if getattr(self, 'compiled', None) is None:
+            self.compile()
 
-            if type(self.params[k]) == Constant:
-                    self.sampled_params[k] = self.params[k].val
-            else:
-                self.sampled_params[k] = self.params[k].sample((batch_size,))
+        self.sampled_params = self.compiled.sample(batch_size)
 
         return self.sampled_params
 
@@ -221,23 +309,31 @@ class LAL_BBHPrior(BasePrior):
         # Uniform(0, 2*np.pi) # Reference phase. (TensorType) #(Bilby) Orbital phase
         self.bilby_priors['phiRef'] = Constant(0) 
 
-        self.sample_keys = self.priors.keys()
+        self.sample_keys = list(self.priors.keys())
         
+    def distributions(self):
+        return dict(self.priors, **self.bilby_priors)
+
+    def compile(self, device=None, seed=None):
+
+        super().compile(device, seed)
+        self.fs = self.sampled_params["fs"].to(self.compiled.device)
+
+        return self
+
     def sample(self, batch_size): # translator
-        
-        for key in self.priors.keys():
-            
-            self.sampled_params[key] = self.priors[key].sample((batch_size,))
 
-        for key in self.bilby_priors.keys():
-            
-            self.spin_params[key] = self.bilby_priors[key].sample((batch_size,)) 
-        
+        if getattr(self, 'compiled', None) is None:
+            self.compile()
+
+        sampled = self.compiled.sample(batch_size)
+        self.spin_params = {key: sampled.pop(key) for key in self.bilby_priors}
+
         mass_1, mass_2 = chirp_mass_and_mass_ratio_to_components(
-            self.sampled_params['chirp_mass'],
-            self.sampled_params['mass_ratio']
+            sampled['chirp_mass'],
+            sampled['mass_ratio']
         )
-        
+
         lal_spins = bilby_spins_to_lalsim(
             theta_jn=self.spin_params['theta_jn'], 
             phi_jl=self.spin_params['phi_jl'], 
@@ -251,12 +347,16 @@ class LAL_BBHPrior(BasePrior):
             f_ref=self.sampled_params['f_ref'][0], 
             phi_ref=self.spin_params['phiRef'], 
         )
-        
-        for i, key in enumerate(self.lal_keys):
 
-            self.sampled_params[key] = lal_spins[i]
-        
-        return self.sampled_params
+        # a new dict every call, the caller may keep or modify it
+        sampled_params = dict(
+            fs=self.fs,
+            f_ref=self.sampled_params['f_ref'],
+            **sampled,
+            **dict(zip(self.lal_keys, lal_spins))
+        )
+
+        return sampled_params
 
 
 class BBHPrior(BasePrior):
@@ -289,8 +389,7 @@ class BBHPrior(BasePrior):
 
     def sample(self, batch_size):
 
-        for k in self.params.keys():
-            self.sampled_params[k] = self.params[k].sample((batch_size,))
+        super().sample(batch_size)
 
         self.sampled_params['mass_2'] = self.sampled_params['chirp_mass'] * (1 + self.sampled_params['mass_ratio']) ** 0.2 / self.sampled_params['mass_ratio']**0.6
         self.sampled_params['mass_1'] = self.sampled_params['mass_ratio'] * self.sampled_params['mass_2']
@@ -307,7 +406,7 @@ class BBHPrior(BasePrior):
         # convert from Bilby convention to Lalsimulation
         self.sampled_params['incl'], self.sampled_params['s1x'], self.sampled_params['s1y'], \
         self.sampled_params['s1z'], self.sampled_params['s2x'], self.sampled_params['s2y'], \
-        self.sampled_params['s2z'] = transform_precessing_spins(
+        self.sampled_params['s2z'] = bilby_spins_to_lalsim(
             self.sampled_params['theta_jn'], self.sampled_params['phi_jl'],
             self.sampled_params['tilt_1'],
             self.sampled_params['tilt_2'], self.sampled_params['phi_12'],
@@ -316,25 +415,16 @@ class BBHPrior(BasePrior):
             self.sampled_params['reference_frequency'], self.sampled_params['phase']
             )
 
-        self.sampled_params['incl'] = torch.Tensor(self.sampled_params['incl'])
-        self.sampled_params['s1x'] = Constant(0).sample((batch_size,)) # torch.Tensor(self.sampled_params['s1x'])
-        self.sampled_params['s1y'] = Constant(0).sample((batch_size,)) # torch.Tensor(self.sampled_params['s1y'])
-        self.sampled_params['s1z'] = torch.Tensor(self.sampled_params['s1z'])
-        self.sampled_params['s2x'] = Constant(0).sample((batch_size,)) # torch.Tensor(self.sampled_params['s2x'])
-        self.sampled_params['s2y'] = Constant(0).sample((batch_size,)) # torch.Tensor(self.sampled_params['s2y'])
-        self.sampled_params['s2z'] = torch.Tensor(self.sampled_params['s2z'])
+        zeros = torch.zeros_like(self.sampled_params['s1z'])
+        self.sampled_params['s1x'] = zeros # self.sampled_params['s1x']
+        self.sampled_params['s1y'] = zeros # self.sampled_params['s1y']
+        self.sampled_params['s2x'] = zeros # self.sampled_params['s2x']
+        self.sampled_params['s2y'] = zeros # self.sampled_params['s2y']
 
         self.sampled_params['f_ref'] = self.sampled_params['reference_frequency']
         self.sampled_params['phiRef'] = self.sampled_params['phase']
 
-        self.sampled_params['dist_mpc'] = (self.sampled_params['dist_mpc'] * u.Mpc).to("m").value # ???
-
-        logger = logging.getLogger(__name__)
+        # Mpc to m
+        self.sampled_params['dist_mpc'] = self.sampled_params['dist_mpc'] * (1e6 * lal.PC_SI)
 
-        for k in self.sampled_params.keys():
-            if type(self.sampled_params[k])==float:
-                logger.info(f'The shape of {k} is {self.sampled_params[k]}')
-            else:
-                logger.info(f'The shape of {k} is {self.sampled_params[k].shape}')
-        
         return self.sampled_params
@@ -0,0 +1,157 @@
+import h5py
+import logging
+
+import numpy as np
+
+from typing import Optional
+from pathlib import Path
+
+
+def merge_intervals(segs: np.ndarray):
+    """
+    Sort and coalesce overlapping or touching intervals of
+    shape (N, 2) into disjoint intervals.
+    """
+
+    segs = np.asarray(segs, dtype=np.float64).reshape(-1, 2)
+    segs = segs[segs[:, 1] > segs[:, 0]]
+    if len(segs) == 0:
+        return segs
+
+    segs = segs[np.argsort(segs[:, 0], kind="stable")]
+    run_end = np.maximum.accumulate(segs[:, 1])
+
+    new = np.ones(len(segs), dtype=bool)
+    new[1:] = segs[1:, 0] > run_end[:-1]
+    idx = np.flatnonzero(new)
+
+    return np.stack(
+        [segs[idx, 0], np.maximum.reduceat(segs[:, 1], idx)],
+        axis=1
+    )
+
+
+def intersect_intervals(a: np.ndarray, b: np.ndarray):
+    """
+    Intersection of two sorted lists of disjoint intervals. Each
+    interval of a is paired with the range of intervals of b it can
+    overlap, found with searchsorted, so no python loop is needed.
+    """
+
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 2)
+    if len(a) == 0 or len(b) == 0:
+        return np.empty((0, 2))
+
+    lo = np.searchsorted(b[:, 1], a[:, 0], side="right")
+    hi = np.searchsorted(b[:, 0], a[:, 1], side="left")
+    counts = np.maximum(hi - lo, 0)
+
+    a_idx = np.repeat(np.arange(len(a)), counts)
+    b_idx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    b_idx += np.repeat(lo, counts)
+
+    starts = np.maximum(a[a_idx, 0], b[b_idx, 0])
+    ends = np.minimum(a[a_idx, 1], b[b_idx, 1])
+    keep = ends > starts
+
+    return np.stack([starts[keep], ends[keep]], axis=1)
+
+
+def complement_intervals(segs: np.ndarray, start: float, stop: float):
+    """
+    Sub-ranges of [start, stop) not covered by the disjoint sorted
+    intervals segs.
+    """
+
+    segs = intersect_intervals(segs, [[start, stop]])
+    edges = np.concatenate([[start], segs.ravel(), [stop]]).reshape(-1, 2)
+
+    return edges[edges[:, 1] > edges[:, 0]]
+
+
+class SegmentCache:
+    """
+    Persistent store of the active segments of data quality flags.
+    For every flag the cache remembers which GPS spans were already
+    queried ("known") next to their active segments, so only the
+    missing sub-ranges of a request are fetched from the backend.
+
+    The backend is DQSegDB unless segment_file is given, a text file
+    with one "<flag> <start> <end>" active segment per line.
+    """
+
+    def __init__(
+        self,
+        cache_file: Path,
+        segment_file: Optional[Path] = None,
+    ):
+
+        self.cache_file = Path(cache_file)
+        self.segment_file = Path(segment_file) if segment_file is not None else None
+
+    def read(self, flag: str):
+
+        if not self.cache_file.exists():
+            return np.empty((0, 2)), np.empty((0, 2))
+
+        with h5py.File(self.cache_file, "r") as h:
+
+            if flag not in h:
+                return np.empty((0, 2)), np.empty((0, 2))
+
+            return h[flag]["known"][:], h[flag]["active"][:]
+
+    def write(self, flag: str, known: np.ndarray, active: np.ndarray):
+
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with h5py.File(self.cache_file, "a") as h:
+
+            if flag in h:
+                del h[flag]
+
+            g = h.create_group(flag)
+            g.create_dataset("known", data=known)
+            g.create_dataset("active", data=active)
+
+    def fetch(self, flag: str, start: float, stop: float):
+
+        if self.segment_file is not None:
+
+            rows = np.loadtxt(self.segment_file, dtype=str, ndmin=2)
+            segs = rows[rows[:, 0] == flag, 1:].astype(np.float64)
+
+            return intersect_intervals(merge_intervals(segs), [[start, stop]])
+
+        from gwpy.segments import DataQualityFlag
+
+        active = DataQualityFlag.query_dqsegdb(flag, start, stop).active
+
+        return np.asarray([[seg[0], seg[1]] for seg in active], dtype=np.float64)
+
+    def query(self, flag: str, start: float, stop: float):
+        """
+        Active segments of flag within [start, stop).
+        """
+
+        known, active = self.read(flag)
+        missing = complement_intervals(known, start, stop)
+
+        if len(missing):
+
+            logging.info(f"Querying {flag} for {len(missing)} missing span(s)")
+            fetched = [self.fetch(flag, t0, t1) for t0, t1 in missing]
+
+            known = merge_intervals(np.concatenate([known, missing]))
+            active = merge_intervals(np.concatenate([active, *fetched]))
+            self.write(flag, known, active)
+
+        return intersect_intervals(active, [[start, stop]])
+
+    def coincident(self, flags: list, start: float, stop: float):
+
+        segs = self.query(flags[0], start, stop)
+        for flag in flags[1:]:
+            segs = intersect_intervals(segs, self.query(flag, start, stop))
+
+        return segs
@@ -0,0 +1,140 @@
+import json
+import shutil
+import hashlib
+import logging
+
+import h5py
+import numpy as np
+import torch
+
+from pathlib import Path
+
+
+def store_path(store_dir: Path, fnames: list):
+
+    # one store per file selection, so train and val get their own
+    names = "\n".join(sorted(str(Path(fname).resolve()) for fname in fnames))
+    return Path(store_dir) / hashlib.sha1(names.encode()).hexdigest()[:16]
+
+
+def file_stamps(fnames: list):
+
+    return [[str(fname), Path(fname).stat().st_mtime] for fname in fnames]
+
+
+def build_background_store(
+    store_dir: Path,
+    fnames: list,
+    channels: list,
+    chunk_size: int = 2**22,
+):
+    """
+    Load the channels of fnames once into one contiguous float32
+    array shaped (channels, samples) in data.npy, with the first
+    sample of every file in offsets.npy. Put store_dir on /dev/shm
+    for a shared memory store. A store of the same files and channels
+    is reused.
+    """
+
+    path = store_path(store_dir, fnames)
+    meta_file = path / "store.json"
+    stamps = file_stamps(fnames)
+    if meta_file.exists() and json.loads(meta_file.read_text()) == dict(channels=channels, files=stamps):
+        return path
+
+    logging.info(f"Loading {len(fnames)} background file(s) into {path}")
+    sizes = []
+    for fname in fnames:
+        with h5py.File(fname, "r") as f:
+            sizes.append(len(f[channels[0]]))
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+
+    tmp = path.with_name(f"{path.name}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    data = np.lib.format.open_memmap(
+        tmp / "data.npy", mode="w+", dtype=np.float32, shape=(len(channels), int(offsets[-1]))
+    )
+    for fname, offset, size in zip(fnames, offsets, sizes):
+        with h5py.File(fname, "r") as f:
+            for c, channel in enumerate(channels):
+                for i in range(0, size, chunk_size):
+                    data[c, offset + i:offset + min(i + chunk_size, size)] = f[channel][i:i + chunk_size]
+    data.flush()
+    del data
+
+    np.save(tmp / "offsets.npy", offsets)
+    (tmp / "store.json").write_text(json.dumps(dict(channels=channels, files=stamps)))
+
+    shutil.rmtree(path, ignore_errors=True)
+    tmp.rename(path)
+
+    return path
+
+
+class StoreTimeSeriesDataset(torch.utils.data.IterableDataset):
+    """
+    Hdf5TimeSeriesDataset with coincident=False over a store written
+    by build_background_store. The store is memory-mapped in every
+    worker, so all workers and ranks on a node share one copy in the
+    page cache and a batch is a single gather.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        kernel_size: int,
+        batch_size: int,
+        batches_per_epoch: int,
+    ):
+        super().__init__()
+        self.path = Path(path)
+        self.kernel_size = kernel_size
+        self.batch_size = batch_size
+        self.batches_per_epoch = batches_per_epoch
+
+        offsets = np.load(self.path / "offsets.npy")
+        self.starts = offsets[:-1]
+        self.sizes = np.diff(offsets)
+        self.probs = self.sizes / self.sizes.sum()
+        self.data = None
+
+    def __len__(self):
+        return self.batches_per_epoch
+
+    def __getstate__(self):
+
+        # workers map the store themselves instead of receiving a copy
+        state = self.__dict__.copy()
+        state["data"] = None
+
+        return state
+
+    def sample_batch(self, rng):
+
+        n_channels = self.data.shape[0]
+        file_idx = rng.choice(len(self.sizes), p=self.probs, size=(self.batch_size, n_channels))
+        idx = self.starts[file_idx] + rng.integers(self.sizes[file_idx] - self.kernel_size)
+
+        X = np.empty((self.batch_size, n_channels, self.kernel_size), dtype=np.float32)
+        for c in range(n_channels):
+            windows = np.lib.stride_tricks.sliding_window_view(self.data[c], self.kernel_size)
+            X[:, c] = windows[idx[:, c]]
+
+        return torch.from_numpy(X)
+
+    def __iter__(self):
+
+        if self.data is None:
+            self.data = np.load(self.path / "data.npy", mmap_mode="r")
+        # torch is seeded per worker and epoch, numpy is not
+        rng = np.random.default_rng(torch.randint(2**62, (1,)).item())
+
+        n_batches = self.batches_per_epoch
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            n_batches = len(range(worker_info.id, n_batches, worker_info.num_workers))
+
+        for _ in range(n_batches):
+            yield self.sample_batch(rng)
@@ -1,4 +1,5 @@
 import h5py
+import json
 import logging
 import argparse
 import numpy as np
@@ -10,11 +11,13 @@ import torch
 import torch.nn.functional as F
 import lightning.pytorch as pl
 from lightning.pytorch.loggers import WandbLogger
+from lightning.pytorch.utilities import move_data_to_device
 
 import ml4gw
 from ml4gw.dataloading import Hdf5TimeSeriesDataset
 from ml4gw.transforms import SpectralDensity, Whiten
-from ml4gw.gw import compute_observed_strain, get_ifo_geometry
+from ml4gw.gw import compute_observed_strain, compute_antenna_responses, get_ifo_geometry
+from ml4gw.constants import C
 from bilby.gw.conversion import bilby_to_lalsimulation_spins
 
 from torch.distributions.uniform import Uniform
@@ -23,6 +26,50 @@ from ml4gw.distributions import Cosine
 from gwak import data
 from abc import ABC
 
+from preprocessing import WhiteningStage, WhitenedCache, BatchTimer, build_psd_index
+from waveform_bank import WaveformBank, build_waveform_bank, signal_config, time_domain
+from recorder import BatchRecorder, recorder_file
+from background_store import StoreTimeSeriesDataset, build_background_store, store_path
+
+
+def stored_channels(fnames: list, ifos: list, sample_rate: int):
+    """
+    Datasets holding the strain of ifos at sample_rate, the decimated
+    copies written by gwak_background when the files have them and the
+    strain itself otherwise. Every file has to agree, a mix of files
+    with and without the copies raises a ValueError.
+    """
+
+    if not fnames:
+        return ifos
+
+    decimated = [f"decimated/{sample_rate}/{ifo}" for ifo in ifos]
+    missing, stored_rates = [], set()
+    for fname in fnames:
+
+        with h5py.File(fname, "r") as f:
+
+            if all(channel in f for channel in decimated):
+                continue
+
+            missing.append(fname)
+            stored_rates.add(f.attrs.get("sample_rate", sample_rate))
+
+    if not missing:
+        return decimated
+
+    if len(missing) < len(fnames):
+        raise ValueError(
+            f"{len(missing)} of {len(fnames)} files have no {sample_rate} Hz copy, "
+            f"e.g. {missing[0]}, rerun gwak_background with decimate_rates"
+        )
+
+    for stored_rate in stored_rates - {sample_rate}:
+        logging.warning(f"Reading {stored_rate} Hz strain as {sample_rate} Hz, no copy at {sample_rate} Hz in the files")
+
+    return ifos
+
+
 class GwakFileDataloader(pl.LightningDataModule):
 
     def __init__(
@@ -36,11 +83,15 @@ class GwakFileDataloader(pl.LightningDataModule):
         batch_size: int,
         batches_per_epoch: int,
         num_workers: int,
-        data_saving_file: Path = None
+        data_saving_file: Path = None,
+        record_every: int = 1
     ):
         super().__init__()
+        self.data_dir = data_dir
         self.train_fnames, self.val_fnames = self.train_val_split(data_dir)
         self.sample_rate = sample_rate
+        # read the stored copy at sample_rate if there is one
+        self.channels = stored_channels(self.train_fnames + self.val_fnames, ['H1', 'L1'], sample_rate)
         self.kernel_length = kernel_length
         self.psd_length = psd_length
         self.fduration = fduration
@@ -49,12 +100,12 @@ class GwakFileDataloader(pl.LightningDataModule):
         self.batches_per_epoch = batches_per_epoch
         self.num_workers = num_workers
         self.data_saving_file = data_saving_file
-        if self.data_saving_file is not None:
-
-            Path(self.data_saving_file.parents[0]).mkdir(parents=True, exist_ok=True)
-            self.data_group = h5py.File(self.data_saving_file, "w")
+        # record every record_every-th step to data_saving_file
+        self.record_every = record_every
+        self.recorder = None
 
         self._logger = self.get_logger()
+        self.timer = BatchTimer(self._logger.name)
 
     def train_val_split(self, data_dir, val_split=0.2):
 
@@ -68,7 +119,7 @@ class GwakFileDataloader(pl.LightningDataModule):
 
         dataset = Hdf5TimeSeriesDataset(
                 self.train_fnames,
-                channels=['H1', 'L1'],
+                channels=self.channels,
                 kernel_size=int((self.psd_length + self.fduration + self.kernel_length) * self.sample_rate),#int(self.sample_rate * self.sample_length),
                 batch_size=self.batch_size,
                 batches_per_epoch=self.batches_per_epoch,
@@ -86,7 +137,7 @@ class GwakFileDataloader(pl.LightningDataModule):
     def val_dataloader(self):
         dataset = Hdf5TimeSeriesDataset(
             self.val_fnames,
-            channels=['H1', 'L1'],
+            channels=self.channels,
             kernel_size=int((self.psd_length + self.fduration + self.kernel_length) * self.sample_rate), # int(self.hparams.sample_rate * self.sample_length),
             batch_size=self.batch_size,
             batches_per_epoch=self.batches_per_epoch,
@@ -107,38 +158,39 @@ class GwakFileDataloader(pl.LightningDataModule):
         logger.setLevel(logging.INFO)
         return logger
 
-    def whiten(self, batch):
+    @property
+    def device(self):
+
+        if self.trainer is None:
+            return torch.device('cpu')
 
-        # split batch into psd data and data to be whitened
-        split_size = int((self.kernel_length + self.fduration) * self.sample_rate)
-        splits = [batch.size(-1) - split_size, split_size]
-        psd_data, batch = torch.split(batch, splits, dim=-1)
+        return self.trainer.strategy.root_device
 
-        # psd estimator
-        # takes tensor of shape (batch_size, num_ifos, psd_length)
-        spectral_density = SpectralDensity(
+    def setup(self, stage=None):
+
+        # built once and kept on the trainer's device
+        self.preprocessor = WhiteningStage(
             self.sample_rate,
+            self.kernel_length,
+            self.fduration,
             self.fftlength,
-            average = 'median'
-        ).to('cuda')
+        ).to(self.device)
 
-        # calculate psds
-        psds = spectral_density(psd_data.double())
+        if self.data_saving_file is not None and self.recorder is None:
 
-        # create whitener
-        whitener = Whiten(
-            self.fduration,
-            self.sample_rate,
-            highpass = 30,
-        ).to('cuda')
+            rank = 0 if self.trainer is None else self.trainer.global_rank
+            file_name = recorder_file(self.data_saving_file, rank, stage)
+            self.recorder = BatchRecorder(file_name, every=self.record_every)
+
+    def teardown(self, stage=None):
 
-        whitened = whitener(batch.double(), psds.double())
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
-        # normalize the input data
-        stds = torch.std(whitened, dim=-1, keepdim=True)
-        whitened = whitened / stds
+    def whiten(self, batch):
 
-        return whitened
+        return self.preprocessor(batch)
 
     def on_after_batch_transfer(self, batch, dataloader_idx):
 
@@ -146,17 +198,11 @@ class GwakFileDataloader(pl.LightningDataModule):
             # unpack the batch
             [batch] = batch
             # inject waveforms; maybe also whiten data preprocess etc..
-            batch = self.whiten(batch)
-
-            if self.trainer.training and (self.data_saving_file is not None):
-
-                step_name = f"Training/Step_{self.trainer.global_step:06d}_BK"
-                self.data_group.create_dataset(step_name, data = batch.cpu())
-
-            if self.trainer.validating and (self.data_saving_file is not None):
+            with self.timer(batch.device):
+                batch = self.whiten(batch)
 
-                step_name = f"Validation/Step_{self.trainer.global_validation_step:06d}_BK"
-                self.data_group.create_dataset(step_name, data = batch.cpu())
+            if self.recorder is not None:
+                self.recorder.record_step(self.trainer, BK=batch)
 
             return batch
 
@@ -167,10 +213,338 @@ class GwakFileDataloader(pl.LightningDataModule):
         pass
 
 
+class GlitchTimeSeriesDataset(torch.utils.data.IterableDataset):
+    """
+    Iterable dataset of kernels centred on glitch triggers.
+
+    At construction the triggers of every IFO that fall inside a
+    background file, far enough from its edges for a fully jittered
+    kernel, are turned into an index of (file, sample position). With
+    a store written by build_background_store for fnames, a batch is
+    one gather from the memory-mapped store. Otherwise the kernels of
+    a batch are read from the files, which every worker opens itself,
+    one contiguous range per run of overlapping kernels of a file.
+    """
+
+    def __init__(
+        self,
+        fnames: list,
+        channels: list,
+        kernel_size: int,
+        center: int,
+        jitter: int,
+        batch_size: int,
+        batches_per_epoch: int,
+        catalogs: dict,
+        sample_rate: int,
+        cuts: Optional[dict] = None,
+        store: Optional[Path] = None,
+    ):
+        super().__init__()
+        self.channels = channels
+        self.kernel_size = kernel_size
+        self.jitter = jitter
+        self.batch_size = batch_size
+        self.batches_per_epoch = batches_per_epoch
+
+        cuts = cuts or {}
+        self.fnames, file_idx, positions, offsets = [], [], [], []
+        for n, fname in enumerate(fnames):
+
+            # background-<gps start>-<duration>.<ext>
+            t0 = float(Path(fname).stem.split("-")[-2])
+
+            with h5py.File(fname, "r") as h:
+                length = min(h[channel].shape[0] for channel in channels)
+
+                # the glitch sits at `center` samples into the kernel
+                # and the kernel may move by up to `jitter` samples
+                lo = center + jitter
+                hi = length - kernel_size + center - jitter
+                if hi <= lo:
+                    continue
+
+                pos = []
+                for catalog in catalogs.values():
+                    idx = catalog.query(t0 + lo / sample_rate, t0 + hi / sample_rate, **cuts)
+                    pos.append(np.round((catalog["time"][idx] - t0) * sample_rate))
+                pos = np.concatenate(pos).astype(np.int64)
+
+                if len(pos) == 0:
+                    continue
+
+            file_idx.append(np.full(len(pos), len(self.fnames)))
+            positions.append(pos - center)
+            offsets.append(n)
+            self.fnames.append(fname)
+
+        if not positions:
+            raise ValueError(f"No glitch passing {cuts} fits in {len(fnames)} file(s)")
+
+        self.file_idx = np.concatenate(file_idx)
+        self.positions = np.concatenate(positions)
+        self.files = None
+
+        # positions in the store, whose files follow the order of fnames
+        self.store = store
+        self.data = None
+        if store is not None:
+            starts = np.load(Path(store) / "offsets.npy")[offsets]
+            self.positions = self.positions + starts[self.file_idx]
+
+    def __len__(self):
+        return self.batches_per_epoch
+
+    def __getstate__(self):
+
+        # workers open the files themselves
+        state = self.__dict__.copy()
+        state["files"] = None
+        state["data"] = None
+
+        return state
+
+    def gather(self, starts):
+
+        if self.data is None:
+            self.data = np.load(Path(self.store) / "data.npy", mmap_mode="r")
+
+        X = np.empty((len(starts), len(self.channels), self.kernel_size), dtype=np.float32)
+        for c in range(len(self.channels)):
+            windows = np.lib.stride_tricks.sliding_window_view(self.data[c], self.kernel_size)
+            X[:, c] = windows[starts]
+
+        return X
+
+    def read(self, file_idx, starts):
+
+        if self.files is None:
+            self.files = [h5py.File(fname, "r") for fname in self.fnames]
+
+        X = np.empty((len(starts), len(self.channels), self.kernel_size), dtype=np.float32)
+
+        # sorted by file and start, overlapping kernels form one run
+        order = np.lexsort((starts, file_idx))
+        file_idx, starts = file_idx[order], starts[order]
+        new = np.ones(len(starts), dtype=bool)
+        new[1:] = (file_idx[1:] != file_idx[:-1]) | (starts[1:] >= starts[:-1] + self.kernel_size)
+        bounds = np.append(np.flatnonzero(new), len(starts))
+
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+
+            f = self.files[file_idx[lo]]
+            start, stop = starts[lo], starts[hi - 1] + self.kernel_size
+            block = np.stack([f[channel][start:stop] for channel in self.channels])
+
+            windows = np.lib.stride_tricks.sliding_window_view(block, self.kernel_size, axis=-1)
+            X[order[lo:hi]] = windows[:, starts[lo:hi] - start].swapaxes(0, 1)
+
+        return X
+
+    def sample_batch(self):
+
+        triggers = np.random.randint(len(self.positions), size=self.batch_size)
+        starts = self.positions[triggers] + np.random.randint(-self.jitter, self.jitter + 1, self.batch_size)
+
+        if self.store is not None:
+            return torch.from_numpy(self.gather(starts))
+
+        return torch.from_numpy(self.read(self.file_idx[triggers], starts))
+
+    def __iter__(self):
+
+        n_batches = self.batches_per_epoch
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            n_batches = len(range(worker_info.id, n_batches, worker_info.num_workers))
+
+        for _ in range(n_batches):
+            yield self.sample_batch()
+
+
 class GlitchDataloader(GwakFileDataloader):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        glitch_file: Optional[Path] = None,
+        snr_min: Optional[float] = None,
+        snr_max: Optional[float] = None,
+        fmin: Optional[float] = None,
+        fmax: Optional[float] = None,
+        jitter: float = 0.0,
+        background_store: Optional[Path] = None,
+        **kwargs
+    ):
         super().__init__(*args, **kwargs)
+        # the catalog gwak_background combines next to the background
+        self.glitch_file = glitch_file or Path(self.data_dir) / 'omicron' / 'glitch_info.h5'
+        self.cuts = dict(snr_min=snr_min, snr_max=snr_max, fmin=fmin, fmax=fmax)
+        self.jitter = jitter
+        # gather the kernels from a memory-mapped copy of the background
+        self.background_store = background_store
+
+    def prepare_data(self):
+
+        if self.background_store is not None:
+
+            for fnames in [self.train_fnames, self.val_fnames]:
+                build_background_store(self.background_store, fnames, channels=self.channels)
+
+    def glitch_dataset(self, fnames):
+
+        catalogs = {
+            ifo: data.GlitchCatalog(self.glitch_file, ifo)
+            for ifo in ['H1', 'L1']
+        }
+
+        # centre the glitch in the kernel that is whitened
+        center = self.psd_length + (self.fduration + self.kernel_length) / 2
+
+        return GlitchTimeSeriesDataset(
+            fnames,
+            channels=self.channels,
+            kernel_size=int((self.psd_length + self.fduration + self.kernel_length) * self.sample_rate),
+            center=int(center * self.sample_rate),
+            jitter=int(self.jitter * self.sample_rate),
+            batch_size=self.batch_size,
+            batches_per_epoch=self.batches_per_epoch,
+            catalogs=catalogs,
+            sample_rate=self.sample_rate,
+            cuts=self.cuts,
+            store=None if self.background_store is None else store_path(self.background_store, fnames),
+        )
+
+    def train_dataloader(self):
+
+        dataset = self.glitch_dataset(self.train_fnames)
+        dataloader = torch.utils.data.DataLoader(
+            dataset, num_workers=self.num_workers, pin_memory=False
+        )
+        return dataloader
+
+    def val_dataloader(self):
+
+        dataset = self.glitch_dataset(self.val_fnames)
+        dataloader = torch.utils.data.DataLoader(
+            dataset, num_workers=self.num_workers, pin_memory=False
+        )
+        return dataloader
+
+
+class PsdIndexedDataset(torch.utils.data.IterableDataset):
+    """
+    Iterable dataset of kernel_length + fduration windows paired with
+    the PSD of the psd_length preceding each window, interpolated from
+    the grid written by build_psd_index. Channels are sampled
+    independently, like Hdf5TimeSeriesDataset with coincident=False.
+    Windows start at least psd_length into their file, so their PSD
+    never overlaps them.
+    """
+
+    def __init__(
+        self,
+        fnames: list,
+        channels: list,
+        kernel_size: int,
+        batch_size: int,
+        batches_per_epoch: int,
+        psd_length: float,
+        sample_rate: int,
+    ):
+        super().__init__()
+        self.fnames = np.array(fnames)
+        self.channels = channels
+        self.kernel_size = kernel_size
+        self.batch_size = batch_size
+        self.batches_per_epoch = batches_per_epoch
+        self.psd_length = psd_length
+        self.sample_rate = sample_rate
+
+        self.sizes, self.n_grid = [], []
+        for fname in self.fnames:
+            with h5py.File(fname, "r") as f:
+                self.sizes.append(len(f[channels[0]]))
+                self.n_grid.append(f["psd"][channels[0]].shape[0])
+                self.stride = f["psd"].attrs["stride"]
+                self.n_freqs = f["psd"][channels[0]].shape[1]
+
+        # the first psd_length of a file only serves as PSD data
+        self.psd_size = int(psd_length * sample_rate)
+        starts = np.maximum(np.array(self.sizes) - self.psd_size - kernel_size, 0)
+        self.probs = starts / starts.sum()
+
+    def __len__(self):
+        return self.batches_per_epoch
+
+    def sample_batch(self):
+
+        X = np.zeros((self.batch_size, len(self.channels), self.kernel_size))
+        P = np.zeros((self.batch_size, len(self.channels), self.n_freqs))
+
+        file_idx = np.random.choice(
+            len(self.fnames),
+            p=self.probs,
+            size=(self.batch_size, len(self.channels))
+        )
+        for i in np.unique(file_idx):
+
+            batch_indices, channel_indices = np.where(file_idx == i)
+            idx = np.random.randint(self.psd_size, self.sizes[i] - self.kernel_size, size=len(batch_indices))
+
+            # fractional grid position of the psd_length preceding
+            # each window, linearly interpolated between grid points
+            grid = (idx / self.sample_rate - self.psd_length) / self.stride
+            grid = np.clip(grid, 0, self.n_grid[i] - 1)
+            lo = np.floor(grid).astype(int)
+            hi = np.minimum(lo + 1, self.n_grid[i] - 1)
+            w = (grid - lo)[:, None]
+
+            with h5py.File(self.fnames[i], "r") as f:
+                for b, c, j, l, h, ww in zip(batch_indices, channel_indices, idx, lo, hi, w):
+                    channel = self.channels[c]
+                    X[b, c] = f[channel][j : j + self.kernel_size]
+                    psd = f["psd"][channel]
+                    P[b, c] = (1 - ww) * psd[l] + ww * psd[h]
+
+        # PSDs stay float64, strain PSDs underflow float32
+        return torch.Tensor(X), torch.from_numpy(P)
+
+    def __iter__(self):
+
+        n_batches = self.batches_per_epoch
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            n_batches = len(range(worker_info.id, n_batches, worker_info.num_workers))
+
+        for _ in range(n_batches):
+            yield self.sample_batch()
+
+
+class FrozenValidationDataset(torch.utils.data.Dataset):
+    """
+    The whitened batches of a validation set written by
+    GwakBaseDataloader.build_val_set, read as they are, followed by
+    the metadata of the batch for every key in metadata.
+    """
+
+    def __init__(self, fname: Path, group: str, metadata: list = []):
+        super().__init__()
+        self.fname = fname
+        self.group = group
+        self.keys = ["data"] + [f"metadata/{key}" for key in metadata]
+
+        with h5py.File(fname, "r") as f:
+            self.n_batches = len(f[group]["data"])
+
+    def __len__(self):
+        return self.n_batches
+
+    def __getitem__(self, idx):
+
+        # not kept open, other data modules may add their groups
+        with h5py.File(self.fname, "r") as f:
+            return [torch.from_numpy(f[self.group][key][idx]) for key in self.keys]
 
 
 class GwakBaseDataloader(pl.LightningDataModule):
@@ -186,11 +560,21 @@ class GwakBaseDataloader(pl.LightningDataModule):
         batch_size: int,
         batches_per_epoch: int,
         num_workers: int,
-        data_saving_file: Path = None
+        data_saving_file: Path = None,
+        record_every: int = 1,
+        psd_stride: Optional[float] = None,
+        kernels_per_chunk: Optional[int] = None,
+        background_store: Optional[Path] = None,
+        cache_size: Optional[int] = None,
+        cache_refresh: float = 0.25,
+        cache_dir: Optional[Path] = None,
+        val_file: Optional[Path] = None
     ):
         super().__init__()
         self.train_fnames, self.val_fnames = self.train_val_split(data_dir)
         self.sample_rate = sample_rate
+        # read the stored copy at sample_rate if there is one
+        self.channels = stored_channels(self.train_fnames + self.val_fnames, ['H1', 'L1'], sample_rate)
         self.kernel_length = kernel_length
         self.psd_length = psd_length
         self.fduration = fduration
@@ -199,12 +583,37 @@ class GwakBaseDataloader(pl.LightningDataModule):
         self.batches_per_epoch = batches_per_epoch
         self.num_workers = num_workers
         self.data_saving_file = data_saving_file
-        if self.data_saving_file is not None:
-
-            Path(self.data_saving_file.parents[0]).mkdir(parents=True, exist_ok=True)
-            self.data_group = h5py.File(self.data_saving_file, "w")
+        # record every record_every-th step to data_saving_file
+        self.record_every = record_every
+        self.recorder = None
+        # look up precomputed PSDs on a psd_stride grid instead
+        # of reading and transforming psd_length per sample
+        self.psd_stride = psd_stride
+        # cut several kernels from one long read sharing one PSD,
+        # fewer kernels per chunk give more diverse batches
+        self.kernels_per_chunk = kernels_per_chunk
+        if psd_stride is not None and kernels_per_chunk is not None:
+            raise ValueError("psd_stride and kernels_per_chunk are exclusive")
+        # load the background files once into a memory-mapped store
+        # shared by all workers and ranks, e.g. under /dev/shm
+        self.background_store = background_store
+        if psd_stride is not None and background_store is not None:
+            raise ValueError("psd_stride and background_store are exclusive")
+        # replay cache_size whitened training windows across epochs,
+        # replacing a cache_refresh fraction of them every epoch
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+        self.cache = None
+        if cache_size is not None:
+            # at least one fresh window per batch
+            fresh = round(cache_refresh * cache_size / batches_per_epoch)
+            self.fresh_size = min(max(fresh, 1), batch_size)
+        # validate on a fixed set of whitened batches written once to
+        # val_file, one group per data module class
+        self.val_file = val_file
 
         self._logger = self.get_logger()
+        self.timer = BatchTimer(self._logger.name)
 
     def train_val_split(self, data_dir, val_split=0.2):
 
@@ -214,17 +623,80 @@ class GwakBaseDataloader(pl.LightningDataModule):
 
         return all_files[:n_train_files], all_files[n_train_files:]
 
-    def train_dataloader(self):
+    def background_dataset(self, fnames, batch_size=None):
 
-        dataset = Hdf5TimeSeriesDataset(
-                self.train_fnames,
-                channels=['H1', 'L1'],
-                kernel_size=int((self.psd_length + self.fduration + self.kernel_length) * self.sample_rate),#int(self.sample_rate * self.sample_length),
-                batch_size=self.batch_size,
+        batch_size = batch_size or self.batch_size
+        if self.psd_stride is not None:
+
+            return PsdIndexedDataset(
+                fnames,
+                channels=self.channels,
+                kernel_size=int((self.fduration + self.kernel_length) * self.sample_rate),
+                batch_size=batch_size,
                 batches_per_epoch=self.batches_per_epoch,
-                coincident=False,
+                psd_length=self.psd_length,
+                sample_rate=self.sample_rate,
+            )
+
+        if self.kernels_per_chunk is not None:
+
+            window_length = self.fduration + self.kernel_length
+            return self.timeseries_dataset(
+                fnames,
+                kernel_size=int((self.psd_length + self.kernels_per_chunk * window_length) * self.sample_rate),
+                batch_size=-(-batch_size // self.kernels_per_chunk),
+            )
+
+        return self.timeseries_dataset(
+            fnames,
+            kernel_size=int((self.psd_length + self.fduration + self.kernel_length) * self.sample_rate),#int(self.sample_rate * self.sample_length),
+            batch_size=batch_size,
+        )
+
+    def timeseries_dataset(self, fnames, kernel_size, batch_size):
+
+        if self.background_store is not None:
+
+            return StoreTimeSeriesDataset(
+                store_path(self.background_store, fnames),
+                kernel_size=kernel_size,
+                batch_size=batch_size,
+                batches_per_epoch=self.batches_per_epoch,
+            )
+
+        return Hdf5TimeSeriesDataset(
+            fnames,
+            channels=self.channels,
+            kernel_size=kernel_size,
+            batch_size=batch_size,
+            batches_per_epoch=self.batches_per_epoch,
+            coincident=False,
+        )
+
+    def prepare_data(self):
+
+        if self.background_store is not None:
+
+            for fnames in [self.train_fnames, self.val_fnames]:
+                build_background_store(self.background_store, fnames, channels=self.channels)
+
+        if self.psd_stride is not None:
+
+            build_psd_index(
+                self.train_fnames + self.val_fnames,
+                channels=self.channels,
+                sample_rate=self.sample_rate,
+                psd_length=self.psd_length,
+                fftlength=self.fftlength,
+                stride=self.psd_stride,
             )
 
+    def train_dataloader(self):
+
+        # with a whitened cache only the fresh windows are read
+        batch_size = self.fresh_size if self.cache is not None else None
+        dataset = self.background_dataset(self.train_fnames, batch_size)
+
         pin_memory = isinstance(
             self.trainer.accelerator, pl.accelerators.CUDAAccelerator
         )
@@ -234,14 +706,21 @@ class GwakBaseDataloader(pl.LightningDataModule):
         return dataloader
 
     def val_dataloader(self):
-        dataset = Hdf5TimeSeriesDataset(
-            self.val_fnames,
-            channels=['H1', 'L1'],
-            kernel_size=int((self.psd_length + self.fduration + self.kernel_length) * self.sample_rate), # int(self.hparams.sample_rate * self.sample_length),
-            batch_size=self.batch_size,
-            batches_per_epoch=self.batches_per_epoch,
-            coincident=False,
-        )
+
+        if self.val_file is not None:
+
+            # built on the first rank while the others wait
+            if self.trainer.global_rank == 0:
+                self.build_val_set()
+            self.trainer.strategy.barrier()
+
+            return torch.utils.data.DataLoader(
+                FrozenValidationDataset(self.val_file, self.val_group, self.val_metadata),
+                num_workers=self.num_workers,
+                pin_memory=False
+            )
+
+        dataset = self.background_dataset(self.val_fnames)
 
         pin_memory = isinstance(
             self.trainer.accelerator, pl.accelerators.CUDAAccelerator
@@ -257,63 +736,289 @@ class GwakBaseDataloader(pl.LightningDataModule):
         logger.setLevel(logging.INFO)
         return logger
 
-    def whiten(self, batch):
+    @property
+    def device(self):
+
+        if self.trainer is None:
+            return torch.device('cpu')
+
+        return self.trainer.strategy.root_device
+
+    @property
+    def seed(self):
 
-        # split batch into psd data and data to be whitened
-        split_size = int((self.kernel_length + self.fduration) * self.sample_rate)
-        splits = [batch.size(-1) - split_size, split_size]
-        psd_data, batch = torch.split(batch, splits, dim=-1)
+        # seed_everything gives all ranks the same seed, offset it
+        # so every rank draws its own samples
+        rank = 0 if self.trainer is None else self.trainer.global_rank
+        return (torch.initial_seed() + rank) % 2**63
 
-        # psd estimator
-        # takes tensor of shape (batch_size, num_ifos, psd_length)
-        spectral_density = SpectralDensity(
+    def setup(self, stage=None):
+
+        # built once and kept on the trainer's device
+        self.preprocessor = WhiteningStage(
             self.sample_rate,
+            self.kernel_length,
+            self.fduration,
             self.fftlength,
-            average = 'median'
-        ).to('cuda')
+        ).to(self.device)
 
-        # calculate psds
-        psds = spectral_density(psd_data.double())
+        if self.data_saving_file is not None and self.recorder is None:
 
-        # create whitener
-        whitener = Whiten(
-            self.fduration,
-            self.sample_rate,
-            highpass = 30,
-        ).to('cuda')
+            rank = 0 if self.trainer is None else self.trainer.global_rank
+            file_name = recorder_file(self.data_saving_file, rank, stage)
+            self.recorder = BatchRecorder(file_name, every=self.record_every)
+
+        if self.cache_size is not None and self.cache is None and stage in (None, 'fit'):
+            self.cache = WhitenedCache(self.cache_size, self.cache_dir)
+            self.fill_cache()
+
+    def teardown(self, stage=None):
+
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def unpack(self, batch, batch_size=None):
+
+        # the PSD indexed dataset yields (kernels, psds)
+        if self.psd_stride is not None:
+            batch, psds = batch
+            return batch[0], psds[0]
+
+        [batch] = batch
+        if self.kernels_per_chunk is not None:
+            return self.preprocessor.cut_kernels(batch, self.kernels_per_chunk, batch_size or self.batch_size)
+
+        return batch, None
+
+    def whiten_background(self, batch, psds=None):
+
+        if psds is None:
+            psd_data, batch = self.preprocessor.split(batch)
+            psds = self.preprocessor.psd(psd_data)
+
+        return self.preprocessor.whiten(batch, psds, normalize=False), psds
+
+    def fill_cache(self):
+
+        self._logger.info(f'Filling the whitened cache with {self.cache_size} windows')
+        dataloader = torch.utils.data.DataLoader(
+            self.background_dataset(self.train_fnames), num_workers=self.num_workers
+        )
+        while not self.cache.full:
+            for batch in dataloader:
+                batch, psds = self.unpack(move_data_to_device(batch, self.device))
+                self.cache.add(*self.whiten_background(batch, psds))
+                if self.cache.full:
+                    break
+
+    def replay(self, batch, psds=None):
+        """
+        Whiten the fresh windows into the cache and fill the batch up
+        with cached windows. Returns whitened, not yet normalized,
+        windows and their PSDs.
+        """
+
+        batch, psds = self.whiten_background(batch, psds)
+        self.cache.add(batch, psds)
+
+        cached, cached_psds = self.cache.sample(self.batch_size - len(batch))
+        batch = torch.cat([batch, cached.to(batch)])
+        psds = torch.cat([psds, cached_psds.to(psds)])
+
+        return batch, psds
+
+    def background(self, batch, replay=None):
+        """
+        Background windows and PSDs of a transferred batch, and
+        whether the windows are already whitened, which they are when
+        training replays the whitened cache.
+        """
+
+        if replay is None:
+            replay = self.cache is not None and self.trainer.training
+
+        if replay:
+            batch, psds = self.unpack(batch, self.fresh_size)
+            return *self.replay(batch, psds), True
+
+        return *self.unpack(batch), False
+
+    def whiten(self, batch, psds=None):
+
+        return self.preprocessor(batch, psds=psds)
+
+    @property
+    def val_group(self):
+        return type(self).__name__
+
+    @property
+    def val_metadata(self):
+
+        # metadata returned with the frozen validation batches
+        return []
+
+    @property
+    def val_config(self):
+
+        # what the validation set holds besides the window settings
+        return dict(
+            fnames=sorted(Path(fname).name for fname in self.val_fnames),
+            channels=self.channels,
+        )
+
+    @property
+    def frozen(self):
+
+        # batches of the frozen validation set are used as they are
+        return self.val_file is not None and not self.trainer.training
+
+    def unpack_frozen(self, batch):
+
+        batch = [value[0] for value in batch]
+
+        return batch[0] if len(batch) == 1 else tuple(batch)
+
+    def pad(self, waveforms):
+
+        # centre the waveforms in the whitened window
+        inj_len = waveforms.shape[-1]
+        window_len = self.preprocessor.split_size
+        half = int((window_len - inj_len)/2)
+
+        first_half, second_half = half, window_len - half - inj_len
 
-        whitened = whitener(batch.double(), psds.double())
+        return F.pad(
+            input=waveforms,
+            pad=(first_half, second_half),
+            mode='constant',
+            value=0
+        )
+
+    def whiten_views(self, batch, waveforms, psds, whitened=False):
+        """
+        Add K views of padded waveforms, shaped (K, batch, ifos,
+        length), to the same background batch and whiten all views in
+        one stacked pass. A whitened batch gets the whitened waveforms
+        added instead.
+        """
+
+        # (K, batch, ifos, length) -> (K * batch, ifos, length)
+        n_views, batch_size = waveforms.shape[:2]
+
+        if whitened:
+            # whitening is linear, whiten the signal alone
+            waveforms = self.preprocessor.whiten(
+                waveforms.reshape(n_views * batch_size, *waveforms.shape[2:]),
+                psds.repeat(n_views, 1, 1),
+                normalize=False
+            )
+            injected = batch + waveforms.reshape(n_views, batch_size, *waveforms.shape[1:])
 
-        # normalize the input data
-        stds = torch.std(whitened, dim=-1, keepdim=True)
-        whitened = whitened / stds
+            return self.preprocessor.normalize(injected)
 
-        return whitened
+        injected = batch + waveforms
+        injected = self.preprocessor.whiten(
+            injected.reshape(n_views * batch_size, *injected.shape[2:]),
+            psds.repeat(n_views, 1, 1)
+        )
+
+        return injected.reshape(n_views, batch_size, *injected.shape[1:])
+
+    def val_batch(self, batch, psds=None):
+        """
+        A whitened validation batch and a dict of per sample metadata
+        tensors to store with it.
+        """
+
+        return self.whiten(batch, psds), {}
+
+    def build_val_set(self):
+        """
+        Run batches_per_epoch validation batches through the full
+        pipeline once and write the whitened batches to the val_group
+        of val_file, with their metadata. A set built with the same
+        settings and val_config is reused, any other one is rebuilt.
+        """
+
+        attrs = dict(
+            sample_rate=self.sample_rate,
+            kernel_length=self.kernel_length,
+            psd_length=self.psd_length,
+            fduration=self.fduration,
+            fftlength=self.fftlength,
+            batch_size=self.batch_size,
+            batches_per_epoch=self.batches_per_epoch,
+            config=json.dumps(self.val_config, sort_keys=True),
+        )
+
+        val_file = Path(self.val_file)
+        if val_file.exists():
+            with h5py.File(val_file, 'r') as f:
+
+                if self.val_group in f:
+                    if dict(f[self.val_group].attrs) == attrs:
+                        return
+                    self._logger.info(f'The validation set {self.val_group} in {val_file} was built with other settings')
+
+        self._logger.info(f'Building the validation set {self.val_group} in {val_file}')
+        dataloader = torch.utils.data.DataLoader(
+            self.background_dataset(self.val_fnames), num_workers=self.num_workers
+        )
+
+        data, metadata = [], {}
+        with torch.no_grad():
+            for batch in dataloader:
+
+                batch, psds, _ = self.background(move_data_to_device(batch, self.device), replay=False)
+                batch, meta = self.val_batch(batch, psds)
+
+                data.append(batch.cpu().numpy())
+                for key, value in meta.items():
+                    metadata.setdefault(key, []).append(value.cpu().numpy())
+
+        # written under a temporary name, a complete group is moved in place
+        val_file.parent.mkdir(parents=True, exist_ok=True)
+        with h5py.File(val_file, 'a') as f:
+
+            tmp = f'{self.val_group}.tmp'
+            for name in [tmp, self.val_group]:
+                if name in f:
+                    del f[name]
+
+            group = f.create_group(tmp)
+            group.create_dataset('data', data=np.stack(data))
+            for key, value in metadata.items():
+                group.create_dataset(f'metadata/{key}', data=np.stack(value))
+            group.attrs.update(attrs)
+
+            f.move(tmp, self.val_group)
 
     def on_after_batch_transfer(self, batch, dataloader_idx):
 
+        if self.frozen:
+            return self.unpack_frozen(batch)
+
         if self.trainer.training or self.trainer.validating or self.trainer.sanity_checking:
-            # unpack the batch
-            [batch] = batch
             # inject waveforms; maybe also whiten data preprocess etc..
-            batch = self.whiten(batch)
-
-            if self.trainer.training and (self.data_saving_file is not None):
-
-                step_name = f"Training/Step_{self.trainer.global_step:06d}_BK"
-                self.data_group.create_dataset(step_name, data = batch.cpu())
+            with self.timer(self.device):
+                # unpack the batch
+                batch, psds, whitened = self.background(batch)
 
-            if self.trainer.validating and (self.data_saving_file is not None):
+                if whitened:
+                    batch = self.preprocessor.normalize(batch)
+                else:
+                    batch = self.whiten(batch, psds)
 
-                step_name = f"Validation/Step_{self.trainer.global_validation_step:06d}_BK"
-                self.data_group.create_dataset(step_name, data = batch.cpu())
+            if self.recorder is not None:
+                self.recorder.record_step(self.trainer, BK=batch)
 
             return batch
 
     def generate_waveforms(self, batch_size, parameters=None, ra=None, dec=None):
         pass
 
-    def inject(self, batch, waveforms):
+    def inject(self, batch, waveforms, psds=None, whitened=False, return_snrs=False):
         pass
 
 
@@ -324,126 +1029,271 @@ class SignalDataloader(GwakBaseDataloader):
         prior: data.BasePrior,
         waveform: torch.nn.Module,
         *args,
+        waveform_bank: Optional[Path] = None,
+        bank_size: int = 100000,
+        bank_refresh: float = 0,
+        snr_prior: Optional[torch.distributions.Distribution] = None,
         **kwargs
     ):
         super().__init__(*args, **kwargs)
         self.waveform = waveform
         self.prior = prior
 
+        # rescale every injection to an optimal SNR drawn from
+        # snr_prior instead of a fixed factor of 100
+        self.snr_prior = snr_prior
+
+        # draw polarizations from a pre-generated bank, with a
+        # bank_refresh fraction of every batch generated fresh
+        self.waveform_bank = waveform_bank
+        self.bank_size = bank_size
+        self.bank_refresh = bank_refresh
+        self.bank = None
+        # set by frequency domain models
+        self.ringdown_size = None
+
         # Projection parameters
         self.ra_prior =  Uniform(0, 2*torch.pi)
         self.dec_prior = Cosine(-np.pi/2, torch.pi/2)
         self.phic_prior = Uniform(0, 2 * torch.pi)
 
-    def generate_waveforms(self, batch_size, parameters=None, ra=None, dec=None):
+    def prepare_data(self):
+
+        super().prepare_data()
+
+        if self.waveform_bank is not None:
+
+            build_waveform_bank(
+                self.waveform_bank,
+                self.prior,
+                self.waveform,
+                self.bank_size,
+                sample_rate=self.sample_rate,
+                ringdown_size=self.ringdown_size,
+                max_workers=max(self.num_workers, 1),
+            )
+
+    def setup(self, stage=None):
+
+        super().setup(stage)
+
+        # sample the prior and generate on the trainer's device
+        self.prior.compile(self.device, self.seed)
+        self.waveform.to(self.device)
+
+        if self.waveform_bank is not None:
+            self.bank = WaveformBank(self.waveform_bank)
+
+    def sample_psi(self, parameters, batch_size):
+
+        return self.phic_prior.sample((batch_size,))
+
+    def generate_polarizations(self, parameters):
+
+        cross, plus = self.waveform(**parameters)
+
+        return cross, plus
+
+    def sample_polarizations(self, batch_size):
+        """
+        Parameters, psi and polarizations of batch_size signals, from
+        the bank if there is one.
+        """
+
+        if self.bank is None:
+
+            parameters = self.prior.sample(batch_size) # dict[str, torch.tensor]
+            cross, plus = self.generate_polarizations(parameters)
+
+            return parameters, self.sample_psi(parameters, batch_size), cross, plus
+
+        n_fresh = int(round(self.bank_refresh * batch_size))
+        parameters, cross, plus = move_data_to_device(
+            self.bank.sample(batch_size - n_fresh), self.device
+        )
+
+        if n_fresh > 0:
+
+            fresh = self.prior.sample(n_fresh)
+            fresh_cross, fresh_plus = self.generate_polarizations(fresh)
+
+            parameters = {
+                key: torch.cat([value, fresh[key].to(value)])
+                for key, value in parameters.items()
+            }
+            cross = torch.cat([cross, fresh_cross.to(cross)])
+            plus = torch.cat([plus, fresh_plus.to(plus)])
+
+        return parameters, self.sample_psi(parameters, batch_size), cross, plus
+
+    def project(self, cross, plus, ra, dec, psi):
+        """
+        Detector responses of one set of polarizations seen from N sky
+        positions, computed in a single compute_observed_strain call.
+        ra, dec and psi are shaped (N, batch), the responses
+        (N, batch, ifos, length).
+        """
 
         # get detector orientations
         ifos = ['H1', 'L1']
         tensors, vertices = get_ifo_geometry(*ifos)
 
-        # sample from prior and generate waveforms
-        parameters = self.prior.sample(batch_size) # dict[str, torch.tensor]
+        n_views = ra.shape[0]
+        device = cross.device
+        responses = compute_observed_strain(
+            dec.reshape(-1).to(device),
+            psi.reshape(-1).to(device),
+            ra.reshape(-1).to(device),
+            tensors.to(device),
+            vertices.to(device),
+            self.sample_rate,
+            cross=cross.float().repeat(n_views, 1),
+            plus=plus.float().repeat(n_views, 1)
+        ).to(self.device)
 
-        ra = self.ra_prior.sample((batch_size,))
-        dec = self.dec_prior.sample((batch_size,))
-        phic = self.phic_prior.sample((batch_size,))
+        return responses.reshape(n_views, -1, *responses.shape[1:])
 
-        cross, plus = self.waveform(**parameters)
+    def generate_waveforms(self, batch_size, parameters=None, ra=None, dec=None):
+
+        if parameters is None:
+            parameters, psi, cross, plus = self.sample_polarizations(batch_size)
+        else:
+            psi = self.sample_psi(parameters, batch_size)
+            cross, plus = self.generate_polarizations(parameters)
+
+        if ra is None:
+            ra = self.ra_prior.sample((batch_size,))
+        if dec is None:
+            dec = self.dec_prior.sample((batch_size,))
 
         # compute detector responses
-        responses = compute_observed_strain(
-            dec,
-            phic,
-            ra,
-            tensors,
-            vertices,
-            self.sample_rate,
-            cross=cross.float(),
-            plus=plus.float()
-        ).to('cuda')
+        return self.project(cross, plus, ra[None], dec[None], psi[None])[0]
 
+    def inject(self, batch, waveforms, psds=None, whitened=False, return_snrs=False):
 
-        return responses
+        if return_snrs:
+            injected, snrs = self.inject_views(batch, waveforms[None], psds, whitened, return_snrs)
+            return injected[0], snrs[0]
 
-    def inject(self, batch, waveforms):
+        return self.inject_views(batch, waveforms[None], psds, whitened)[0]
 
-        # split batch into psd data and data to be whitened
-        split_size = int((self.kernel_length + self.fduration) * self.sample_rate)
-        splits = [batch.size(-1) - split_size, split_size]
-        psd_data, batch = torch.split(batch, splits, dim=-1)
+    def inject_views(self, batch, waveforms, psds=None, whitened=False, return_snrs=False):
+        """
+        Inject K views of waveforms, shaped (K, batch, ifos, length),
+        into the same background batch. The PSD is estimated once and
+        all K views are whitened in one stacked pass. With
+        return_snrs the optimal SNRs of the injections, shaped
+        (K, batch), are returned too.
+        """
 
-        # psd estimator
-        # takes tensor of shape (batch_size, num_ifos, psd_length)
-        spectral_density = SpectralDensity(
-            self.sample_rate,
-            self.fftlength,
-            average = 'median'
-        ).to('cuda')
+        if psds is None:
+            psd_data, batch = self.preprocessor.split(batch)
+            psds = self.preprocessor.psd(psd_data)
 
-        # calculate psds
-        psds = spectral_density(psd_data.double())
+        waveforms, snrs = self.scale_views(self.pad(waveforms), psds, return_snrs)
+        injected = self.whiten_views(batch, waveforms, psds, whitened)
 
-        # Waveform padding
-        inj_len = waveforms.shape[-1]
-        window_len = splits[1]
-        half = int((window_len - inj_len)/2)
+        if return_snrs:
+            return injected, snrs
 
-        first_half, second_half = half, window_len - half - inj_len
+        return injected
 
-        waveforms = F.pad(
-            input=waveforms,
-            pad=(first_half, second_half),
-            mode='constant',
-            value=0
-        )
+    def scale_views(self, waveforms, psds, return_snrs=False):
+        """
+        Rescale K padded views of waveforms, shaped (K, batch, ifos,
+        length). The optimal SNRs are only computed when needed.
+        """
 
-        injected = batch + waveforms * 100
+        n_views, batch_size = waveforms.shape[:2]
+        snrs = None
+        if self.snr_prior is not None or return_snrs:
+            snrs = self.preprocessor.snr(
+                waveforms.reshape(n_views * batch_size, *waveforms.shape[2:]),
+                psds.repeat(n_views, 1, 1)
+            ).reshape(n_views, batch_size)
 
-        # create whitener
-        whitener = Whiten(
-            self.fduration,
-            self.sample_rate,
-            highpass = 30,
-        ).to('cuda')
+        return self.rescale(waveforms, snrs)
 
-        whitened = whitener(injected.double(), psds.double())
+    def rescale(self, waveforms, snrs=None):
+        """
+        Scale injections of optimal SNR snrs, shaped (K, batch), to
+        SNRs drawn from snr_prior, or by a fixed factor of 100 without
+        one. Returns the scaled waveforms and their SNRs.
+        """
 
-        # normalize the input data
-        stds = torch.std(whitened, dim=-1, keepdim=True)
-        whitened = whitened / stds
+        if self.snr_prior is None:
+            return waveforms * 100, None if snrs is None else snrs * 100
 
-        return whitened
+        scale = self.snr_scale(snrs)
 
-    def on_after_batch_transfer(self, batch, dataloader_idx):
+        return waveforms * scale[..., None, None], snrs * scale
 
-        if self.trainer.training or self.trainer.validating or self.trainer.sanity_checking:
-            # unpack the batch
-            [batch] = batch
+    def snr_scale(self, snrs):
+        """
+        Amplitude factors taking injections of optimal SNR snrs,
+        shaped (K, batch), to SNRs drawn from snr_prior. The first view
+        gets the drawn SNR and the others the same factor, so the
+        amplitude differences between the views are kept.
+        """
 
-            # generate waveforms
-            waveforms = self.generate_waveforms(batch.shape[0])
-            # inject waveforms; maybe also whiten data preprocess etc..
+        target = self.snr_prior.sample((snrs.shape[-1],)).to(snrs)
+        scale = torch.where(snrs[0] > 0, target / snrs[0], torch.zeros_like(target))
+
+        return scale.float().expand(snrs.shape)
+
+    def signal_settings(self):
+        """
+        The signals this class injects, as plain values.
+        """
+
+        return dict(
+            signal_config(self.prior, self.waveform),
+            signal_class=type(self).__name__,
+            snr_prior=repr(self.snr_prior),
+        )
+
+    @property
+    def val_config(self):
+
+        return dict(super().val_config, signal=self.signal_settings())
+
+    def val_batch(self, batch, psds=None):
+
+        batch_size = batch.shape[0]
+        parameters = self.prior.sample(batch_size)
+        ra = self.ra_prior.sample((batch_size,))
+        dec = self.dec_prior.sample((batch_size,))
+
+        waveforms = self.generate_waveforms(batch_size, parameters, ra, dec)
+        batch, snrs = self.inject(batch, waveforms, psds, return_snrs=True)
 
-            batch = self.inject(batch, waveforms)
+        # keep the per sample parameters only
+        metadata = {
+            key: value for key, value in parameters.items()
+            if torch.is_tensor(value) and value.shape == (batch_size,)
+        }
+        metadata.update(ra=ra, dec=dec, snr=snrs)
 
-            if self.trainer.training and (self.data_saving_file is not None):
+        return batch, metadata
 
-                # Set a warning that when the global_step exceed 1e6,
-                # the data will have duplications.
-                # Replace this with a data saving function.
-                bk_step = f"Training/Step_{self.trainer.global_step:06d}_BK"
-                inj_step = f"Training/Step_{self.trainer.global_step:06d}_INJ"
+    def on_after_batch_transfer(self, batch, dataloader_idx):
 
-                self.data_group.create_dataset(bk_step, data = batch.cpu())
-                self.data_group.create_dataset(inj_step, data = waveforms.cpu())
+        if self.frozen:
+            return self.unpack_frozen(batch)
 
-            if self.trainer.validating and (self.data_saving_file is not None):
+        if self.trainer.training or self.trainer.validating or self.trainer.sanity_checking:
+            with self.timer(self.device):
+                # unpack the batch
+                batch, psds, whitened = self.background(batch)
 
-                bk_step = f"Validation/Step_{self.trainer.global_validation_step:06d}_BK"
-                inj_step = f"Validation/Step_{self.trainer.global_validation_step:06d}_INJ"
+                # generate waveforms
+                waveforms = self.generate_waveforms(batch.shape[0])
+                # inject waveforms; maybe also whiten data preprocess etc..
 
-                self.data_group.create_dataset(bk_step, data = batch.cpu())
-                self.data_group.create_dataset(inj_step, data = waveforms.cpu())
+                batch = self.inject(batch, waveforms, psds, whitened)
+
+            if self.recorder is not None:
+                self.recorder.record_step(self.trainer, BK=batch, INJ=waveforms)
 
             return batch
 
@@ -456,11 +1306,17 @@ class AugmentationSignalDataloader(GwakBaseDataloader):
             ra_prior=None,
             dec_prior=None,
             *args,
+            n_views: int = 2,
             **kwargs
         ):
         super().__init__(*args, **kwargs)
         self.signal_class = signal_class
         self.prior = prior
+        self.n_views = n_views
+
+        # the views are projected and whitened in the time domain
+        if getattr(signal_class, 'frequency_domain', False):
+            raise ValueError("frequency_domain is not supported with augmented views")
 
         self.ra_prior =  Uniform(0, 2*torch.pi)
         self.dec_prior = Cosine(-np.pi/2, torch.pi/2)
@@ -475,70 +1331,273 @@ class AugmentationSignalDataloader(GwakBaseDataloader):
         self.distance_augmentation = False
         self.tc_augmentation = False
 
-    def generate_waveforms_augmented(self, batch_size):
-        parameters = self.prior.sample(batch_size) # dict[str, torch.tensor]
-        ra = self.ra_prior.sample((batch_size,))
-        dec = self.dec_prior.sample((batch_size,))
+    def prepare_data(self):
 
+        super().prepare_data()
+        self.signal_class.prepare_data()
 
-        aug0 = self.signal_class.generate_waveforms(batch_size, parameters = parameters,
-                                                    ra = ra, dec = dec)
+    def setup(self, stage=None):
 
-        if self.sky_location_augmentation: #reroll
-            ra = self.ra_prior.sample((batch_size,))
-            dec = self.dec_prior.sample((batch_size,))
+        super().setup(stage)
 
-        if self.distance_augmentation:
-            parameters_regenerated = self.prior.sample(batch_size)
-            parameters['distance'] = parameters_regenerated['distance']
+        # the signal class is not attached to the trainer, let it
+        # follow our device and share our preprocessing stage
+        self.signal_class.trainer = self.trainer
+        self.signal_class.preprocessor = self.preprocessor
 
-        if self.tc_augmentation:
-            # prior sets everything to zero, so implement this later
-            None
+        self.signal_class.prior.compile(self.device, self.seed)
+        self.signal_class.waveform.to(self.device)
 
-        # and do it again
-        aug1 = self.signal_class.generate_waveforms(batch_size, parameters = parameters,
-                                                    ra = ra, dec = dec)
+        if self.signal_class.waveform_bank is not None:
+            self.signal_class.bank = WaveformBank(self.signal_class.waveform_bank)
 
-        return torch.stack([aug0, aug1])
+    def sample_distance(self, batch_size):
 
-    def inject_augmented(self, batch, waveforms):
-        aug_0, aug_1 = waveforms
+        # LAL_BBHPrior keeps its distributions in priors
+        priors = getattr(self.prior, 'priors', None) or self.prior.params
 
-        aug_0_injected = self.signal_class.inject(batch, aug_0)
-        aug_1_injected = self.signal_class.inject(batch, aug_1)
-        return torch.stack([aug_0_injected, aug_1_injected])
+        return priors['distance'].sample((batch_size,))
+
+    def generate_waveforms_augmented(self, batch_size):
+        """
+        The polarizations are generated once and projected to all
+        n_views sky positions together. Distance augmentation rescales
+        the amplitude, strain goes as 1 / distance.
+        """
+
+        parameters, psi, cross, plus = self.signal_class.sample_polarizations(batch_size)
+
+        ra = [self.ra_prior.sample((batch_size,))]
+        dec = [self.dec_prior.sample((batch_size,))]
+        scale = [torch.ones(batch_size, device=cross.device)]
+
+        for view in range(1, self.n_views):
+
+            if self.sky_location_augmentation: #reroll
+                ra.append(self.ra_prior.sample((batch_size,)))
+                dec.append(self.dec_prior.sample((batch_size,)))
+            else:
+                ra.append(ra[0])
+                dec.append(dec[0])
+
+            if self.distance_augmentation and 'distance' in parameters:
+                distance = self.sample_distance(batch_size).to(scale[0])
+                scale.append(parameters['distance'].to(scale[0]) / distance)
+            else:
+                scale.append(scale[0])
+
+            if self.tc_augmentation:
+                # prior sets everything to zero, so implement this later
+                None
+
+        responses = self.signal_class.project(
+            cross,
+            plus,
+            torch.stack(ra),
+            torch.stack(dec),
+            psi.expand(self.n_views, -1)
+        )
+        scale = torch.stack(scale).to(responses)
+
+        return responses * scale[:, :, None, None]
+
+    def inject_augmented(self, batch, waveforms, psds=None, whitened=False):
+
+        # one PSD and one whitening pass for all views
+        return self.signal_class.inject_views(batch, waveforms, psds, whitened)
+
+    @property
+    def val_config(self):
+
+        return dict(
+            super().val_config,
+            signal=self.signal_class.signal_settings(),
+            prior=type(self.prior).__name__,
+            n_views=self.n_views,
+            augmentations=[
+                self.sky_location_augmentation,
+                self.distance_augmentation,
+                self.tc_augmentation
+            ],
+        )
+
+    def val_batch(self, batch, psds=None):
+
+        waveforms = self.generate_waveforms_augmented(batch.shape[0])
+        batch, snrs = self.signal_class.inject_views(batch, waveforms, psds, return_snrs=True)
+
+        return batch, dict(snr=snrs.T)
 
     def on_after_batch_transfer(self, batch, dataloader_idx):
 
+        if self.frozen:
+            return self.unpack_frozen(batch)
+
         if self.trainer.training or self.trainer.validating or self.trainer.sanity_checking:
-            # unpack the batch
-            [batch] = batch
+            with self.timer(self.device):
+                # unpack the batch
+                batch, psds, whitened = self.background(batch)
 
-            # generate waveforms
-            waveforms = self.generate_waveforms_augmented(batch.shape[0])
-            # inject waveforms; maybe also whiten data preprocess etc..
+                # generate waveforms
+                waveforms = self.generate_waveforms_augmented(batch.shape[0])
+                # inject waveforms; maybe also whiten data preprocess etc..
+
+                batch = self.inject_augmented(batch, waveforms, psds, whitened)
+
+            if self.recorder is not None:
+                self.recorder.record_step(self.trainer, BK=batch, INJ=waveforms)
+
+            return batch
+
+
+class MixtureDataloader(GwakBaseDataloader):
+    """
+    Inject a weighted mix of signal classes into one background
+    stream. The background of a batch is read, PSD estimated and
+    whitened once, every sample gets a class drawn with the given
+    weights and all classes are whitened together in one pass.
+    """
+
+    def __init__(
+        self,
+        signal_classes: List[SignalDataloader],
+        *args,
+        weights: Optional[List[float]] = None,
+        n_views: int = 2,
+        return_labels: bool = False,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.signal_classes = signal_classes
+
+        # the views are projected and whitened in the time domain
+        if any(getattr(signal_class, 'frequency_domain', False) for signal_class in signal_classes):
+            raise ValueError("frequency_domain is not supported in a mixture")
+
+        weights = weights or [1] * len(signal_classes)
+        if len(weights) != len(signal_classes):
+            raise ValueError("weights and signal_classes differ in length")
+        self.weights = torch.as_tensor(weights, dtype=torch.float)
+
+        # the views of a sample differ in sky position, a single view
+        # gives (batch, ifos, length) batches
+        self.n_views = n_views
+        # return (batch, labels) instead of the batch alone
+        self.return_labels = return_labels
+
+        self.ra_prior =  Uniform(0, 2*torch.pi)
+        self.dec_prior = Cosine(-np.pi/2, torch.pi/2)
+
+    def prepare_data(self):
+
+        super().prepare_data()
+        for signal_class in self.signal_classes:
+            signal_class.prepare_data()
+
+    def setup(self, stage=None):
+
+        super().setup(stage)
+
+        # the signal classes are not attached to the trainer, let them
+        # follow our device and share our preprocessing stage
+        for signal_class in self.signal_classes:
+
+            signal_class.trainer = self.trainer
+            signal_class.preprocessor = self.preprocessor
+
+            signal_class.prior.compile(self.device, self.seed)
+            signal_class.waveform.to(self.device)
+
+            if signal_class.waveform_bank is not None:
+                signal_class.bank = WaveformBank(signal_class.waveform_bank)
+
+    @property
+    def val_metadata(self):
+        return ['label'] if self.return_labels else []
+
+    @property
+    def val_config(self):
+
+        return dict(
+            super().val_config,
+            signals=[signal_class.signal_settings() for signal_class in self.signal_classes],
+            weights=self.weights.tolist(),
+            n_views=self.n_views,
+        )
+
+    def generate_views(self, signal_class, batch_size):
+
+        parameters, psi, cross, plus = signal_class.sample_polarizations(batch_size)
+        ra = self.ra_prior.sample((self.n_views, batch_size))
+        dec = self.dec_prior.sample((self.n_views, batch_size))
+
+        return signal_class.project(cross, plus, ra, dec, psi.expand(self.n_views, -1))
+
+    def generate_mixture(self, batch_size, psds, return_snrs=False):
+        """
+        Class labels and K views of padded, rescaled waveforms of a
+        batch, every class generated for its own samples only.
+        """
+
+        labels = torch.multinomial(self.weights, batch_size, replacement=True).to(self.device)
+        waveforms = torch.zeros(
+            (self.n_views, batch_size, psds.shape[1], self.preprocessor.split_size),
+            device=self.device
+        )
+        snrs = torch.zeros((self.n_views, batch_size), device=self.device)
+
+        for label, signal_class in enumerate(self.signal_classes):
+
+            idx = torch.where(labels == label)[0]
+            if len(idx) == 0:
+                continue
+
+            views = self.pad(self.generate_views(signal_class, len(idx)))
+            views, class_snrs = signal_class.scale_views(views, psds[idx], return_snrs)
+
+            waveforms[:, idx] = views.to(waveforms)
+            if return_snrs:
+                snrs[:, idx] = class_snrs.to(snrs)
+
+        return labels, waveforms, snrs
+
+    def inject_mixture(self, batch, psds=None, whitened=False, return_snrs=False):
+
+        if psds is None:
+            psd_data, batch = self.preprocessor.split(batch)
+            psds = self.preprocessor.psd(psd_data)
 
-            batch = self.inject_augmented(batch, waveforms)
+        labels, waveforms, snrs = self.generate_mixture(batch.shape[0], psds, return_snrs)
+        injected = self.whiten_views(batch, waveforms, psds, whitened)
 
-            if self.trainer.training and (self.data_saving_file is not None):
+        if self.n_views == 1:
+            injected, waveforms, snrs = injected[0], waveforms[0], snrs[0]
 
-                # Set a warning that when the global_step exceed 1e6,
-                # the data will have duplications.
-                # Replace this with a data saving function.
-                bk_step = f"Training/Step_{self.trainer.global_step:06d}_BK"
-                inj_step = f"Training/Step_{self.trainer.global_step:06d}_INJ"
+        return injected, labels, waveforms, snrs
 
-                self.data_group.create_dataset(bk_step, data = batch.cpu())
-                self.data_group.create_dataset(inj_step, data = waveforms.cpu())
+    def val_batch(self, batch, psds=None):
 
-            if self.trainer.validating and (self.data_saving_file is not None):
+        batch, labels, _, snrs = self.inject_mixture(batch, psds, return_snrs=True)
 
-                bk_step = f"Validation/Step_{self.trainer.global_validation_step:06d}_BK"
-                inj_step = f"Validation/Step_{self.trainer.global_validation_step:06d}_INJ"
+        return batch, dict(label=labels, snr=snrs.movedim(0, -1))
 
-                self.data_group.create_dataset(bk_step, data = batch.cpu())
-                self.data_group.create_dataset(inj_step, data = waveforms.cpu())
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+
+        if self.frozen:
+            return self.unpack_frozen(batch)
+
+        if self.trainer.training or self.trainer.validating or self.trainer.sanity_checking:
+            with self.timer(self.device):
+                # unpack the batch
+                batch, psds, whitened = self.background(batch)
+
+                batch, labels, waveforms, _ = self.inject_mixture(batch, psds, whitened)
+
+            if self.recorder is not None:
+                self.recorder.record_step(self.trainer, BK=batch, INJ=waveforms, LABEL=labels)
+
+            if self.return_labels:
+                return batch, labels
 
             return batch
 
@@ -549,49 +1608,189 @@ class BBHDataloader(SignalDataloader):
         self,
         ringdown_duration: float,
         *args,
+        frequency_domain: bool = False,
         **kwargs
     ):
         super().__init__(*args, **kwargs)
         self.ringdown_size = int(ringdown_duration * self.sample_rate)
 
-    def generate_waveforms(self, batch_size, parameters=None, ra=None, dec=None):
+        # project, shift, inject and whiten in the frequency domain
+        # with one inverse FFT per batch
+        self.frequency_domain = frequency_domain
+        if frequency_domain and self.waveform_bank is not None:
+            raise ValueError("frequency_domain and waveform_bank are exclusive")
 
-        # get detector orientations
-        ifos = ['H1', 'L1']
-        tensors, vertices = get_ifo_geometry(*ifos)
+        self.window_size = int((self.kernel_length + self.fduration) * self.sample_rate)
+        if frequency_domain:
+            self.frequency_grid()
+
+    def frequency_grid(self):
+        """
+        The band of the rfft grid of the prior's duration, or of the
+        window if that is longer, the model is evaluated on. A signal
+        longer than the window is cut to the window at the end of its
+        grid by a fixed linear map of its spectrum to the rfft of the
+        window, so it does not wrap around and needs no extra FFT.
+        """
+
+        fs = self.prior.sampled_params.get('fs') if hasattr(self.prior, 'sampled_params') else None
+        if fs is None:
+            raise ValueError("frequency_domain needs a prior with a frequency grid fs")
+
+        duration = 1 / (fs[1] - fs[0]).item()
+        self.grid_size = max(self.window_size, round(duration * self.sample_rate))
+
+        frequencies = torch.fft.rfftfreq(self.grid_size, 1 / self.sample_rate)
+        self.band = torch.where((frequencies >= fs[0]) & (frequencies <= fs[-1]))[0]
+        self.frequencies = frequencies[self.band]
+
+        self.crop = None
+        if self.grid_size == self.window_size:
+            return
+
+        # irfft takes bin k of a spectrum X to X[k] e^{iwn} + X[k]* e^{-iwn},
+        # once for the zero and Nyquist bins, the window is the rfft of
+        # its last window_size samples
+        n = torch.arange(self.grid_size - self.window_size, self.grid_size, dtype=torch.float64)
+        edge = (self.band == 0) | (2 * self.band == self.grid_size)
+        crop = []
+        for sign in [1, -1]:
+            rows = [
+                torch.fft.fft(
+                    torch.exp(sign * 2j * torch.pi * k[:, None] * n / self.grid_size), norm='forward'
+                )[:, :self.window_size // 2 + 1]
+                for k in torch.split(self.band.double(), 256)
+            ]
+            crop.append(torch.cat(rows) / torch.where(edge, 2., 1.)[:, None])
+
+        self.crop = torch.stack(crop).to(torch.complex64)
+
+    def setup(self, stage=None):
+
+        super().setup(stage)
+
+        if self.frequency_domain:
+            self.grid_to(self.device)
+
+    def grid_to(self, device):
+
+        self.frequencies = self.frequencies.to(device)
+        if self.crop is not None:
+            self.crop = self.crop.to(device)
+
+    def sample_psi(self, parameters, batch_size):
+
+        return parameters['phic']
+
+    def signal_settings(self):
+
+        return dict(
+            super().signal_settings(),
+            ringdown_size=self.ringdown_size,
+            frequency_domain=self.frequency_domain,
+        )
+
+    def generate_polarizations(self, parameters):
+
+        cross, plus = self.waveform(**parameters)
+
+        return time_domain(cross, plus, self.sample_rate, self.ringdown_size)
+
+    def generate_spectra(self, batch_size, parameters=None, ra=None, dec=None):
+        """
+        Detector responses on the rfft grid of the whitened window,
+        coalescing at the window centre. The model is evaluated on
+        the grid of frequency_grid.
+        """
 
         if parameters is None:
-            # sample from prior and generate waveforms
             parameters = self.prior.sample(batch_size) # dict[str, torch.tensor]
         if ra is None:
             ra = self.ra_prior.sample((batch_size,))
         if dec is None:
             dec = self.dec_prior.sample((batch_size,))
 
-        cross, plus = self.waveform(**parameters)
-        cross, plus = torch.fft.irfft(cross), torch.fft.irfft(plus)
-        # Normalization
-        cross *= self.sample_rate
-        plus *= self.sample_rate
+        # evaluate the model inside its band
+        fs = parameters['fs']
+        if self.frequencies.device != fs.device:
+            self.grid_to(fs.device)
+        frequencies = self.frequencies
+        cross, plus = self.waveform(**dict(parameters, fs=frequencies))
+        polarizations = torch.stack([cross, plus], dim=1)
+
+        # get detector orientations
+        ifos = ['H1', 'L1']
+        tensors, vertices = get_ifo_geometry(*ifos)
+        tensors, vertices = tensors.to(fs.device), vertices.to(fs.device)
+
+        ra, dec = ra.to(fs.device), dec.to(fs.device)
+        theta = torch.pi / 2 - dec
+        psi = self.sample_psi(parameters, batch_size).to(fs.device)
+        antenna_responses = compute_antenna_responses(theta, psi, ra, tensors, ['cross', 'plus'])
+        responses = torch.einsum(
+            'bpi,bpf->bif', antenna_responses.to(polarizations.dtype), polarizations
+        )
 
-        # roll the waveforms to join
-        # the coalescence and ringdown
-        cross = torch.roll(cross, -self.ringdown_size, dims=-1)
-        plus = torch.roll(plus, -self.ringdown_size, dims=-1)
+        # geocenter to detector delay and the shift to the window
+        # centre as one phase ramp
+        omega = torch.stack([
+            torch.sin(theta) * torch.cos(ra),
+            torch.sin(theta) * torch.sin(ra),
+            torch.cos(theta)
+        ], dim=-1)
+        delays = -(omega[:, None] * vertices).sum(-1) / C
+        delays = delays + (self.grid_size - self.window_size / 2) / self.sample_rate
+        responses = responses * torch.exp(
+            -2j * torch.pi * frequencies * delays[..., None]
+        )
 
-        # compute detector responses
-        responses = compute_observed_strain(
-            # parameters['dec'],
-            dec,
-            parameters['phic'], # psi
-            # parameters['ra'],
-            ra,
-            tensors,
-            vertices,
-            self.sample_rate,
-            cross=cross.float(),
-            plus=plus.float()
-        ).to('cuda')
+        # continuous Fourier amplitude to the forward normalized rfft
+        responses = responses * self.sample_rate / self.grid_size
+
+        if self.crop is not None:
+            crop = self.crop.to(responses.dtype)
+            spectra = responses @ crop[0] + responses.conj() @ crop[1]
+
+        else:
+            spectra = torch.zeros(
+                (batch_size, len(ifos), self.window_size // 2 + 1),
+                dtype=responses.dtype,
+                device=responses.device
+            )
+            spectra[..., self.band.to(responses.device)] = responses
+
+        return spectra.to(self.device)
+
+    def generate_waveforms(self, batch_size, parameters=None, ra=None, dec=None):
+
+        if self.frequency_domain:
+            return self.generate_spectra(batch_size, parameters, ra, dec)
+
+        return super().generate_waveforms(batch_size, parameters, ra, dec)
+
+    def inject(self, batch, waveforms, psds=None, whitened=False, return_snrs=False):
+
+        if not self.frequency_domain:
+            return super().inject(batch, waveforms, psds, whitened, return_snrs)
+
+        if whitened:
+            # the cached windows are already whitened
+            waveforms = torch.fft.irfft(waveforms, n=self.window_size, norm='forward')
+            return super().inject(batch, waveforms.float(), psds, whitened, return_snrs)
+
+        if psds is None:
+            psd_data, batch = self.preprocessor.split(batch)
+            psds = self.preprocessor.psd(psd_data)
+
+        snrs = None
+        if self.snr_prior is not None or return_snrs:
+            snrs = self.preprocessor.spectrum_snr(waveforms, psds, batch.shape[-1])[None]
+        waveforms, snrs = self.rescale(waveforms[None], snrs)
+
+        spectra = self.preprocessor.rfft(batch) + waveforms[0]
+        injected = self.preprocessor.whiten_spectrum(spectra, psds, batch.shape[-1])
 
-        return responses
+        if return_snrs:
+            return injected, snrs[0]
 
+        return injected
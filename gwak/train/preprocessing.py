@@ -0,0 +1,330 @@
+import time
+import h5py
+import logging
+from pathlib import Path
+from typing import Optional
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from ml4gw.transforms import SpectralDensity, Whiten
+from ml4gw.spectral import truncate_inverse_power_spectrum
+from ml4gw.gw import compute_network_snr
+
+
+class WhiteningStage(torch.nn.Module):
+    """
+    PSD estimation and whitening of a batch of background kernels.
+
+    The batch is split into the leading psd_length part used for the
+    median PSD and the trailing kernel_length + fduration part that is
+    whitened. Built once per datamodule in setup and moved to the
+    trainer's device, so the window and filter buffers are not
+    reallocated every batch.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int,
+        kernel_length: float,
+        fduration: float,
+        fftlength: float,
+        highpass: float = 30,
+    ):
+        super().__init__()
+        self.split_size = int((kernel_length + fduration) * sample_rate)
+
+        # psd estimator
+        # takes tensor of shape (batch_size, num_ifos, psd_length)
+        self.spectral_density = SpectralDensity(
+            sample_rate,
+            fftlength,
+            average = 'median'
+        )
+
+        self.whitener = Whiten(
+            fduration,
+            sample_rate,
+            highpass = highpass,
+        )
+
+    def split(self, batch):
+
+        # split batch into psd data and data to be whitened
+        splits = [batch.size(-1) - self.split_size, self.split_size]
+        return torch.split(batch, splits, dim=-1)
+
+    def psd(self, psd_data):
+
+        return self.spectral_density(psd_data.double())
+
+    def whiten(self, batch, psds, normalize=True):
+
+        whitened = self.whitener(batch.double(), psds.double())
+
+        if normalize:
+            whitened = self.normalize(whitened)
+
+        return whitened
+
+    def normalize(self, whitened):
+
+        # normalize the input data
+        stds = torch.std(whitened, dim=-1, keepdim=True)
+
+        return whitened / stds
+
+    def rfft(self, batch):
+
+        # the normalization of ml4gw's whitening
+        batch = batch - batch.mean(-1, keepdim=True)
+
+        return torch.fft.rfft(batch.double(), norm='forward', dim=-1)
+
+    def whiten_spectrum(self, spectrum, psds, n):
+        """
+        Whiten the rfft of a batch of n samples with the same
+        truncated filter as whiten, with a single inverse FFT.
+        """
+
+        psds = psds.double()
+        while psds.ndim < 3:
+            psds = psds[None]
+        if psds.size(-1) != spectrum.size(-1):
+            psds = F.interpolate(psds, size=(spectrum.size(-1),), mode='linear')
+
+        psds = truncate_inverse_power_spectrum(
+            psds,
+            self.whitener.window,
+            self.whitener.sample_rate,
+            self.whitener.highpass,
+            self.whitener.lowpass
+        )
+        spectrum = spectrum * torch.nan_to_num(psds**-0.5)
+
+        whitened = torch.fft.irfft(spectrum, n=n, norm='forward', dim=-1)
+        whitened = whitened.float() / self.whitener.sample_rate**0.5
+
+        # crop the filter settle-in and normalize like whiten
+        pad = self.whitener.window.size(-1) // 2
+
+        return self.normalize(whitened[..., pad:-pad])
+
+    def snr(self, waveforms, psds):
+        """
+        Optimal network SNR of waveforms shaped (batch, ifos, n)
+        against the per sample PSDs, above the whitening highpass.
+        """
+
+        return compute_network_snr(
+            waveforms.double(),
+            psds.double(),
+            self.whitener.sample_rate,
+            self.whitener.highpass
+        )
+
+    def spectrum_snr(self, spectra, psds, n):
+        """
+        snr of waveforms given as the rfft of n samples, normalized
+        like rfft.
+        """
+
+        psds = psds.double()
+        if psds.size(-1) != spectra.size(-1):
+            psds = F.interpolate(psds, size=(spectra.size(-1),), mode='linear')
+
+        # forward normalized rfft to the continuous Fourier amplitude
+        sample_rate = self.whitener.sample_rate
+        power = (spectra.abs().double() * n / sample_rate)**2 / psds
+
+        frequencies = torch.fft.rfftfreq(n, 1 / sample_rate).to(power.device)
+        power = power * (frequencies >= self.whitener.highpass)
+
+        return (4 * power.sum(-1) * sample_rate / n).sum(-1)**0.5
+
+    def cut_kernels(self, chunks, kernels_per_chunk, batch_size):
+        """
+        Estimate one PSD from the leading psd_length of every chunk and
+        cut the rest into kernels_per_chunk adjacent kernels of
+        kernel_length + fduration. Returns batch_size kernels with the
+        PSD of the chunk each was cut from.
+        """
+
+        psd_data, rest = torch.split(
+            chunks,
+            [chunks.size(-1) - kernels_per_chunk * self.split_size, kernels_per_chunk * self.split_size],
+            dim=-1
+        )
+        psds = self.psd(psd_data)
+
+        # (chunks, ifos, kernels * size) -> (chunks * kernels, ifos, size)
+        n_chunks, n_ifos = rest.shape[:2]
+        kernels = rest.reshape(n_chunks, n_ifos, kernels_per_chunk, self.split_size)
+        kernels = kernels.transpose(1, 2).reshape(-1, n_ifos, self.split_size)
+        psds = psds.repeat_interleave(kernels_per_chunk, dim=0)
+
+        return kernels[:batch_size], psds[:batch_size]
+
+    def forward(self, batch, waveforms=None, psds=None):
+
+        # with precomputed psds the batch holds only the part to whiten
+        if psds is None:
+            psd_data, batch = self.split(batch)
+            psds = self.psd(psd_data)
+
+        if waveforms is not None:
+            batch = batch + waveforms
+
+        return self.whiten(batch, psds)
+
+
+class WhitenedCache:
+    """
+    Whitened, not yet normalized, background windows with the PSDs
+    they were whitened with, kept in RAM or, with cache_dir, in local
+    memmaps. Whitening is linear, so a whitened signal added to a
+    cached window and normalized equals whitening the injected raw
+    window.
+    """
+
+    def __init__(self, size: int, cache_dir: Optional[Path] = None):
+
+        self.size = size
+        self.cache_dir = cache_dir
+        self.n_filled = 0
+        self.windows = None
+        self.psds = None
+
+    def allocate(self, shape, dtype):
+
+        if self.cache_dir is None:
+            return torch.empty(shape, dtype=dtype)
+
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        name = 'windows' if self.windows is None else 'psds'
+        array = np.lib.format.open_memmap(
+            Path(self.cache_dir) / f'{name}.npy',
+            mode='w+',
+            dtype=torch.empty(0, dtype=dtype).numpy().dtype,
+            shape=shape
+        )
+
+        return torch.from_numpy(array)
+
+    @property
+    def full(self):
+        return self.n_filled == self.size
+
+    def add(self, windows, psds):
+
+        windows, psds = windows.cpu(), psds.cpu()
+        if self.windows is None:
+            self.windows = self.allocate((self.size, *windows.shape[1:]), windows.dtype)
+            self.psds = self.allocate((self.size, *psds.shape[1:]), psds.dtype)
+
+        # fill in order, then replace random entries
+        n_fill = min(len(windows), self.size - self.n_filled)
+        idx = torch.arange(self.n_filled, self.n_filled + n_fill)
+        idx = torch.cat([idx, torch.randint(self.size, (len(windows) - n_fill,))])
+        self.n_filled += n_fill
+
+        self.windows[idx] = windows
+        self.psds[idx] = psds
+
+    def sample(self, n):
+
+        idx = torch.randint(self.n_filled, (n,))
+
+        return self.windows[idx], self.psds[idx]
+
+
+def build_psd_index(
+    fnames: list,
+    channels: list,
+    sample_rate: int,
+    psd_length: float,
+    fftlength: float,
+    stride: float,
+    chunk_size: int = 256,
+):
+    """
+    Write a `psd` group next to the strain of every background file
+    holding, per channel, the median PSD of psd_length seconds starting
+    every stride seconds. Files with an up to date index are skipped.
+    """
+
+    spectral_density = SpectralDensity(sample_rate, fftlength, average='median')
+    attrs = dict(
+        sample_rate=sample_rate,
+        psd_length=psd_length,
+        fftlength=fftlength,
+        stride=stride
+    )
+
+    for fname in fnames:
+
+        with h5py.File(fname, 'a') as f:
+
+            if 'psd' in f and all(f['psd'].attrs.get(k) == v for k, v in attrs.items()):
+                continue
+
+            logging.info(f'Building the PSD index of {fname}')
+            if 'psd' in f:
+                del f['psd']
+
+            g = f.create_group('psd')
+            g.attrs.update(attrs)
+
+            for channel in channels:
+
+                x = torch.from_numpy(f[channel][:]).double()
+                windows = x.unfold(0, int(psd_length * sample_rate), int(stride * sample_rate))
+
+                psds = []
+                for i in range(0, len(windows), chunk_size):
+                    psd = spectral_density(windows[i:i + chunk_size, None])
+                    # float64, strain PSDs underflow float32
+                    psds.append(psd[:, 0].numpy())
+
+                g.create_dataset(channel, data=np.concatenate(psds))
+
+
+class BatchTimer:
+    """
+    Measure the wall time of the preprocessing of every interval-th
+    batch and log the mean over the measured batches. Only measured
+    batches synchronize the device.
+    """
+
+    def __init__(self, name: str, interval: int = 100):
+
+        self.logger = logging.getLogger(name)
+        self.interval = interval
+        self.n_calls = 0
+        self.times = []
+
+    @contextmanager
+    def __call__(self, device: torch.device):
+
+        self.n_calls += 1
+        if self.interval <= 0 or self.n_calls % self.interval:
+            yield
+            return
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        t0 = time.perf_counter()
+
+        yield
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        self.times.append(time.perf_counter() - t0)
+
+        self.logger.info(
+            f'Preprocessing batch {self.n_calls}: {self.times[-1] * 1e3:.2f} ms '
+            f'(mean {sum(self.times) / len(self.times) * 1e3:.2f} ms '
+            f'over {len(self.times)} measured batches)'
+        )
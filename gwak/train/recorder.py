@@ -0,0 +1,205 @@
+import queue
+import h5py
+import logging
+import threading
+from pathlib import Path
+
+import torch
+
+
+def recorder_file(file_name: Path, rank: int = 0, stage: str = None):
+    """
+    One recording per rank and per stage other than fit, so a later
+    stage does not overwrite the recording of fit.
+    """
+
+    file_name = Path(file_name)
+    suffix = f"_{stage}" if stage not in (None, "fit") else ""
+    if rank > 0:
+        suffix += f"_rank{rank}"
+
+    return file_name.with_name(f"{file_name.stem}{suffix}{file_name.suffix}")
+
+
+class BatchRecorder:
+    """
+    Record tensors of every-th step to an HDF5 file from a background
+    thread.
+
+    record only queues a copy of the tensor: device tensors are copied
+    without synchronizing to pinned host buffers, reused per name and
+    shape, and the writer waits for the copy. Every name is appended
+    to a resizable, compressed `<name>/data` dataset with the steps in
+    `<name>/step`. When the bounded queue is full record waits up to
+    put_timeout seconds for the writer. A record that still does not
+    fit, or arrives after the writer failed, is dropped with a warning,
+    so recording never stalls training.
+    """
+
+    def __init__(
+        self,
+        file_name: Path,
+        every: int = 1,
+        max_queue: int = 16,
+        grow_size: int = 64,
+        compression: str = "gzip",
+        put_timeout: float = 60,
+    ):
+
+        self.file_name = Path(file_name)
+        self.every = every
+        self.grow_size = grow_size
+        self.compression = compression
+        self.put_timeout = put_timeout
+        self.n_dropped = 0
+
+        self.logger = logging.getLogger("BatchRecorder")
+        # validation batches are counted here, the trainer only
+        # counts optimizer steps
+        self.validation_step = 0
+        # free pinned buffers per (name, shape, dtype)
+        self.buffers = {}
+        self.buffer_lock = threading.Lock()
+
+        self.file_name.parent.mkdir(parents=True, exist_ok=True)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def record(self, name: str, tensor: torch.Tensor, step: int):
+
+        if self.every <= 0 or step % self.every:
+            return
+
+        if not self.thread.is_alive():
+            self.drop(name, step, "the writer stopped")
+            return
+
+        tensor = tensor.detach()
+        key, event = None, None
+        if tensor.is_cuda:
+            key = (name, tuple(tensor.shape), tensor.dtype)
+            host = self.buffer(key)
+            host.copy_(tensor, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host = tensor.clone()
+
+        try:
+            self.queue.put((name, step, host, event, key), timeout=self.put_timeout)
+        except queue.Full:
+            if key is not None:
+                self.release(key, host)
+            self.drop(name, step, f"the writer is {self.put_timeout}s behind")
+
+    def drop(self, name, step, reason):
+
+        self.n_dropped += 1
+        self.logger.warning(f"Dropped {name} at step {step}, {reason}, {self.n_dropped} dropped so far")
+
+    def buffer(self, key):
+
+        with self.buffer_lock:
+            free = self.buffers.setdefault(key, [])
+            if free:
+                return free.pop()
+
+        _, shape, dtype = key
+        return torch.empty(shape, dtype=dtype, pin_memory=True)
+
+    def release(self, key, host):
+
+        # back to the pool once written
+        with self.buffer_lock:
+            self.buffers[key].append(host)
+
+    def record_step(self, trainer, **tensors):
+        """
+        Record tensors as Training/<key> or Validation/<key> at the
+        current step of trainer.
+        """
+
+        if trainer.training:
+            prefix, step = "Training", trainer.global_step
+        elif trainer.validating:
+            prefix, step = "Validation", self.validation_step
+            self.validation_step += 1
+        else:
+            return
+
+        for key, tensor in tensors.items():
+            self.record(f"{prefix}/{key}", tensor, step)
+
+    def append(self, f, counts, name, step, data):
+
+        if name not in counts:
+
+            group = f.create_group(name)
+            group.create_dataset(
+                "data",
+                shape=(0, *data.shape),
+                maxshape=(None, *data.shape),
+                chunks=(1, *data.shape),
+                dtype=data.dtype,
+                compression=self.compression,
+            )
+            group.create_dataset("step", shape=(0,), maxshape=(None,), dtype="i8")
+            counts[name] = 0
+
+        dataset, steps = f[name]["data"], f[name]["step"]
+        if dataset.shape[1:] != data.shape:
+            self.logger.warning(f"Skipping {name} at step {step}, shape {data.shape} != {dataset.shape[1:]}")
+            return
+
+        # grow in blocks, trimmed to the recorded length on close
+        n = counts[name]
+        if n == len(dataset):
+            dataset.resize(n + self.grow_size, axis=0)
+            steps.resize(n + self.grow_size, axis=0)
+
+        dataset[n] = data
+        steps[n] = step
+        counts[name] = n + 1
+
+    def write(self):
+
+        try:
+            self.write_items()
+        except Exception:
+            # record drops everything from here on
+            self.logger.exception(f"Recording to {self.file_name} failed")
+
+    def write_items(self):
+
+        counts = {}
+        with h5py.File(self.file_name, "w") as f:
+
+            while True:
+
+                item = self.queue.get()
+                if item is None:
+                    break
+
+                name, step, host, event, key = item
+                try:
+                    if event is not None:
+                        event.synchronize()
+                    self.append(f, counts, name, step, host.numpy())
+                except Exception:
+                    self.logger.exception(f"Failed to record {name} at step {step}")
+                finally:
+                    if key is not None:
+                        self.release(key, host)
+
+            for name, n in counts.items():
+                f[name]["data"].resize(n, axis=0)
+                f[name]["step"].resize(n, axis=0)
+
+    def close(self):
+
+        if not self.thread.is_alive():
+            return
+
+        self.queue.put(None)
+        self.thread.join()
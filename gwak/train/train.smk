@@ -1,6 +1,6 @@
 import os
 
-signalclasses = ['bbh', 'sine_gaussian', 'sine_gaussian_lf', 'sine_gaussian_hf', 'kink', 'kinkkink', 'white_noise_burst', 'gaussian', 'cusp']
+signalclasses = ['bbh', 'sine_gaussian', 'sine_gaussian_lf', 'sine_gaussian_hf', 'kink', 'kinkkink', 'white_noise_burst', 'gaussian', 'cusp', 'mixture']
 backgroundclasses = ['background', 'glitches']
 dataclasses = signalclasses+backgroundclasses
 
@@ -19,6 +19,7 @@ CLI = {
     'white_noise_burst': 'train/cli_signal.py',
     'gaussian': 'train/cli_signal.py',
     'cusp': 'train/cli_signal.py',
+    'mixture': 'train/cli_base.py',
     }
 
 rule train_gwak1:
@@ -0,0 +1,224 @@
+import json
+import logging
+
+import numpy as np
+import torch
+
+from typing import Optional
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def time_domain(cross, plus, sample_rate: int, ringdown_size: int):
+    """
+    Time domain polarizations of a frequency domain model with the
+    coalescence rolled ringdown_size samples from the end.
+    """
+
+    cross, plus = torch.fft.irfft(cross), torch.fft.irfft(plus)
+    # Normalization
+    cross *= sample_rate
+    plus *= sample_rate
+
+    # roll the waveforms to join
+    # the coalescence and ringdown
+    cross = torch.roll(cross, -ringdown_size, dims=-1)
+    plus = torch.roll(plus, -ringdown_size, dims=-1)
+
+    return cross, plus
+
+
+def generate_chunk(
+    prior,
+    waveform: torch.nn.Module,
+    n_samples: int,
+    seed: int,
+    sample_rate: int,
+    ringdown_size: Optional[int] = None,
+):
+
+    parameters = prior.compile(seed=seed).sample(n_samples)
+
+    with torch.no_grad():
+        cross, plus = waveform(**parameters)
+    if ringdown_size is not None:
+        cross, plus = time_domain(cross, plus, sample_rate, ringdown_size)
+
+    # keep the per sample parameters only
+    parameters = {
+        key: value.numpy() for key, value in parameters.items()
+        if torch.is_tensor(value) and value.shape == (n_samples,)
+    }
+
+    return cross.float().numpy(), plus.float().numpy(), parameters
+
+
+def signal_config(prior, waveform: torch.nn.Module):
+    """
+    The prior and waveform model signals are drawn from, as plain
+    values to compare stored banks and validation sets against. The
+    buffer shapes of the waveform carry its duration.
+    """
+
+    config = dict(
+        prior=type(prior).__name__,
+        distributions={key: repr(value) for key, value in prior.distributions().items()},
+        waveform=type(waveform).__name__,
+        buffers={key: list(value.shape) for key, value in waveform.state_dict().items()},
+    )
+
+    # frequency domain priors fix the frequency grid of the model
+    fs = getattr(prior, "sampled_params", {}).get("fs")
+    if torch.is_tensor(fs):
+        config["fs"] = [len(fs), fs[0].item(), fs[-1].item()]
+
+    return config
+
+
+def bank_config(
+    prior,
+    waveform: torch.nn.Module,
+    n_samples: int,
+    sample_rate: int,
+    ringdown_size: Optional[int] = None,
+):
+    """
+    What a bank was generated from, a bank is only reused for the same
+    configuration.
+    """
+
+    return dict(
+        n_samples=n_samples,
+        sample_rate=sample_rate,
+        ringdown_size=ringdown_size,
+        **signal_config(prior, waveform)
+    )
+
+
+def write_chunk(bank_dir: Path, start: int, *args, **kwargs):
+
+    # one thread per worker process, the pool is the parallelism
+    torch.set_num_threads(1)
+    cross, plus, parameters = generate_chunk(*args, **kwargs)
+    stop = start + len(cross)
+
+    for key, value in [("cross", cross), ("plus", plus)] + list(parameters.items()):
+
+        column = np.load(bank_dir / f"{key}.npy", mmap_mode="r+")
+        column[start:stop] = value
+        column.flush()
+
+    return stop - start
+
+
+def build_waveform_bank(
+    bank_dir: Path,
+    prior,
+    waveform: torch.nn.Module,
+    n_samples: int,
+    sample_rate: int,
+    ringdown_size: Optional[int] = None,
+    chunk_size: int = 1024,
+    max_workers: int = 4,
+    seed: int = 0,
+):
+    """
+    Pre-generate n_samples polarizations of waveform for parameters
+    drawn from prior into one .npy file per column in bank_dir.
+
+    The first chunk is generated here to size the memory-mapped
+    columns, the rest is filled in place by a process pool. bank.json
+    is written last and marks the bank as complete, a complete bank
+    of the same configuration, see bank_config, is not rebuilt.
+    """
+
+    bank_dir = Path(bank_dir)
+    meta_file = bank_dir / "bank.json"
+    config = bank_config(prior, waveform, n_samples, sample_rate, ringdown_size)
+    if meta_file.exists() and json.loads(meta_file.read_text()).get("config") == config:
+        return
+
+    logging.info(f"Building a bank of {n_samples} waveforms in {bank_dir}")
+    bank_dir.mkdir(parents=True, exist_ok=True)
+    meta_file.unlink(missing_ok=True)
+
+    kwargs = dict(
+        prior=prior,
+        waveform=waveform,
+        sample_rate=sample_rate,
+        ringdown_size=ringdown_size
+    )
+    n_first = min(chunk_size, n_samples)
+    cross, plus, parameters = generate_chunk(n_samples=n_first, seed=seed, **kwargs)
+
+    for key, value in [("cross", cross), ("plus", plus)] + list(parameters.items()):
+
+        column = np.lib.format.open_memmap(
+            bank_dir / f"{key}.npy",
+            mode="w+",
+            dtype=value.dtype,
+            shape=(n_samples, *value.shape[1:])
+        )
+        column[:n_first] = value
+        column.flush()
+        del column
+
+    starts = range(n_first, n_samples, chunk_size)
+    with ProcessPoolExecutor(max_workers=max_workers) as e:
+
+        futures = [
+            e.submit(
+                write_chunk,
+                bank_dir,
+                start,
+                n_samples=min(chunk_size, n_samples - start),
+                seed=seed + 1 + i,
+                **kwargs
+            )
+            for i, start in enumerate(starts)
+        ]
+
+        done = n_first
+        for future in as_completed(futures):
+            done += future.result()
+            logging.info(f"Generated {done}/{n_samples} waveforms")
+
+    meta_file.write_text(json.dumps(dict(
+        config=config,
+        length=cross.shape[-1],
+        parameters=list(parameters)
+    )))
+
+
+class WaveformBank:
+    """
+    Memory-mapped view of a bank written by build_waveform_bank.
+    Drawing a batch is a gather of random rows.
+    """
+
+    def __init__(self, bank_dir: Path):
+
+        self.bank_dir = Path(bank_dir)
+        meta = json.loads((self.bank_dir / "bank.json").read_text())
+
+        self.cross = np.load(self.bank_dir / "cross.npy", mmap_mode="r")
+        self.plus = np.load(self.bank_dir / "plus.npy", mmap_mode="r")
+        self.parameters = {
+            key: np.load(self.bank_dir / f"{key}.npy", mmap_mode="r")
+            for key in meta["parameters"]
+        }
+
+    def __len__(self):
+        return len(self.cross)
+
+    def sample(self, batch_size: int):
+
+        # sorted rows read the memory map front to back
+        idx = torch.randint(len(self), (batch_size,)).sort().values.numpy()
+
+        parameters = {
+            key: torch.from_numpy(value[idx])
+            for key, value in self.parameters.items()
+        }
+
+        return parameters, torch.from_numpy(self.cross[idx]), torch.from_numpy(self.plus[idx])
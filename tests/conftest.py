@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pytest
+
+# the train and data stages import their modules flat
+root = Path(__file__).resolve().parents[1]
+for path in [root, root / "gwak" / "train", root / "gwak" / "data"]:
+    sys.path.insert(0, str(path))
+
+
+@pytest.fixture(scope="session")
+def background_dir(tmp_path_factory):
+
+    # five files of white noise, four train and one validation file
+    data_dir = tmp_path_factory.mktemp("background")
+    rng = np.random.default_rng(0)
+    for i in range(5):
+        with h5py.File(data_dir / f"background-{1000 + 100 * i}-64.hdf5", "w") as f:
+            for ifo in ["H1", "L1"]:
+                f.create_dataset(ifo, data=rng.normal(size=64 * 2048) * 1e-21, chunks=(2**14,))
+
+    return data_dir
+
+
+@pytest.fixture
+def loader_kwargs(background_dir):
+
+    return dict(
+        data_dir=background_dir,
+        sample_rate=2048,
+        kernel_length=0.09765625,
+        psd_length=8,
+        fduration=1,
+        fftlength=2,
+        batch_size=4,
+        batches_per_epoch=2,
+        num_workers=0,
+    )
@@ -0,0 +1,51 @@
+import json
+
+import h5py
+import numpy as np
+import pytest
+
+pytest.importorskip("gwpy")
+pytest.importorskip("gwdatafind")
+
+import background
+
+
+def test_manifest_resume(tmp_path, monkeypatch):
+
+    segs = [(1000, 1064), (1100, 1164), (1200, 1264)]
+    fetched = []
+
+    def get_background(seg_start, seg_end, ifos, **kwargs):
+        fetched.append((seg_start, seg_end))
+        return {ifo: np.zeros((seg_end - seg_start) * 16) for ifo in ifos}
+
+    monkeypatch.setattr(background, "get_conincident_segs", lambda **kwargs: segs)
+    monkeypatch.setattr(background, "get_background", get_background)
+
+    # the first segment was finished, the second is listed but its
+    # file is gone and the third was never written
+    with h5py.File(tmp_path / "background-1000-64.h5", "w") as g:
+        g.create_dataset("H1", data=np.ones(64 * 16))
+    (tmp_path / "manifest.json").write_text(
+        json.dumps(["background-1000-64.h5", "background-1100-64.h5"])
+    )
+
+    background.gwak_background(
+        ifos=["H1"],
+        state_flag=["DMT-ANALYSIS_READY:1"],
+        channels=["GDS-CALIB_STRAIN"],
+        frame_type=["HOFT_C00"],
+        ana_start=1000,
+        ana_end=1264,
+        sample_rate=16,
+        save_dir=tmp_path,
+    )
+
+    assert fetched == segs[1:]
+    assert json.loads((tmp_path / "manifest.json").read_text()) == [
+        f"background-{start}-64.h5" for start, _ in segs
+    ]
+    with h5py.File(tmp_path / "background-1000-64.h5", "r") as g:
+        assert (g["H1"][:] == 1).all()
+    for start, _ in segs[1:]:
+        assert (tmp_path / f"background-{start}-64.h5").exists()
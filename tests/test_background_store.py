@@ -0,0 +1,30 @@
+import h5py
+import numpy as np
+import torch
+
+from background_store import StoreTimeSeriesDataset, build_background_store
+
+
+def test_store_batch_matches_the_files(background_dir, tmp_path):
+
+    fnames = sorted(background_dir.glob("*.hdf5"))
+    channels = ["H1", "L1"]
+    path = build_background_store(tmp_path, fnames, channels)
+    assert build_background_store(tmp_path, fnames, channels) == path
+
+    dataset = StoreTimeSeriesDataset(path, kernel_size=300, batch_size=16, batches_per_epoch=1)
+    dataset.data = np.load(path / "data.npy", mmap_mode="r")
+    X = dataset.sample_batch(np.random.default_rng(0))
+
+    # replay the draws and read the same segments from the files
+    rng = np.random.default_rng(0)
+    file_idx = rng.choice(len(fnames), p=dataset.probs, size=(16, len(channels)))
+    positions = rng.integers(dataset.sizes[file_idx] - 300)
+
+    assert X.shape == (16, len(channels), 300)
+    assert X.dtype == torch.float32
+    for b in range(16):
+        for c, channel in enumerate(channels):
+            with h5py.File(fnames[file_idx[b, c]], "r") as f:
+                expected = f[channel][positions[b, c]:positions[b, c] + 300]
+            np.testing.assert_allclose(X[b, c].numpy(), expected.astype(np.float32))
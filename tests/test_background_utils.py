@@ -0,0 +1,124 @@
+import h5py
+import numpy as np
+import pytest
+
+pytest.importorskip("gwpy")
+pytest.importorskip("gwdatafind")
+
+import background_utils
+from background_utils import plan_shards, owned_spans, combine_catalogs, trigger_group, add_source
+from glitch_catalog import glitch_keys
+
+
+@pytest.mark.parametrize("seg", [(1000, 1000 + 10000), (1000, 1000 + 4097), (7, 7 + 12345)])
+def test_plan_shards(seg):
+
+    overlap = 64 + 1 + 0.09765625
+    shards = plan_shards([seg], shard_duration=4096, psd_length=64, fduration=1, kernel_length=0.09765625)
+    shards = sorted(shards)
+
+    assert shards[0][0] == seg[0] and shards[-1][1] == seg[1]
+    for start, end in shards:
+        assert seg[0] <= start and end <= seg[1]
+        assert end - start <= 4096
+
+    for (_, end), (start, _) in zip(shards, shards[1:]):
+        assert end - start >= overlap
+
+
+def test_plan_shards_keeps_short_segments():
+
+    segs = [(0, 50), (100, 1100)]
+    assert plan_shards(segs, 4096, 64, 1, 0.09765625) == [(100, 1100)]
+
+
+def test_owned_spans():
+
+    segs = [(100, 200), (0, 110), (300, 400)]
+    assert owned_spans(segs) == [(105, 200), (0, 105), (300, 400)]
+
+
+def test_combine_catalogs(tmp_path):
+
+    catalogs = {}
+    for i, times in enumerate([[1, 5, 9], [8, 12]]):
+
+        catalog_file = tmp_path / f"Segs_{i:05d}" / "glitch_info.h5"
+        catalog_file.parent.mkdir()
+        with h5py.File(catalog_file, "w") as g:
+            group = trigger_group(g, "H1")
+            triggers = {key: np.zeros(len(times)) for key in glitch_keys}
+            triggers["time"] = np.array(times, dtype=float)
+            add_source(group, "triggers.h5", triggers)
+
+        catalogs[catalog_file] = [(0, 8.5), (8.5, 20)][i]
+
+    output_file = tmp_path / "glitch_info.h5"
+    combine_catalogs(catalogs, output_file, ["H1"])
+    combine_catalogs(catalogs, output_file, ["H1"])
+
+    with h5py.File(output_file, "r") as g:
+        assert list(g["H1/time"][:]) == [1, 5, 12]
+    assert not output_file.with_name("glitch_info.h5.tmp").exists()
+
+
+def test_add_source_tags_rows(tmp_path):
+
+    with h5py.File(tmp_path / "glitch_info.h5", "w") as g:
+
+        group = trigger_group(g, "L1")
+        for name, times in [("a.h5", [1, 3, 5]), ("b.h5", [2, 4])]:
+            triggers = {key: np.zeros(len(times)) for key in glitch_keys}
+            triggers["time"] = np.array(times, dtype=float)
+            add_source(group, name, triggers)
+
+        assert list(group["time"][:]) == [1, 2, 3, 4, 5]
+        assert list(group["source"][:]) == [0, 1, 0, 1, 0]
+        assert list(group["sources"].asstr()[:]) == ["a.h5", "b.h5"]
+
+
+class FakeStrain:
+    """
+    Frame reads of a GPS ramp, so every sample knows its time.
+    """
+
+    def __init__(self, start, end, sample_rate=16):
+        self.times = np.arange(start, end, 1 / sample_rate)
+
+    @classmethod
+    def read(cls, files, channel, start, end, verbose=False):
+        return cls(start, end)
+
+    def resample(self, sample_rate):
+        return self
+
+    def crop(self, start, end):
+        self.times = self.times[(self.times >= start) & (self.times < end)]
+        return self
+
+    @property
+    def value(self):
+        return self.times
+
+
+def test_write_background_streamed(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(background_utils, "TimeSeries", FakeStrain)
+    monkeypatch.setattr(background_utils, "discover_frames", lambda **kwargs: [])
+
+    output_file = background_utils.write_background_streamed(
+        tmp_path / "background.h5",
+        seg_start=1000,
+        seg_end=1100,
+        ifos=["H1", "L1"],
+        frame_type=["HOFT_C00", "HOFT_C00"],
+        channels=["GDS-CALIB_STRAIN", "GDS-CALIB_STRAIN"],
+        sample_rate=16,
+        block_duration=32,
+        dtype="float64",
+    )
+
+    with h5py.File(output_file, "r") as g:
+        for ifo in ["H1", "L1"]:
+            assert g[ifo].compression is None
+            np.testing.assert_array_equal(g[ifo][:], np.arange(1000, 1100, 1 / 16))
@@ -0,0 +1,324 @@
+import h5py
+import json
+import numpy as np
+import pytest
+import lightning.pytorch as pl
+import torch
+
+import dataloader
+from glitch_catalog import GlitchCatalog, glitch_keys
+
+
+class TinyModel(pl.LightningModule):
+
+    def __init__(self):
+        super().__init__()
+        self.layer = torch.nn.Linear(2 * 200, 1)
+
+    def step(self, batch):
+        return self.layer(batch.flatten(1)).square().mean()
+
+    def training_step(self, batch, batch_idx):
+        return self.step(batch)
+
+    def validation_step(self, batch, batch_idx):
+        self.log("val_loss", self.step(batch))
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=1e-3)
+
+
+def test_fit_with_validation(loader_kwargs, tmp_path):
+
+    datamodule = dataloader.GwakBaseDataloader(
+        data_saving_file=tmp_path / "batches.h5", **loader_kwargs
+    )
+    trainer = pl.Trainer(
+        accelerator="cpu",
+        max_epochs=2,
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        default_root_dir=tmp_path,
+    )
+    trainer.fit(TinyModel(), datamodule=datamodule)
+
+    with h5py.File(tmp_path / "batches.h5", "r") as f:
+        assert f["Training/BK/data"].shape == (4, 4, 2, 200)
+        assert f["Validation/BK/data"].shape == (4, 4, 2, 200)
+
+
+@pytest.mark.parametrize("use_store", [False, True])
+def test_glitch_dataset(background_dir, tmp_path, use_store):
+
+    # triggers every 5 s in the first two files
+    times = np.concatenate([np.arange(1010, 1060, 5), np.arange(1110, 1160, 5)]).astype(float)
+    with h5py.File(tmp_path / "glitch_info.h5", "w") as g:
+        for ifo in ["H1", "L1"]:
+            for key in glitch_keys:
+                g.create_dataset(f"{ifo}/{key}", data=times if key == "time" else np.full(len(times), 10.0))
+
+    catalogs = {ifo: GlitchCatalog(tmp_path / "glitch_info.h5", ifo) for ifo in ["H1", "L1"]}
+    fnames = sorted(background_dir.glob("*.hdf5"))
+    store = None
+    if use_store:
+        store = dataloader.build_background_store(tmp_path / "store", fnames, channels=["H1", "L1"])
+
+    dataset = dataloader.GlitchTimeSeriesDataset(
+        fnames,
+        channels=["H1", "L1"],
+        kernel_size=400,
+        center=200,
+        jitter=0,
+        batch_size=8,
+        batches_per_epoch=2,
+        catalogs=catalogs,
+        sample_rate=2048,
+        store=store,
+    )
+    assert len(dataset.fnames) == 2
+
+    # without jitter every kernel is the strain around a trigger
+    windows = []
+    for fname, t0 in zip(fnames[:2], [1000, 1100]):
+        with h5py.File(fname, "r") as f:
+            strain = np.stack([f["H1"][:], f["L1"][:]]).astype(np.float32)
+        for t in times:
+            start = int(round((t - t0) * 2048)) - 200
+            if 0 <= start and start + 400 <= strain.shape[-1]:
+                windows.append(strain[:, start:start + 400])
+    windows = np.stack(windows)
+
+    for batch in dataset:
+        assert batch.shape == (8, 2, 400)
+        for kernel in batch.numpy():
+            assert np.any(np.all(windows == kernel, axis=(1, 2)))
+
+
+def test_stored_channels(tmp_path):
+
+    fnames = []
+    for i in range(3):
+
+        fname = tmp_path / f"background-{i}.h5"
+        with h5py.File(fname, "w") as f:
+            for ifo in ["H1", "L1"]:
+                f.create_dataset(ifo, data=np.zeros(16))
+                if i:
+                    f.create_dataset(f"decimated/1024/{ifo}", data=np.zeros(8))
+        fnames.append(fname)
+
+    channels = dataloader.stored_channels(fnames[1:], ["H1", "L1"], 1024)
+    assert channels == ["decimated/1024/H1", "decimated/1024/L1"]
+    assert dataloader.stored_channels(fnames[:1], ["H1", "L1"], 1024) == ["H1", "L1"]
+
+    with pytest.raises(ValueError):
+        dataloader.stored_channels(fnames, ["H1", "L1"], 1024)
+
+
+def test_frequency_domain_signals_do_not_wrap(loader_kwargs):
+
+    from ml4gw.waveforms import IMRPhenomPv2
+    from prior import LAL_BBHPrior
+
+    # an 8 s grid is much longer than the 1.1 s whitened window
+    loader = dataloader.BBHDataloader(
+        0.9, LAL_BBHPrior(duration=8), IMRPhenomPv2(), frequency_domain=True, **loader_kwargs
+    )
+    spectra = loader.generate_spectra(4)
+    strain = torch.fft.irfft(spectra, n=loader.window_size, norm='forward')
+
+    # nothing of the early inspiral ends up after the merger
+    peak = strain.abs().amax(-1)
+    assert torch.all(strain[..., -300:].abs().amax(-1) < 0.05 * peak)
+
+
+def test_validation_set_follows_the_signal(loader_kwargs, tmp_path):
+
+    from ml4gw.waveforms import SineGaussian
+    from prior import SineGaussianHighFrequency, SineGaussianLowFrequency
+
+    def validate(prior):
+
+        datamodule = dataloader.SignalDataloader(
+            prior, SineGaussian(sample_rate=2048, duration=1.1), val_file=tmp_path / "validation.h5", **loader_kwargs
+        )
+        trainer = pl.Trainer(accelerator="cpu", logger=False, enable_progress_bar=False)
+        trainer.validate(TinyModel(), datamodule=datamodule)
+
+        with h5py.File(tmp_path / "validation.h5", "r") as f:
+            group = f["SignalDataloader"]
+            return json.loads(group.attrs["config"]), group["metadata/frequency"][:]
+
+    config, frequency = validate(SineGaussianHighFrequency())
+    assert frequency.min() >= 512
+
+    # the same settings reuse the set
+    assert validate(SineGaussianHighFrequency())[1].tolist() == frequency.tolist()
+
+    # another prior under the same group rebuilds it
+    rebuilt, frequency = validate(SineGaussianLowFrequency())
+    assert rebuilt["signal"]["distributions"] != config["signal"]["distributions"]
+    assert frequency.max() <= 512
+
+
+def test_glitch_reads_overlapping_kernels(background_dir, tmp_path):
+
+    with h5py.File(tmp_path / "glitch_info.h5", "w") as g:
+        for ifo in ["H1", "L1"]:
+            for key in glitch_keys:
+                g.create_dataset(f"{ifo}/{key}", data=np.array([1030.0, 1130.0]))
+
+    fnames = sorted(background_dir.glob("*.hdf5"))
+    dataset = dataloader.GlitchTimeSeriesDataset(
+        fnames[:2],
+        channels=["H1", "L1"],
+        kernel_size=400,
+        center=200,
+        jitter=0,
+        batch_size=8,
+        batches_per_epoch=1,
+        catalogs={ifo: GlitchCatalog(tmp_path / "glitch_info.h5", ifo) for ifo in ["H1", "L1"]},
+        sample_rate=2048,
+    )
+
+    # unsorted, overlapping and repeated kernels of both files
+    file_idx = np.array([1, 0, 0, 1, 0])
+    starts = np.array([500, 900, 100, 100, 100])
+    X = dataset.read(file_idx, starts)
+
+    for kernel, i, start in zip(X, file_idx, starts):
+        with h5py.File(fnames[i], "r") as f:
+            expected = np.stack([f[ifo][start:start + 400] for ifo in ["H1", "L1"]])
+        np.testing.assert_array_equal(kernel, expected.astype(np.float32))
+
+
+def test_frequency_domain_needs_a_single_view(loader_kwargs):
+
+    from ml4gw.waveforms import IMRPhenomPv2
+    from prior import LAL_BBHPrior
+
+    signal_class = dataloader.BBHDataloader(
+        0.9, LAL_BBHPrior(), IMRPhenomPv2(), frequency_domain=True, **loader_kwargs
+    )
+    with pytest.raises(ValueError):
+        dataloader.AugmentationSignalDataloader(signal_class, LAL_BBHPrior(), **loader_kwargs)
+    with pytest.raises(ValueError):
+        dataloader.MixtureDataloader([signal_class], **loader_kwargs)
+
+
+def test_snr_scale_keeps_view_ratios(loader_kwargs):
+
+    from ml4gw.waveforms import SineGaussian
+    from prior import SineGaussianHighFrequency
+
+    loader = dataloader.SignalDataloader(
+        SineGaussianHighFrequency(),
+        SineGaussian(sample_rate=2048, duration=1.1),
+        snr_prior=torch.distributions.Uniform(10, 10 + 1e-6),
+        **loader_kwargs
+    )
+
+    # two views of three signals, the second view twice as loud
+    snrs = torch.tensor([[2., 5., 0.], [4., 10., 3.]])
+    waveforms, scaled = loader.rescale(torch.ones(2, 3, 2, 8), snrs)
+
+    torch.testing.assert_close(scaled[0], torch.tensor([10., 10., 0.]))
+    torch.testing.assert_close(scaled[1], torch.tensor([20., 20., 0.]))
+    torch.testing.assert_close(waveforms[0, :, 0, 0], waveforms[1, :, 0, 0])
+
+
+def test_psd_index_precedes_windows(tmp_path):
+
+    # ramps, so the first sample of a window is its position
+    fnames = []
+    for i in range(2):
+        fname = tmp_path / f"background-{i}.h5"
+        with h5py.File(fname, "w") as f:
+            for ifo in ["H1", "L1"]:
+                f.create_dataset(ifo, data=np.arange(20 * 64, dtype=float))
+                f.create_dataset(f"psd/{ifo}", data=np.arange(10, dtype=float)[:, None].repeat(5, 1))
+            f["psd"].attrs["stride"] = 2
+        fnames.append(fname)
+
+    dataset = dataloader.PsdIndexedDataset(
+        fnames, ["H1", "L1"], kernel_size=64, batch_size=256, batches_per_epoch=1, psd_length=4, sample_rate=64
+    )
+    X, P = dataset.sample_batch()
+
+    starts = X[..., 0].numpy()
+    assert starts.min() >= 4 * 64 and starts.max() <= 20 * 64 - 64
+
+    # the PSD grid position of the psd_length before the window
+    np.testing.assert_allclose(P[..., 0].numpy(), np.clip((starts / 64 - 4) / 2, 0, 9), rtol=1e-6)
+
+
+@pytest.mark.parametrize('whitened', [False, True])
+def test_inject_views_matches_separate_injections(loader_kwargs, whitened):
+
+    from ml4gw.waveforms import SineGaussian
+    from preprocessing import WhiteningStage
+    from prior import SineGaussianHighFrequency
+
+    loader = dataloader.SignalDataloader(
+        SineGaussianHighFrequency(),
+        SineGaussian(sample_rate=2048, duration=1.1),
+        **loader_kwargs
+    )
+    loader.preprocessor = WhiteningStage(2048, 0.09765625, 1, 2)
+
+    generator = torch.Generator().manual_seed(0)
+    batch = torch.randn(4, 2, 9 * 2048 + 200, generator=generator)
+    waveforms = torch.randn(2, 4, 2, 100, generator=generator)
+
+    psds, raw = None, batch
+    if whitened:
+        batch, psds = loader.whiten_background(batch)
+
+    injected = loader.inject_views(batch, waveforms, psds, whitened=whitened)
+
+    assert injected.shape == (2, 4, 2, 200)
+    for view in range(2):
+        torch.testing.assert_close(
+            injected[view], loader.inject(batch, waveforms[view], psds, whitened=whitened)
+        )
+
+        # without an snr_prior the injections are scaled by 100
+        expected = loader.preprocessor(raw, waveforms=100 * loader.pad(waveforms[view]))
+        torch.testing.assert_close(injected[view], expected, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('weights', [[1, 0], [1, 1]])
+def test_mixture_labels_follow_their_source(loader_kwargs, weights):
+
+    from ml4gw.waveforms import SineGaussian
+    from prior import SineGaussianHighFrequency, SineGaussianLowFrequency
+
+    signal_classes = [
+        dataloader.SignalDataloader(prior, SineGaussian(sample_rate=2048, duration=1.1), **loader_kwargs)
+        for prior in [SineGaussianHighFrequency(), SineGaussianLowFrequency()]
+    ]
+    mixture = dataloader.MixtureDataloader(signal_classes, weights=weights, **loader_kwargs)
+    mixture.setup()
+
+    # keep the views every class generated, in the order of its samples
+    generated = {}
+    for label, signal_class in enumerate(signal_classes):
+        def scale_views(views, psds, return_snrs=False, label=label, scale=signal_class.scale_views):
+            views, snrs = scale(views, psds, return_snrs)
+            generated[label] = views
+            return views, snrs
+        signal_class.scale_views = scale_views
+
+    torch.manual_seed(0)
+    batch = torch.randn(32, 2, 9 * 2048 + 200)
+    _, labels, waveforms, _ = mixture.inject_mixture(batch)
+
+    assert labels.shape == (32,)
+    if weights[1] == 0:
+        assert (labels == 0).all()
+        assert list(generated) == [0]
+
+    for label, views in generated.items():
+        torch.testing.assert_close(waveforms[:, labels == label], views)
+    assert set(labels.tolist()) == set(generated)
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+import pytest
+
+pytest.importorskip("gwpy")
+pytest.importorskip("gwdatafind")
+
+import excess_power as excess_power_module
+from excess_power import find_file_triggers
+from glitch_catalog import glitch_keys
+
+
+def test_file_tail_is_searched(tmp_path):
+
+    sample_rate, duration = 1024, 100
+    t = np.arange(duration * sample_rate) / sample_rate
+    strain = np.random.default_rng(0).normal(size=len(t))
+
+    # a loud burst past the last full stride of blocks
+    t_glitch = 95
+    strain += 50 * np.exp(-((t - t_glitch) / 0.02) ** 2) * np.sin(2 * np.pi * 100 * t)
+
+    fname = tmp_path / f"background-1000-{duration}.h5"
+    with h5py.File(fname, "w") as h:
+        h.create_dataset("H1", data=strain)
+
+    triggers = find_file_triggers(
+        fname,
+        ifos=["H1"],
+        sample_rate=sample_rate,
+        q_range=[4, 64],
+        frequency_range=[32, 256],
+        cluster_dt=0.5,
+        segment_duration=32,
+        overlap_duration=4,
+        mismatch_max=0.2,
+        snr_threshold=8,
+    )["H1"]
+
+    loudest = np.argmax(triggers["snr"])
+    assert triggers["time"][loudest] == pytest.approx(1000 + t_glitch, abs=0.1)
+    assert np.all(np.diff(np.sort(triggers["time"])) > 0)
+
+
+def test_overlapping_files_keep_their_triggers_once(tmp_path, monkeypatch):
+
+    # one trigger every second of two files overlapping by 10 s
+    def fake_triggers(fname, ifos, sample_rate, **kwargs):
+        start, duration = map(int, fname.stem.split("-")[-2:])
+        time = np.arange(start, start + duration, dtype=float)
+        return {ifo: {key: time if key == "time" else np.zeros(len(time)) for key in glitch_keys} for ifo in ifos}
+
+    monkeypatch.setattr(excess_power_module, "find_file_triggers", fake_triggers)
+    monkeypatch.setattr(excess_power_module, "ProcessPoolExecutor", ThreadPoolExecutor)
+    for start in [1000, 1090]:
+        (tmp_path / f"background-{start}-100.h5").touch()
+
+    output_file = excess_power_module.excess_power(tmp_path, ["H1"], 2048, max_workers=1)
+
+    with h5py.File(output_file, "r") as g:
+        time = np.sort(g["H1"]["time"][:])
+    np.testing.assert_array_equal(time, np.arange(1000, 1190, dtype=float))
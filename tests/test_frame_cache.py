@@ -0,0 +1,46 @@
+from frame_cache import FrameCache, open_frame_cache
+
+
+def frame_dir(tmp_path):
+
+    frames = tmp_path / "frames"
+    frames.mkdir()
+    for gps in range(1000, 2000, 100):
+        (frames / f"H-H1_HOFT_C00-{gps}-100.gwf").touch()
+
+    return frames
+
+
+def test_lookup_inside_known_span(tmp_path):
+
+    cache = FrameCache(tmp_path / "cache.json", frame_dir=frame_dir(tmp_path))
+    urls = cache.find_urls("H", "H1_HOFT_C00", 1000, 1500)
+    assert len(urls) == 5
+
+    # answered from the entries without globbing again
+    cache.discover = None
+    assert cache.find_urls("H", "H1_HOFT_C00", 1150, 1250) == urls[1:3]
+
+    # no temporary files left next to the cache
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["cache.json", "frames"]
+
+
+def test_entries_are_shared(tmp_path):
+
+    frames = frame_dir(tmp_path)
+    first = FrameCache(tmp_path / "cache.json", frame_dir=frames)
+    second = FrameCache(tmp_path / "cache.json", frame_dir=frames)
+
+    first.find_urls("H", "H1_HOFT_C00", 1000, 1500)
+    second.find_urls("H", "H1_HOFT_C00", 1500, 1900)
+
+    # a miss in first picks up the span second saved
+    first.discover = None
+    assert len(first.find_urls("H", "H1_HOFT_C00", 1600, 1700)) == 1
+    assert len(first.entries["H/H1_HOFT_C00/file"]) == 1
+
+
+def test_open_frame_cache_once(tmp_path):
+
+    cache_file = str(tmp_path / "cache.json")
+    assert open_frame_cache(cache_file) is open_frame_cache(cache_file)
@@ -0,0 +1,53 @@
+import h5py
+import numpy as np
+import pytest
+
+from glitch_catalog import GlitchCatalog, glitch_keys
+
+
+@pytest.fixture
+def catalog(tmp_path):
+
+    rng = np.random.default_rng(0)
+    n = 1000
+    with h5py.File(tmp_path / "glitch_info.h5", "w") as g:
+        for key in glitch_keys:
+            g.create_dataset(f"H1/{key}", data=rng.uniform(0, 100, n))
+
+    return GlitchCatalog(tmp_path / "glitch_info.h5", "H1")
+
+
+def brute_force(catalog, t0, t1, snr_min=None):
+
+    time, snr = np.asarray(catalog["time"]), np.asarray(catalog["snr"])
+    result = []
+    for a, b in zip(t0, t1):
+        keep = (time >= a) & (time <= b)
+        if snr_min is not None:
+            keep &= snr >= snr_min
+        result.append(np.flatnonzero(keep))
+
+    return result
+
+
+def test_index_is_sorted(catalog):
+
+    assert np.all(np.diff(catalog["time"]) >= 0)
+    assert len(list(catalog.index_dir.glob("tmp*"))) == 0
+
+
+@pytest.mark.parametrize("cuts", [{}, {"snr_min": 50}])
+def test_batch_query(catalog, cuts):
+
+    t0 = np.array([0.0, 10.0, 50.0, 99.0])
+    t1 = np.array([5.0, 10.5, 80.0, 200.0])
+    idx, offsets = catalog.batch_query(t0, t1, **cuts)
+
+    for i, expected in enumerate(brute_force(catalog, t0, t1, **cuts)):
+        assert np.array_equal(np.sort(idx[offsets[i]:offsets[i + 1]]), expected)
+
+
+def test_count(catalog):
+
+    counts = catalog.count(np.array([0.0]), np.array([100.0]), snr_min=50)
+    assert counts[0] == np.sum(np.asarray(catalog["snr"]) >= 50)
@@ -0,0 +1,30 @@
+import time
+
+import pytest
+
+from omicron_scheduler import run_job
+
+
+def test_run_job_retries(tmp_path):
+
+    bash_file = tmp_path / "job.sh"
+    bash_file.write_text("exit 3\n")
+
+    with pytest.raises(RuntimeError):
+        run_job(bash_file, retries=1)
+
+    assert bash_file.with_suffix(".log").exists()
+
+
+def test_run_job_timeout_kills_children(tmp_path):
+
+    # the subshell outlives bash unless the whole group is killed
+    marker = tmp_path / "marker"
+    bash_file = tmp_path / "job.sh"
+    bash_file.write_text(f"(sleep 1; touch {marker}) &\nwait\n")
+
+    with pytest.raises(RuntimeError):
+        run_job(bash_file, timeout=0.2)
+
+    time.sleep(1.5)
+    assert not marker.exists()
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import torch
+
+from preprocessing import WhiteningStage, WhitenedCache
+
+
+def test_whiten_spectrum_matches_whiten():
+
+    stage = WhiteningStage(sample_rate=2048, kernel_length=0.09765625, fduration=1, fftlength=2)
+
+    batch = torch.randn(3, 2, 8 * 2048 + stage.split_size, dtype=torch.float64)
+    psd_data, batch = stage.split(batch)
+    psds = stage.psd(psd_data)
+
+    expected = stage.whiten(batch, psds)
+    whitened = stage.whiten_spectrum(stage.rfft(batch), psds, batch.size(-1))
+
+    assert whitened.shape == expected.shape
+    torch.testing.assert_close(whitened, expected.float(), rtol=1e-3, atol=1e-3)
+
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_whitened_cache(tmp_path, on_disk):
+
+    cache = WhitenedCache(8, cache_dir=tmp_path / "cache" if on_disk else None)
+
+    def batch(start):
+        values = torch.arange(start, start + 6.)[:, None, None]
+        return values.expand(6, 2, 4), values.expand(6, 2, 3).double()
+
+    cache.add(*batch(0))
+    assert cache.n_filled == 6 and not cache.full
+    np.testing.assert_array_equal(cache.windows[:6, 0, 0], np.arange(6.))
+
+    # the rest fills up, the overflow replaces random entries
+    cache.add(*batch(6))
+    assert cache.full
+    assert set(cache.windows[:, 0, 0].tolist()) <= set(range(12))
+    np.testing.assert_array_equal(cache.windows[:, 0, 0], cache.psds[:, 0, 0])
+
+    windows, psds = cache.sample(16)
+    assert windows.shape == (16, 2, 4) and psds.shape == (16, 2, 3)
+    assert psds.dtype == torch.float64
+    if on_disk:
+        assert sorted(f.name for f in (tmp_path / "cache").iterdir()) == ["psds.npy", "windows.npy"]
+
+
+@pytest.mark.parametrize("kernels_per_chunk, batch_size", [(1, 3), (4, 12), (4, 10)])
+def test_cut_kernels_matches_unfold(kernels_per_chunk, batch_size):
+
+    stage = WhiteningStage(sample_rate=2048, kernel_length=0.09765625, fduration=1, fftlength=2)
+    size = stage.split_size
+    psd_size = 8 * 2048
+
+    n_chunks = -(-batch_size // kernels_per_chunk)
+    chunks = torch.randn(n_chunks, 2, psd_size + kernels_per_chunk * size, dtype=torch.float64)
+    kernels, psds = stage.cut_kernels(chunks, kernels_per_chunk, batch_size)
+
+    # adjacent windows after the PSD data of every chunk, in chunk order
+    expected = chunks[..., psd_size:].unfold(-1, size, size)
+    expected = expected.transpose(1, 2).reshape(-1, 2, size)[:batch_size]
+    assert torch.equal(kernels, expected)
+
+    chunk_psds = stage.psd(chunks[..., :psd_size])
+    expected_psds = torch.stack([chunk_psds[i // kernels_per_chunk] for i in range(batch_size)])
+    assert torch.equal(psds, expected_psds)
@@ -0,0 +1,74 @@
+import math
+
+import numpy as np
+import pytest
+import torch
+
+from torch.distributions.uniform import Uniform
+from ml4gw.distributions import Cosine, Sine
+
+from prior import BasePrior, CompiledPrior, Constant
+
+
+def distributions():
+
+    return dict(
+        frequency=Uniform(64, 512),
+        phase=Uniform(0, 2 * torch.pi),
+        dec=Cosine(-math.pi / 2, math.pi / 2),
+        narrow_dec=Cosine(-0.3, 1.1),
+        theta_jn=Sine(),
+        narrow_theta=Sine(0.2, 2.5),
+        tc=Constant(0),
+        f_ref=Constant(20.0, tensor=False),
+    )
+
+
+@pytest.mark.parametrize("key", ["frequency", "phase", "dec", "narrow_dec", "theta_jn", "narrow_theta"])
+def test_samples_match_torch(key):
+
+    torch.manual_seed(0)
+    dist = distributions()[key]
+    expected = dist.sample((200000,)).double()
+    sampled = CompiledPrior({key: dist}, seed=1).sample(200000)[key].double()
+
+    low, high = expected.min(), expected.max()
+    width = high - low
+    assert sampled.min() >= low - 1e-3 * width and sampled.max() <= high + 1e-3 * width
+
+    # moments and quantiles within a few standard errors
+    assert abs(sampled.mean() - expected.mean()) < 0.01 * width
+    assert abs(sampled.std() - expected.std()) < 0.01 * width
+    quantiles = torch.linspace(0.05, 0.95, 19, dtype=torch.float64)
+    np.testing.assert_allclose(
+        torch.quantile(sampled[:100000], quantiles), torch.quantile(expected[:100000], quantiles), atol=0.01 * width
+    )
+
+
+def test_constants():
+
+    sampled = CompiledPrior(distributions(), seed=0).sample(4)
+
+    assert list(sampled) == list(distributions())
+    assert torch.equal(sampled["tc"], torch.zeros(4))
+    assert sampled["f_ref"] == 20.0
+
+
+def test_seeding():
+
+    prior = BasePrior()
+    prior.params = distributions()
+
+    first = prior.compile(seed=3).sample(8)
+    second = prior.compile(seed=3).sample(8)
+    assert all(torch.equal(first[key], second[key]) for key in ["frequency", "dec", "theta_jn"])
+
+    # without a seed the global generator applies
+    prior.compile()
+    torch.manual_seed(5)
+    first = prior.sample(8)
+    torch.manual_seed(5)
+    second = prior.sample(8)
+    assert all(torch.equal(first[key], second[key]) for key in ["frequency", "dec", "theta_jn"])
+
+    assert not torch.equal(prior.sample(8)["frequency"], second["frequency"])
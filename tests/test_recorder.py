@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+import h5py
+import torch
+
+from recorder import BatchRecorder, recorder_file
+
+
+def test_recorder_file():
+
+    assert recorder_file("out/bbh.h5").name == "bbh.h5"
+    assert recorder_file("out/bbh.h5", rank=1).name == "bbh_rank1.h5"
+    assert recorder_file("out/bbh.h5", 1, "test").name == "bbh_test_rank1.h5"
+
+
+def test_record_every(tmp_path):
+
+    recorder = BatchRecorder(tmp_path / "rec.h5", every=2, grow_size=1)
+    for step in range(5):
+        recorder.record("x", torch.full((3,), step), step)
+    recorder.close()
+
+    with h5py.File(tmp_path / "rec.h5", "r") as f:
+        assert list(f["x/step"][:]) == [0, 2, 4]
+        assert f["x/data"][:, 0].tolist() == [0, 2, 4]
+
+
+def test_record_step_counts_validation(tmp_path):
+
+    recorder = BatchRecorder(tmp_path / "rec.h5")
+    trainer = SimpleNamespace(training=False, validating=True, global_step=7)
+    for _ in range(3):
+        recorder.record_step(trainer, BK=torch.zeros(2))
+    recorder.close()
+
+    with h5py.File(tmp_path / "rec.h5", "r") as f:
+        assert list(f["Validation/BK/step"][:]) == [0, 1, 2]
+
+
+def test_failed_record_is_skipped(tmp_path):
+
+    recorder = BatchRecorder(tmp_path / "rec.h5")
+    append = recorder.append
+
+    def failing_append(f, counts, name, step, data):
+        if name == "bad":
+            raise OSError("disk full")
+        append(f, counts, name, step, data)
+
+    recorder.append = failing_append
+    for step in range(3):
+        recorder.record("bad", torch.zeros(2), step)
+        recorder.record("x", torch.zeros(2), step)
+    recorder.close()
+
+    with h5py.File(tmp_path / "rec.h5", "r") as f:
+        assert list(f["x/step"][:]) == [0, 1, 2]
+        assert "bad" not in f
+
+
+def test_dead_writer_does_not_block(tmp_path):
+
+    # the writer cannot open a directory as its file and stops
+    (tmp_path / "rec.h5").mkdir()
+    recorder = BatchRecorder(tmp_path / "rec.h5", max_queue=1, put_timeout=0.1)
+    recorder.thread.join()
+
+    for step in range(20):
+        recorder.record("x", torch.zeros(2), step)
+
+    assert recorder.n_dropped == 20
+    recorder.close()
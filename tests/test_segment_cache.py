@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from segment_cache import merge_intervals, intersect_intervals, complement_intervals
+
+
+def covered(segs, grid):
+
+    return np.any((grid[:, None] >= segs[:, 0]) & (grid[:, None] < segs[:, 1]), axis=1)
+
+
+def random_intervals(rng, n):
+
+    starts = rng.integers(0, 1000, n)
+    return np.stack([starts, starts + rng.integers(0, 50, n)], axis=1)
+
+
+def test_merge_intervals():
+
+    segs = [[5, 10], [0, 2], [2, 4], [8, 12], [20, 20]]
+    np.testing.assert_array_equal(merge_intervals(segs), [[0, 4], [5, 12]])
+    assert merge_intervals(np.empty((0, 2))).shape == (0, 2)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_intersect_intervals(seed):
+
+    rng = np.random.default_rng(seed)
+    a = merge_intervals(random_intervals(rng, 40))
+    b = merge_intervals(random_intervals(rng, 40))
+
+    segs = intersect_intervals(a, b)
+    assert np.all(segs[1:, 0] >= segs[:-1, 1])
+
+    # checked against a dense grid of half second steps
+    grid = np.arange(0, 1050, 0.5)
+    np.testing.assert_array_equal(covered(segs, grid), covered(a, grid) & covered(b, grid))
+
+    gaps = complement_intervals(a, 100, 900)
+    inside = (grid >= 100) & (grid < 900)
+    np.testing.assert_array_equal(covered(gaps, grid), inside & ~covered(a, grid))
+
+
+def test_intersect_empty():
+
+    assert intersect_intervals([[0, 1]], np.empty((0, 2))).shape == (0, 2)
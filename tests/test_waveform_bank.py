@@ -0,0 +1,47 @@
+import json
+
+import torch
+
+from ml4gw.waveforms import SineGaussian
+
+from prior import SineGaussianHighFrequency, SineGaussianLowFrequency
+from waveform_bank import WaveformBank, build_waveform_bank
+
+
+def build(bank_dir, prior, duration=0.5, n_samples=8):
+
+    build_waveform_bank(
+        bank_dir,
+        prior=prior,
+        waveform=SineGaussian(sample_rate=2048, duration=duration),
+        n_samples=n_samples,
+        sample_rate=2048,
+        chunk_size=4,
+        max_workers=1,
+    )
+
+    return json.loads((bank_dir / "bank.json").read_text())
+
+
+def test_bank_is_reused(tmp_path):
+
+    meta = build(tmp_path, SineGaussianHighFrequency())
+    stamp = (tmp_path / "cross.npy").stat().st_mtime_ns
+
+    assert build(tmp_path, SineGaussianHighFrequency()) == meta
+    assert (tmp_path / "cross.npy").stat().st_mtime_ns == stamp
+
+    parameters, cross, plus = WaveformBank(tmp_path).sample(3)
+    assert cross.shape == plus.shape == (3, meta["length"])
+    assert set(parameters) == set(meta["parameters"])
+
+
+def test_bank_is_rebuilt(tmp_path):
+
+    meta = build(tmp_path, SineGaussianHighFrequency())
+
+    rebuilt = build(tmp_path, SineGaussianLowFrequency())
+    assert rebuilt["config"]["distributions"] != meta["config"]["distributions"]
+
+    rebuilt = build(tmp_path, SineGaussianLowFrequency(), duration=1)
+    assert rebuilt["length"] == 2 * meta["length"]